@@ -0,0 +1,99 @@
+import csv
+import datetime
+import random
+import uuid
+
+from tools import logger
+logger = logger.get_logger(__name__)
+
+
+class StockSampleGenerator:
+    # Synthetic event files in the samples/ format. The same seed and settings always give the same file.
+    # Hot keys: hot_key_ratio of the (store, item) keys receive hot_key_share of the events.
+    # Duplicates repeat an earlier row as is, stale rows are dated before the last event of their key.
+
+    SIZES = {'small': 10000, 'medium': 1000000, 'large': 10000000}
+    DEFAULT_SIZE = 'small'
+    DEFAULT_SEED = 42
+    DEFAULT_STORE_COUNT = 50
+    DEFAULT_ITEM_COUNT = 2000
+    DEFAULT_HOT_KEY_RATIO = 0.01
+    DEFAULT_HOT_KEY_SHARE = 0.5
+    DEFAULT_DUPLICATE_RATIO = 0.01
+    DEFAULT_STALE_RATIO = 0.01
+    DEFAULT_SALE_RATIO = 0.6
+    DEFAULT_START_DATE = datetime.datetime(2019, 1, 1)
+    DEFAULT_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+    DEFAULT_RECENT_ROWS = 1000
+    FIELDS = ['transaction_id', 'event_type', 'date', 'store_number', 'item_number', 'value']
+
+    def __init__(self, row_count=None, seed=None):
+        self.row_count = row_count if row_count else self.SIZES[self.DEFAULT_SIZE]
+        self.seed = self.DEFAULT_SEED if seed is None else seed
+        self.store_count = self.DEFAULT_STORE_COUNT
+        self.item_count = self.DEFAULT_ITEM_COUNT
+        self.hot_key_ratio = self.DEFAULT_HOT_KEY_RATIO
+        self.hot_key_share = self.DEFAULT_HOT_KEY_SHARE
+        self.duplicate_ratio = self.DEFAULT_DUPLICATE_RATIO
+        self.stale_ratio = self.DEFAULT_STALE_RATIO
+        self.sale_ratio = self.DEFAULT_SALE_RATIO
+
+    def get_settings(self):
+        return {'row_count': self.row_count,
+                'seed': self.seed,
+                'store_count': self.store_count,
+                'item_count': self.item_count,
+                'hot_key_ratio': self.hot_key_ratio,
+                'hot_key_share': self.hot_key_share,
+                'duplicate_ratio': self.duplicate_ratio,
+                'stale_ratio': self.stale_ratio,
+                'sale_ratio': self.sale_ratio}
+
+    def _get_key(self, randomizer, key_count, hot_key_count):
+        if randomizer.random() < self.hot_key_share:
+            key_index = randomizer.randrange(hot_key_count)
+        else:
+            key_index = randomizer.randrange(key_count)
+        return key_index % self.store_count + 1, key_index // self.store_count + 1
+
+    def iter_rows(self):
+        randomizer = random.Random(self.seed)
+        key_count = self.store_count * self.item_count
+        hot_key_count = max(1, int(key_count * self.hot_key_ratio))
+        last_dates = {}
+        recent_rows = []
+        # About one event per second, stale rows go up to a day back
+        date = self.DEFAULT_START_DATE
+        for row_index in range(self.row_count):
+            draw = randomizer.random()
+            if recent_rows and draw < self.duplicate_ratio:
+                yield randomizer.choice(recent_rows)
+                continue
+            date += datetime.timedelta(seconds=randomizer.randint(0, 2))
+            key = self._get_key(randomizer, key_count, hot_key_count)
+            is_known_key = key in last_dates
+            event_date = date
+            if is_known_key and draw < self.duplicate_ratio + self.stale_ratio:
+                event_date = last_dates[key] - datetime.timedelta(seconds=randomizer.randint(1, 86400))
+            else:
+                last_dates[key] = date
+            is_sale = is_known_key and randomizer.random() < self.sale_ratio
+            row = [str(uuid.UUID(int=randomizer.getrandbits(128), version=4)),
+                   'sale' if is_sale else 'incoming',
+                   event_date.strftime(self.DEFAULT_DATE_FORMAT),
+                   str(key[0]),
+                   str(key[1]),
+                   str(randomizer.randint(1, 20) if is_sale else randomizer.randint(10, 400))]
+            if len(recent_rows) < self.DEFAULT_RECENT_ROWS:
+                recent_rows.append(row)
+            else:
+                recent_rows[row_index % self.DEFAULT_RECENT_ROWS] = row
+            yield row
+
+    def write(self, path):
+        with open(path, 'w', newline='') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(self.FIELDS)
+            writer.writerows(self.iter_rows())
+        logger.info('Generated {} rows: {}'.format(self.row_count, path))
+        return path
@@ -0,0 +1,73 @@
+from collections import deque
+import queue
+
+from kafka_client.client import StockKafkaClient
+
+
+class MemoryMessage:
+
+    def __init__(self, value, partition_id, offset):
+        self.value = value
+        self.partition_id = partition_id
+        self.offset = offset
+
+
+class MemoryProducer:
+    # Every message is delivered at once, the delivery reports go through the same path as with pykafka
+
+    def __init__(self, topic):
+        self.topic = topic
+        self.delivery_reports = deque()
+
+    def produce(self, value, partition_key=None):
+        message = MemoryMessage(value, 0, len(self.topic))
+        self.topic.append(message)
+        self.delivery_reports.append((message, None))
+        return message
+
+    def get_delivery_report(self, block=False):
+        if not self.delivery_reports:
+            raise queue.Empty
+        return self.delivery_reports.popleft()
+
+    def stop(self):
+        pass
+
+
+class MemoryConsumer:
+
+    def __init__(self, topic):
+        self.topic = topic
+        self.position = 0
+
+    def consume(self, block=True):
+        if self.position >= len(self.topic):
+            return None
+        message = self.topic[self.position]
+        self.position += 1
+        return message
+
+    def commit_offsets(self):
+        pass
+
+
+class MemoryKafkaClient(StockKafkaClient):
+    # StockKafkaClient without a broker: one in-memory partition shared by the producer and the consumer
+
+    def __init__(self):
+        self.messages = []
+        super().__init__()
+
+    def _set_host(self):
+        self.client = self
+
+    def _get_producer(self):
+        if not self.producer:
+            self.producer = MemoryProducer(self.messages)
+        return self.producer
+
+    def get_consumer(self):
+        self.consumer = MemoryConsumer(self.messages)
+
+    def get_consumer_lag(self):
+        return len(self.messages) - self.consumer.position
@@ -0,0 +1,180 @@
+import csv
+import datetime
+import json
+import os
+import platform
+import subprocess
+import time
+
+from database.database import StockServiceDB
+from importer.columnar import StockColumnarValidatorException
+from importer.importer import StockImporter
+from importer.pipeline import StockImportPipeline
+from importer.validator import StockRecordValidator
+from kafka_client.codec import StockEventCodec
+from service.offsets import StockOffsetStore
+from service.service import StockService
+from .memory_kafka import MemoryKafkaClient
+
+from tools import logger
+logger = logger.get_logger(__name__)
+
+
+class StockBenchmarkSuite:
+    # Throughput of the validator, the importer (into an in-memory Kafka) and the service (on a throwaway
+    # Postgres) over one generated file. Results are kept as JSON, to compare runs of different versions.
+
+    BENCHMARKS = ['validator', 'importer', 'importer_columnar', 'importer_pipelined', 'importer_mmap', 'service',
+                  'service_compacted']
+
+    def __init__(self, input_path, generator_settings=None):
+        self.input_path = input_path
+        self.generator_settings = generator_settings
+        self.batch_size = StockService.DEFAULT_BATCH_SIZE
+        self.wire_format = StockEventCodec.DEFAULT_WIRE_FORMAT
+        self.results = {}
+
+    @staticmethod
+    def _get_result(row_count, seconds, **details):
+        result = {'rows': row_count,
+                  'seconds': round(seconds, 6),
+                  'rows_per_second': round(row_count / seconds, 1) if seconds else None}
+        result.update(details)
+        return result
+
+    def bench_validator(self):
+        validator = StockRecordValidator(config=StockImporter.DEFAULT_VALIDATOR_CONFIG)
+        # CSV parsing is timed alone first, to tell the validation cost apart
+        with open(self.input_path, newline='') as csv_file:
+            start = time.perf_counter()
+            row_count = sum(1 for _ in csv.DictReader(csv_file))
+            parse_seconds = time.perf_counter() - start
+        with open(self.input_path, newline='') as csv_file:
+            start = time.perf_counter()
+            valid_count = sum(1 for row in csv.DictReader(csv_file) if validator.validate(row))
+            seconds = time.perf_counter() - start
+        validate_seconds = seconds - parse_seconds
+        return self._get_result(row_count, seconds,
+                                parse_seconds=round(parse_seconds, 6),
+                                valid_rows=valid_count,
+                                validate_rows_per_second=round(row_count / validate_seconds, 1)
+                                if validate_seconds > 0 else None)
+
+    def _get_importer(self, engine, reader=None):
+        importer = StockImporter()
+        importer.kafka_client = MemoryKafkaClient()
+        importer.kafka_client.codec = StockEventCodec(self.wire_format)
+        importer.engine = engine
+        importer.reader = reader if reader else StockImporter.CSV_READER
+        importer.input_dir, importer.filename = os.path.split(os.path.abspath(self.input_path))
+        return importer
+
+    def bench_importer(self, engine=None, reader=None, pipelined=False):
+        importer = self._get_importer(engine if engine else StockImporter.ROW_ENGINE, reader)
+        start = time.perf_counter()
+        if pipelined:
+            importer.summaries = StockImportPipeline(importer).run([importer.filename])
+        else:
+            importer.process()
+        importer.kafka_client.close()
+        seconds = time.perf_counter() - start
+        summary = importer.summaries[importer.filename]
+        return self._get_result(summary['processed_lines'], seconds,
+                                sent_events=len(importer.kafka_client.messages),
+                                sent_bytes=sum(len(message.value) for message in importer.kafka_client.messages),
+                                failed_lines=summary['failed_lines'])
+
+    def bench_importer_columnar(self):
+        try:
+            return self.bench_importer(StockImporter.COLUMNAR_ENGINE)
+        except StockColumnarValidatorException as exc:
+            return {'skipped': str(exc)}
+
+    def bench_importer_pipelined(self):
+        return self.bench_importer(pipelined=True)
+
+    def bench_importer_mmap(self):
+        # The mmap reader is only used by the pipeline, compared to importer_pipelined
+        return self.bench_importer(reader=StockImporter.MMAP_READER, pipelined=True)
+
+    def bench_service(self, compaction=False):
+        # testing.postgresql is a development requirement, only this benchmark needs it
+        import psycopg2
+        import testing.postgresql
+        from scripts.init_db import InitStockDB
+
+        importer = self._get_importer(StockImporter.ROW_ENGINE)
+        importer.process()
+        importer.kafka_client.close()
+        with testing.postgresql.Postgresql() as postgresql:
+            init_db = InitStockDB()
+            init_db.db_conn = psycopg2.connect(**postgresql.dsn())
+            init_db.cursor = init_db.db_conn.cursor()
+            init_db.create_tables()
+            init_db.db_conn.close()
+            service = StockService(database=StockServiceDB(config=postgresql.dsn()), kafka_client=importer.kafka_client)
+            service.batch_size = self.batch_size
+            service.compaction = compaction
+            service.kafka_client.get_consumer()
+            service.offset_store = StockOffsetStore(service.database, service.kafka_client.consumer_group,
+                                                    service.kafka_client.topic)
+            service.warm_cache()
+            event_count = 0
+            start = time.perf_counter()
+            while True:
+                messages = service._get_batch()
+                if not messages:
+                    break
+                service.process_batch([message.value for message in messages],
+                                      offsets=service.offset_store.get_message_offsets(messages))
+                event_count += len(messages)
+            seconds = time.perf_counter() - start
+            service.database.close()
+        return self._get_result(event_count, seconds,
+                                batch_size=self.batch_size,
+                                updated_items=service.updated_item_count,
+                                metrics=service.metrics.get_summary())
+
+    def bench_service_compacted(self):
+        return self.bench_service(compaction=True)
+
+    @staticmethod
+    def _get_commit():
+        try:
+            return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                  cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+        except OSError:
+            return None
+
+    def run(self, benchmarks=None):
+        for name in benchmarks if benchmarks else self.BENCHMARKS:
+            logger.info('Running benchmark: {}'.format(name))
+            self.results[name] = getattr(self, 'bench_{}'.format(name))()
+        return self.results
+
+    def get_report(self):
+        return {'created': datetime.datetime.now().isoformat(timespec='seconds'),
+                'commit': self._get_commit(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'input': os.path.basename(self.input_path),
+                'wire_format': self.wire_format,
+                'generator': self.generator_settings,
+                'results': self.results}
+
+    def write_report(self, path):
+        with open(path, 'w') as report_file:
+            json.dump(self.get_report(), report_file, indent=2)
+        return path
+
+    def compare(self, previous_path):
+        # rows/s of this run against a previous report, per benchmark
+        with open(previous_path, 'r') as report_file:
+            previous_results = json.load(report_file)['results']
+        comparison = {}
+        for name, result in self.results.items():
+            previous_rate = previous_results.get(name, {}).get('rows_per_second')
+            current_rate = result.get('rows_per_second')
+            if previous_rate and current_rate:
+                comparison[name] = round(current_rate / previous_rate, 3)
+        return comparison
@@ -0,0 +1,160 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import psycopg2
+from psycopg2 import extensions
+
+from database.database import StockServiceDB, StockServiceDBException
+
+from tools import logger
+logger = logger.get_logger(__name__)
+
+
+class StockServiceAsyncDB:
+    # Pool of psycopg2 asynchronous connections, polled from the asyncio event loop.
+    # Asynchronous connections are always in autocommit mode: every statement is its own transaction,
+    # unless it runs in transaction().
+
+    DEFAULT_POOL_SIZE = 10
+
+    def __init__(self, config=None, size=None):
+        self.config = config if config else StockServiceDB.DEFAULT_CONFIG
+        self.size = size if size else self.DEFAULT_POOL_SIZE
+        self.connections = []
+        self.idle_connections = None
+        self.statements = {}
+        # Same flag as StockServiceDB: every statement is committed
+        self.autocommit = True
+
+    @staticmethod
+    async def _wait(connection):
+        loop = asyncio.get_running_loop()
+        file_descriptor = connection.fileno()
+        while True:
+            state = connection.poll()
+            if state == extensions.POLL_OK:
+                return
+            ready = loop.create_future()
+
+            def _set_ready():
+                if not ready.done():
+                    ready.set_result(None)
+
+            if state == extensions.POLL_READ:
+                loop.add_reader(file_descriptor, _set_ready)
+                try:
+                    await ready
+                finally:
+                    loop.remove_reader(file_descriptor)
+            elif state == extensions.POLL_WRITE:
+                loop.add_writer(file_descriptor, _set_ready)
+                try:
+                    await ready
+                finally:
+                    loop.remove_writer(file_descriptor)
+            else:
+                raise psycopg2.OperationalError('Bad poll result: {}'.format(state))
+
+    async def open(self):
+        self.idle_connections = asyncio.Queue()
+        for _ in range(self.size):
+            try:
+                connection = psycopg2.connect(async_=True, **self.config)
+                await self._wait(connection)
+            except psycopg2.OperationalError:
+                raise StockServiceDBException('Cannot connect to database! {}'.format(self.config.get('host')))
+            self.connections.append(connection)
+            self.statements[id(connection)] = {}
+            self.idle_connections.put_nowait(connection)
+        logger.info('Async pool opened: {} connections.'.format(self.size))
+
+    async def _run(self, connection, sql, values):
+        cursor = connection.cursor()
+        try:
+            cursor.execute(sql, values)
+            await self._wait(connection)
+            rows = cursor.fetchall() if cursor.description else []
+            return rows, cursor.rowcount
+        finally:
+            cursor.close()
+
+    async def _run_prepared(self, connection, key, sql, values):
+        statements = self.statements[id(connection)]
+        statement = statements.get(key)
+        if not statement:
+            prepared_sql, parameters = StockServiceDB._to_prepared(sql)
+            name = '{}{}'.format(StockServiceDB.DEFAULT_STATEMENT_PREFIX, len(statements) + 1)
+            await self._run(connection, 'PREPARE {} AS {}'.format(name, prepared_sql), None)
+            statement = statements[key] = (name, parameters)
+        name, parameters = statement
+        if not parameters:
+            return await self._run(connection, 'EXECUTE {};'.format(name), None)
+        return await self._run(connection,
+                               'EXECUTE {} ({});'.format(name, ', '.join(['%s'] * len(parameters))),
+                               [values[parameter] for parameter in parameters])
+
+    async def _execute_on(self, connection, sql, values):
+        logger.debug(sql)
+        if values is None:
+            return await self._run(connection, sql, None)
+        return await self._run_prepared(connection, sql, sql, values)
+
+    def _drop(self, connection):
+        # Interrupted in the middle of a query (e.g. cancelled): the connection cannot be reused
+        logger.warning('Async connection dropped: {}'.format(id(connection)))
+        self.connections.remove(connection)
+        self.statements.pop(id(connection), None)
+        connection.close()
+
+    async def execute(self, sql, values=None):
+        # Returns (rows, rowcount); statements with values are prepared once per connection
+        connection = await self.idle_connections.get()
+        try:
+            result = await self._execute_on(connection, sql, values)
+        except psycopg2.Error:
+            self.idle_connections.put_nowait(connection)
+            raise
+        except BaseException:
+            self._drop(connection)
+            raise
+        self.idle_connections.put_nowait(connection)
+        return result
+
+    @asynccontextmanager
+    async def transaction(self):
+        # Statements run on the yielded transaction share one connection and are committed together
+        connection = await self.idle_connections.get()
+        try:
+            await self._run(connection, 'BEGIN;', None)
+            yield StockServiceAsyncTransaction(self, connection)
+            await self._run(connection, 'COMMIT;', None)
+        except Exception:
+            try:
+                await self._run(connection, 'ROLLBACK;', None)
+            except BaseException:
+                self._drop(connection)
+                raise
+            self.idle_connections.put_nowait(connection)
+            raise
+        except BaseException:
+            self._drop(connection)
+            raise
+        self.idle_connections.put_nowait(connection)
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
+        self.connections = []
+        self.statements = {}
+        self.idle_connections = None
+
+
+class StockServiceAsyncTransaction:
+
+    def __init__(self, database, connection):
+        self.database = database
+        self.connection = connection
+
+    async def execute(self, sql, values=None):
+        # Same result as StockServiceAsyncDB.execute, on the connection of the transaction
+        return await self.database._execute_on(self.connection, sql, values)
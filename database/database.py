@@ -1,4 +1,7 @@
+import re
+
 import psycopg2
+import psycopg2.extras
 from psycopg2.errors import UniqueViolation
 
 from tools import logger
@@ -21,8 +24,14 @@ class StockServiceDB:
         'host': DEFAULT_DB_HOST,
         'dbname': DEFAULT_DB_NAME
     }
+    DEFAULT_STATEMENT_PREFIX = 'stockservice_'
+    DEFAULT_STREAM_BATCH_SIZE = 10000
+    PARAMETER_PATTERN = re.compile(r'%\((\w+)\)s|%s')
 
-    def __init__(self, config=None):
+    def __init__(self, config=None, pool=None):
+        self.pool = pool
+        if pool:
+            config = pool.config
         self.config = config if config else self.DEFAULT_CONFIG
         self.connection = None
         self.cursor = None
@@ -31,50 +40,169 @@ class StockServiceDB:
         self.values = None
         self.where = None
         self.query_result = None
+        self.autocommit = True
+        self.statements = {}
+        self.stream_count = 0
         self._connect()
 
     def _connect(self):
+        if self.pool:
+            self.connection = self.pool.get_connection()
+            self.statements = self.pool.get_statement_cache(self.connection)
+            self.cursor = self.connection.cursor()
+            return
         try:
             self.connection = psycopg2.connect(**self.config)
             self.cursor = self.connection.cursor()
         except psycopg2.OperationalError:
             raise StockServiceDBException('Cannot connect to database! {}'.format(self.config['host']))
+        self.statements = {}
+
+    def close(self):
+        if not self.connection:
+            return
+        self.cursor.close()
+        if self.pool:
+            self.pool.put_connection(self.connection)
+        else:
+            self.connection.close()
+        self.connection = None
+        self.cursor = None
+
+    @classmethod
+    def _to_prepared(cls, sql):
+        parameters = []
+
+        def _replace(match):
+            name = match.group(1)
+            if name is None:
+                name = len(parameters)
+            if name not in parameters:
+                parameters.append(name)
+            return '${}'.format(parameters.index(name) + 1)
+
+        return cls.PARAMETER_PATTERN.sub(_replace, sql), parameters
+
+    def _execute_prepared(self, key, sql, values):
+        statement = self.statements.get(key)
+        if not statement:
+            prepared_sql, parameters = self._to_prepared(sql)
+            name = '{}{}'.format(self.DEFAULT_STATEMENT_PREFIX, len(self.statements) + 1)
+            self.cursor.execute('PREPARE {} AS {}'.format(name, prepared_sql))
+            statement = self.statements[key] = (name, parameters)
+        name, parameters = statement
+        if not parameters:
+            self.cursor.execute('EXECUTE {};'.format(name))
+            return
+        self.cursor.execute('EXECUTE {} ({});'.format(name, ', '.join(['%s'] * len(parameters))),
+                            [values[parameter] for parameter in parameters])
+
+    def _get_where(self):
+        # Dict conditions are bound as parameters, plain strings are kept for raw SQL conditions
+        if not self.where:
+            return '', [], ()
+        if isinstance(self.where, dict):
+            where_shape = tuple(self.where.keys())
+            where_sql = ' AND '.join('{}=%s'.format(field) for field in where_shape)
+            return ' WHERE {}'.format(where_sql), list(self.where.values()), where_shape
+        return ' WHERE {}'.format(self.where), [], None
+
+    def _execute(self, operation, sql, values, where_shape):
+        logger.debug(sql)
+        if where_shape is None:
+            self.cursor.execute(sql, values)
+            return
+        key = (operation, self.table, tuple(self.fields) if self.fields else (), where_shape)
+        self._execute_prepared(key, sql, values)
+
+    def _get_query_sql(self):
+        query_sql = 'SELECT '
+        query_sql += ', '.join(self.fields) if self.fields else '*'
+        query_sql += ' from {}'.format(self.table)
+        where_sql, where_values, where_shape = self._get_where()
+        query_sql += where_sql + ';'
+        return query_sql, where_values, where_shape
 
     def query(self):
         if not self.table:
             return
-        query_sql = 'SELECT '
-        query_sql += ', '.join(self.fields) if self.fields else '* '
-        query_sql += ' from {} '.format(self.table)
-        if self.where:
-            query_sql += 'WHERE %s' % self.where
-        query_sql += ';'
-        logger.debug(query_sql)
-        self.cursor.execute(query_sql)
+        query_sql, where_values, where_shape = self._get_query_sql()
+        self._execute('query', query_sql, where_values, where_shape)
         result = self.cursor.fetchall()
         self.query_result = result[0] if result else []
 
+    def stream_query(self, batch_size=None):
+        # Same query as query(), with every row instead of the first one
+        if not self.table:
+            return
+        query_sql, where_values, _ = self._get_query_sql()
+        yield from self.stream(query_sql, where_values, batch_size=batch_size)
+
     def insert(self):
         if not self.table:
             return
+        operation = 'insert'
         insert_sql = 'INSERT INTO '
         insert_sql += '{}({})'.format(self.table, ', '.join(self.fields))
-        insert_sql += ' VALUES ({});'.format(','.join(['%s'] * len(self.values)))
-        logger.debug(insert_sql)
+        insert_sql += ' VALUES ({})'.format(','.join(['%s'] * len(self.values)))
+        if not self.autocommit:
+            # A failing statement would abort the whole open transaction, so conflicts are skipped instead
+            operation = 'insert_skip_conflict'
+            insert_sql += ' ON CONFLICT DO NOTHING'
+        insert_sql += ';'
         try:
-            self.cursor.execute(insert_sql, self.values)
+            self._execute(operation, insert_sql, list(self.values), ())
         except UniqueViolation as exc:
             self.connection.rollback()
             raise StockServiceDBException('Insert failed! {}'.format(exc))
-        else:
-            self.connection.commit()
+        if not self.autocommit:
+            if not self.cursor.rowcount:
+                raise StockServiceDBException('Insert failed! Duplicate key: {}'.format(self.values[0]))
+            return
+        self.connection.commit()
 
     def update(self):
         if any([not self.table, not self.where]):
             return
         update_sql = 'UPDATE {} '.format(self.table)
-        update_sql += "SET {}='{}' ".format(self.fields[0], self.values[0])
-        update_sql += 'WHERE %s' % self.where
-        logger.debug(update_sql)
-        self.cursor.execute(update_sql, self.values)
+        update_sql += 'SET {}'.format(', '.join('{}=%s'.format(field) for field in self.fields))
+        where_sql, where_values, where_shape = self._get_where()
+        update_sql += where_sql + ';'
+        self._execute('update', update_sql, list(self.values) + where_values, where_shape)
+        if self.autocommit:
+            self.connection.commit()
+
+    def execute(self, sql, values=None):
+        logger.debug(sql)
+        if values is None:
+            self.cursor.execute(sql)
+        else:
+            self._execute_prepared(('execute', sql), sql, values)
+        self.query_result = self.cursor.fetchall() if self.cursor.description else []
+        if self.autocommit:
+            self.connection.commit()
+
+    def execute_values(self, sql, rows, template=None):
+        # sql holds one "VALUES %s", every row goes into that single statement
+        logger.debug(sql)
+        psycopg2.extras.execute_values(self.cursor, sql, rows, template=template, page_size=max(len(rows), 1))
+        self.query_result = self.cursor.fetchall() if self.cursor.description else []
+        if self.autocommit:
+            self.connection.commit()
+
+    def stream(self, sql, values=None, batch_size=None):
+        # Server-side cursor: rows are fetched in batches instead of materializing the whole result
+        logger.debug(sql)
+        self.stream_count += 1
+        cursor_name = '{}stream_{}'.format(self.DEFAULT_STATEMENT_PREFIX, self.stream_count)
+        with self.connection.cursor(name=cursor_name) as cursor:
+            cursor.itersize = batch_size if batch_size else self.DEFAULT_STREAM_BATCH_SIZE
+            cursor.execute(sql, values)
+            for row in cursor:
+                yield row
+
+    def commit(self):
         self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
@@ -0,0 +1,69 @@
+from contextlib import contextmanager
+import threading
+
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool, PoolError
+
+from database.database import StockServiceDB, StockServiceDBException
+
+from tools import logger
+logger = logger.get_logger(__name__)
+
+
+class StockServiceDBPool:
+
+    DEFAULT_MIN_SIZE = 1
+    DEFAULT_MAX_SIZE = 10
+
+    def __init__(self, config=None, min_size=None, max_size=None):
+        self.config = config if config else StockServiceDB.DEFAULT_CONFIG
+        self.min_size = min_size if min_size else self.DEFAULT_MIN_SIZE
+        self.max_size = max_size if max_size else self.DEFAULT_MAX_SIZE
+        self.pool = None
+        # Prepared statements live in the server session, so their cache is kept per connection
+        self.statement_caches = {}
+        self.lock = threading.Lock()
+        self._connect()
+
+    def _connect(self):
+        if self.min_size > self.max_size:
+            raise StockServiceDBException('Pool min size is bigger than max size! {} > {}'.format(
+                self.min_size, self.max_size))
+        try:
+            self.pool = ThreadedConnectionPool(self.min_size, self.max_size, **self.config)
+        except psycopg2.OperationalError:
+            raise StockServiceDBException('Cannot connect to database! {}'.format(self.config['host']))
+
+    def get_connection(self):
+        try:
+            connection = self.pool.getconn()
+        except PoolError as exc:
+            raise StockServiceDBException('Cannot get connection from pool! {}'.format(exc))
+        except psycopg2.OperationalError:
+            raise StockServiceDBException('Cannot connect to database! {}'.format(self.config['host']))
+        logger.debug('Connection acquired: %s', id(connection))
+        return connection
+
+    def put_connection(self, connection):
+        self.pool.putconn(connection)
+        if connection.closed:
+            with self.lock:
+                self.statement_caches.pop(id(connection), None)
+        logger.debug('Connection released: %s', id(connection))
+
+    def get_statement_cache(self, connection):
+        with self.lock:
+            return self.statement_caches.setdefault(id(connection), {})
+
+    @contextmanager
+    def database(self):
+        database = StockServiceDB(pool=self)
+        try:
+            yield database
+        finally:
+            database.close()
+
+    def close(self):
+        self.pool.closeall()
+        with self.lock:
+            self.statement_caches.clear()
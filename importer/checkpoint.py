@@ -0,0 +1,115 @@
+from collections import deque
+import hashlib
+import json
+import os
+import threading
+
+from tools import logger
+logger = logger.get_logger(__name__)
+
+
+class StockImportCheckpoint:
+    # Per-file import progress, persisted as JSON. A file is identified by its size, modification time and
+    # the hash of its first and last blocks, so a changed file is imported again from the top.
+    # Progress of a member only advances over rows whose delivery (and of every row before them) is confirmed.
+
+    DEFAULT_PATH = 'import_checkpoint.json'
+    DEFAULT_FINGERPRINT_BLOCK_SIZE = 65536
+    DEFAULT_INTERVAL = 10000
+
+    def __init__(self, path=None):
+        self.path = path if path else self.DEFAULT_PATH
+        self.interval = self.DEFAULT_INTERVAL
+        self.files = {}
+        self.marks = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            self.files = {}
+            return
+        with open(self.path, 'r') as checkpoint_file:
+            self.files = json.load(checkpoint_file)
+        logger.info('Checkpoints loaded: {} files.'.format(len(self.files)))
+
+    def _save(self):
+        # Written next to the target and renamed, so a crash never leaves a truncated checkpoint
+        temporary_path = '{}.tmp'.format(self.path)
+        with open(temporary_path, 'w') as checkpoint_file:
+            json.dump(self.files, checkpoint_file)
+        os.replace(temporary_path, self.path)
+
+    @classmethod
+    def get_fingerprint(cls, filepath):
+        file_stat = os.stat(filepath)
+        content_hash = hashlib.sha256()
+        with open(filepath, 'rb') as checked_file:
+            content_hash.update(checked_file.read(cls.DEFAULT_FINGERPRINT_BLOCK_SIZE))
+            if file_stat.st_size > cls.DEFAULT_FINGERPRINT_BLOCK_SIZE:
+                checked_file.seek(max(file_stat.st_size - cls.DEFAULT_FINGERPRINT_BLOCK_SIZE,
+                                      cls.DEFAULT_FINGERPRINT_BLOCK_SIZE))
+                content_hash.update(checked_file.read())
+        return '{}:{}:{}'.format(file_stat.st_size, file_stat.st_mtime_ns, content_hash.hexdigest())
+
+    def is_done(self, filename, filepath):
+        with self.lock:
+            file_checkpoint = self.files.get(filename)
+            if not file_checkpoint or not file_checkpoint['complete']:
+                return False
+            if not all(member['done'] for member in file_checkpoint['members'].values()):
+                return False
+        return file_checkpoint['fingerprint'] == self.get_fingerprint(filepath)
+
+    def start_file(self, filename, filepath):
+        fingerprint = self.get_fingerprint(filepath)
+        with self.lock:
+            file_checkpoint = self.files.get(filename)
+            if file_checkpoint and file_checkpoint['fingerprint'] == fingerprint:
+                file_checkpoint['complete'] = False
+                return
+            if file_checkpoint:
+                logger.warning('File changed since the last import, starting over: {}'.format(filename))
+            self.files[filename] = {'fingerprint': fingerprint, 'complete': False, 'members': {}}
+
+    def start_member(self, filename, member_name):
+        # Returns the number of rows already imported, the stream position after them and if the member is done
+        with self.lock:
+            members = self.files[filename]['members']
+            member = members.setdefault(member_name, {'rows': 0, 'position': None, 'done': False})
+            if not member['done']:
+                self.marks[(filename, member_name)] = deque()
+            return member['rows'], member['position'], member['done']
+
+    def add_mark(self, filename, member_name, sent_count, rows, position):
+        # sent_count: number of events sent by the producer once the row is sent
+        with self.lock:
+            self.marks[(filename, member_name)].append((sent_count, rows, position))
+
+    def advance(self, acknowledged_count):
+        changed = False
+        with self.lock:
+            for (filename, member_name), marks in self.marks.items():
+                member = self.files[filename]['members'][member_name]
+                while marks and marks[0][0] <= acknowledged_count:
+                    _, member['rows'], member['position'] = marks.popleft()
+                    changed = True
+            if changed:
+                self._save()
+
+    def finish_member(self, filename, member_name, rows, position, acknowledged_count, is_complete):
+        # Incomplete members (failed deliveries, interrupted sending) keep the last acknowledged mark
+        self.advance(acknowledged_count)
+        with self.lock:
+            self.marks.pop((filename, member_name), None)
+            if not is_complete:
+                return
+            member = self.files[filename]['members'][member_name]
+            member.update({'rows': rows, 'position': position, 'done': True})
+            self._save()
+
+    def finish_file(self, filename):
+        # Every member of the file was read; the file is done once all of them are delivered
+        with self.lock:
+            self.files[filename]['complete'] = True
+            self._save()
@@ -0,0 +1,141 @@
+import csv
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from tools import logger
+logger = logger.get_logger(__name__)
+
+
+class StockColumnarValidatorException(BaseException):
+    pass
+
+
+class StockColumnarValidator:
+    # Whole-column checks are strict versions of the StockRecordValidator rules. Rows failing them are
+    # re-checked by the row validator, so the accepted rows and the error messages stay the same.
+
+    DEFAULT_BLOCK_SIZE = 10000
+    DEFAULT_INTEGER_MAX_LENGTH = 18
+    UUID_LENGTH = 36
+    UUID_HYPHEN_POSITIONS = (8, 13, 18, 23)
+    DATETIME_LENGTH = 20
+    DATETIME_DIGIT_POSITIONS = (0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18)
+    DATETIME_SEPARATORS = {4: '-', 7: '-', 10: 'T', 13: ':', 16: ':', 19: 'Z'}
+    MONTH_DAYS = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+    def __init__(self, row_validator):
+        if np is None:
+            raise StockColumnarValidatorException('NumPy is required for the columnar engine!')
+        self.row_validator = row_validator
+        self.config = row_validator.config
+        self.block_size = self.DEFAULT_BLOCK_SIZE
+        self.column_checks = {'_check_uuid': self._check_uuid_column,
+                              '_check_datetime': self._check_datetime_column,
+                              '_check_integer': self._check_integer_column}
+
+    @staticmethod
+    def _get_lengths(column):
+        return np.fromiter(map(len, column), dtype=np.int64, count=len(column))
+
+    @staticmethod
+    def _get_codes(column, width):
+        # Character codes as a (rows, width) matrix, shorter values are zero padded
+        return np.array(column, dtype='U{}'.format(width)).view(np.uint32).reshape(-1, width)
+
+    @staticmethod
+    def _is_digit(codes):
+        return (codes >= ord('0')) & (codes <= ord('9'))
+
+    def _check_uuid_column(self, column):
+        codes = self._get_codes(column, self.UUID_LENGTH)
+        is_hex = self._is_digit(codes) | ((codes >= ord('a')) & (codes <= ord('f'))) | \
+            ((codes >= ord('A')) & (codes <= ord('F')))
+        is_hyphen_position = np.zeros(self.UUID_LENGTH, dtype=bool)
+        is_hyphen_position[list(self.UUID_HYPHEN_POSITIONS)] = True
+        is_valid = np.where(is_hyphen_position, codes == ord('-'), is_hex).all(axis=1)
+        return is_valid & (self._get_lengths(column) == self.UUID_LENGTH)
+
+    def _check_datetime_column(self, column):
+        codes = self._get_codes(column, self.DATETIME_LENGTH)
+        is_valid = self._get_lengths(column) == self.DATETIME_LENGTH
+        is_valid &= self._is_digit(codes[:, list(self.DATETIME_DIGIT_POSITIONS)]).all(axis=1)
+        for position, separator in self.DATETIME_SEPARATORS.items():
+            is_valid &= codes[:, position] == ord(separator)
+        digits = codes.astype(np.int64) - ord('0')
+        year = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 + digits[:, 3]
+        month = digits[:, 5] * 10 + digits[:, 6]
+        day = digits[:, 8] * 10 + digits[:, 9]
+        is_valid &= (month >= 1) & (month <= 12) & (day >= 1) & (year >= 1)
+        is_leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+        month_days = np.array(self.MONTH_DAYS)[np.clip(month, 1, 12) - 1] + (is_leap & (month == 2))
+        is_valid &= day <= month_days
+        is_valid &= digits[:, 11] * 10 + digits[:, 12] < 24
+        is_valid &= digits[:, 14] * 10 + digits[:, 15] < 60
+        is_valid &= digits[:, 17] * 10 + digits[:, 18] < 60
+        return is_valid
+
+    def _check_integer_column(self, column):
+        lengths = self._get_lengths(column)
+        codes = self._get_codes(column, self.DEFAULT_INTEGER_MAX_LENGTH)
+        positions = np.arange(self.DEFAULT_INTEGER_MAX_LENGTH)
+        is_inside = positions < lengths[:, None]
+        is_sign = (positions == 0) & (codes == ord('-')) & (lengths[:, None] > 1)
+        is_valid = (~is_inside | self._is_digit(codes) | is_sign).all(axis=1)
+        return is_valid & (lengths >= 1) & (lengths <= self.DEFAULT_INTEGER_MAX_LENGTH)
+
+    def _check_column(self, column_name, column):
+        check_type = self.config.get(column_name, None)
+        if isinstance(check_type, list):
+            return np.isin(np.char.lower(np.array(column)), check_type)
+        if check_type in self.column_checks:
+            return self.column_checks[check_type](column)
+        # No column rule: every row goes through the row validator
+        return np.zeros(len(column), dtype=bool)
+
+    @staticmethod
+    def _get_record_line(header, row):
+        # Same shape as a csv.DictReader line, for the row validator
+        record_line = dict(zip(header, row))
+        if len(row) > len(header):
+            record_line[None] = row[len(header):]
+        for column_name in header[len(row):]:
+            record_line[column_name] = None
+        return record_line
+
+    def validate_block(self, header, rows):
+        is_valid = np.fromiter((len(row) == len(header) for row in rows), dtype=bool, count=len(rows))
+        if len(header) != self.row_validator.line_length:
+            is_valid[:] = False
+        proper_rows = [row for row in rows if len(row) == len(header)] if is_valid.any() else []
+        if proper_rows:
+            is_proper_valid = np.ones(len(proper_rows), dtype=bool)
+            for column_name, column in zip(header, zip(*proper_rows)):
+                is_proper_valid &= self._check_column(column_name, column)
+            is_valid[is_valid] = is_proper_valid
+        reasons = {}
+        for row_index in np.flatnonzero(~is_valid):
+            if self.row_validator.validate(self._get_record_line(header, rows[row_index])):
+                is_valid[row_index] = True
+            else:
+                reasons[int(row_index)] = self.row_validator.error
+        return is_valid, reasons
+
+    def iter_blocks(self, csv_file, delimiter):
+        csv_reader = csv.reader(csv_file, delimiter=delimiter)
+        header = next(csv_reader, None)
+        if header is None:
+            return
+        rows = []
+        for row in csv_reader:
+            # Blank lines are skipped, as csv.DictReader does
+            if not row:
+                continue
+            rows.append(row)
+            if len(rows) >= self.block_size:
+                yield header, rows
+                rows = []
+        if rows:
+            yield header, rows
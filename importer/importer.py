@@ -2,9 +2,13 @@ import csv
 import os
 
 from kafka_client.client import StockKafkaClient, StockKafkaClientException
+from .columnar import StockColumnarValidator
+from .pipeline import StockImportPipeline
+from .sources import READ_ERRORS, StockImportSource
 from .validator import StockRecordValidator
 
 from tools import logger
+event_logger = logger.get_sampled_logger(__name__)
 logger = logger.get_logger(__name__)
 
 
@@ -17,6 +21,13 @@ class StockImporter:
     DEFAULT_INPUT_DIR = 'samples'
     DEFAULT_FILE_SUFFIX = '.csv'
     DEFAULT_DELIMITER = ','
+    ROW_ENGINE = 'row'
+    COLUMNAR_ENGINE = 'columnar'
+    DEFAULT_ENGINE = ROW_ENGINE
+    CSV_READER = 'csv'
+    MMAP_READER = 'mmap'
+    DEFAULT_READER = CSV_READER
+    DEFAULT_PROGRESS_INTERVAL = 100000
     DEFAULT_VALIDATOR_CONFIG = {
         'transaction_id': '_check_uuid',
         'event_type': ['incoming', 'sale'],
@@ -30,10 +41,21 @@ class StockImporter:
         self.input_dir = self.DEFAULT_INPUT_DIR
         self.file_suffix = self.DEFAULT_FILE_SUFFIX
         self.delimiter = self.DEFAULT_DELIMITER
+        self.engine = self.DEFAULT_ENGINE
+        # mmap: plain files of the pipelined import are read through StockMmapReader, the others stay on csv
+        self.reader = self.DEFAULT_READER
         self.validator = StockRecordValidator(config=self.DEFAULT_VALIDATOR_CONFIG)
         self.kafka_client = StockKafkaClient()
         self.import_file_path = None
+        self.member_name = None
         self.processed_lines = None
+        self.failed_lines = None
+        self.summaries = {}
+        # StockImportCheckpoint, when restarts should resume instead of sending every file again
+        self.checkpoint = None
+        self.resumed_lines = 0
+        self.resumed_position = None
+        self.is_interrupted = False
 
     def _set_filepath(self):
         if not self.filename:
@@ -44,40 +66,161 @@ class StockImporter:
         self.import_file_path = filepath
         logger.debug('Filepath: {}'.format(self.import_file_path))
 
+    def _check_delivery_failures(self):
+        failed_events = self.kafka_client.get_delivery_failures()
+        for transaction_id, exc in failed_events:
+            logger.error('Record delivery failed: {}; {}'.format(transaction_id, exc))
+        self.failed_lines = len(failed_events)
+        if self.failed_lines:
+            logger.error('Failed {} lines.'.format(self.failed_lines))
+
+    def _send_line(self, validated_line):
+        try:
+            self.kafka_client.send_event(validated_line)
+        except StockKafkaClientException as exc:
+            logger.critical(exc)
+            self.is_interrupted = True
+            return False
+        event_logger.info('Record sent: %s', validated_line['transaction_id'])
+        return True
+
+    @staticmethod
+    def _iter_lines(csv_file, position):
+        # readline keeps tell() available for the checkpoints; the header is read before seeking to the position
+        yield csv_file.readline()
+        if position is not None:
+            csv_file.seek(position)
+        yield from iter(csv_file.readline, '')
+
+    def _get_lines(self, csv_file):
+        if not self.checkpoint:
+            return csv_file
+        return self._iter_lines(csv_file, self.resumed_position)
+
+    def _add_checkpoint_mark(self, csv_file, row_index):
+        self.checkpoint.add_mark(self.filename, self.member_name, self.kafka_client.sent_count, row_index,
+                                 csv_file.tell())
+        self.checkpoint.advance(self.kafka_client.get_acknowledged_count())
+
+    def _process_rows(self, csv_file):
+        csv_reader = csv.DictReader(self._get_lines(csv_file), delimiter=self.delimiter)
+        row_index = self.resumed_lines
+        validated_lines = 0
+        while True:
+            try:
+                current_line = next(csv_reader)
+            except StopIteration:
+                break
+            except READ_ERRORS:
+                raise StockImporterException('Cannot process file: {}'.format(self.import_file_path))
+            if self.validator.validate(current_line):
+                validated_line = {name: value for name, value in current_line.items()}
+                logger.debug('validated_line: %s', validated_line)
+                validated_lines += 1
+                if not self._send_line(validated_line):
+                    break
+            row_index += 1
+            if not row_index % self.DEFAULT_PROGRESS_INTERVAL:
+                logger.info('Progress {}: {} lines processed.'.format(self.member_name, row_index))
+            if self.checkpoint and not row_index % self.checkpoint.interval:
+                self._add_checkpoint_mark(csv_file, row_index)
+        return row_index - self.resumed_lines, validated_lines
+
+    def _process_columnar(self, csv_file):
+        columnar_validator = StockColumnarValidator(self.validator)
+        row_index = self.resumed_lines
+        validated_lines = 0
+        blocks = columnar_validator.iter_blocks(self._get_lines(csv_file), self.delimiter)
+        while True:
+            try:
+                header, rows = next(blocks)
+            except StopIteration:
+                break
+            except READ_ERRORS:
+                raise StockImporterException('Cannot process file: {}'.format(self.import_file_path))
+            is_valid, reasons = columnar_validator.validate_block(header, rows)
+            logger.debug('Block rejects: %s', reasons)
+            if row_index // self.DEFAULT_PROGRESS_INTERVAL != (row_index + len(rows)) // self.DEFAULT_PROGRESS_INTERVAL:
+                logger.info('Progress {}: {} lines processed.'.format(self.member_name, row_index + len(rows)))
+            for row, is_valid_row in zip(rows, is_valid):
+                row_index += 1
+                if not is_valid_row:
+                    continue
+                validated_lines += 1
+                if not self._send_line(dict(zip(header, row))):
+                    return row_index - self.resumed_lines, validated_lines
+            if self.checkpoint:
+                self._add_checkpoint_mark(csv_file, row_index)
+        return row_index - self.resumed_lines, validated_lines
+
+    def _process_member(self, csv_file):
+        self.resumed_lines, self.resumed_position, is_done = 0, None, False
+        if self.checkpoint:
+            self.resumed_lines, self.resumed_position, is_done = self.checkpoint.start_member(
+                self.filename, self.member_name)
+        if is_done:
+            logger.info('Already imported, skipped: {}'.format(self.member_name))
+            self.summaries[self.member_name] = {'skipped': True}
+            return
+        if self.resumed_lines:
+            logger.info('Resuming {} after {} lines.'.format(self.member_name, self.resumed_lines))
+        self.is_interrupted = False
+        if self.engine == self.COLUMNAR_ENGINE:
+            self.processed_lines, validated_lines = self._process_columnar(csv_file)
+        else:
+            self.processed_lines, validated_lines = self._process_rows(csv_file)
+        self.kafka_client.flush()
+        acknowledged_count = self.kafka_client.get_acknowledged_count() if self.checkpoint else None
+        self._check_delivery_failures()
+        if self.checkpoint:
+            self.checkpoint.finish_member(self.filename, self.member_name, self.resumed_lines + self.processed_lines,
+                                          csv_file.tell(), acknowledged_count,
+                                          not self.failed_lines and not self.is_interrupted)
+        logger.info('Validated {} lines of {}.'.format(validated_lines, self.member_name))
+        logger.info('Processed {} lines of {}.'.format(self.processed_lines, self.member_name))
+        self.summaries[self.member_name] = {'validated_lines': validated_lines,
+                                            'processed_lines': self.processed_lines,
+                                            'failed_lines': self.failed_lines,
+                                            'partition_key': self.kafka_client.partitioner.strategy}
+        if self.resumed_lines:
+            self.summaries[self.member_name]['resumed_lines'] = self.resumed_lines
+
     def process(self):
         self._set_filepath()
         logger.info('Processing: {}'.format(self.import_file_path))
-        validated_lines = 0
-        with open(self.import_file_path, 'r') as csv_file:
-            csv_reader = csv.DictReader(csv_file, delimiter=self.delimiter)
-            row_index = 0
+        if self.checkpoint:
+            if self.checkpoint.is_done(self.filename, self.import_file_path):
+                logger.info('Already imported, skipped: {}'.format(self.import_file_path))
+                self.summaries[self.filename] = {'skipped': True}
+                return
+            self.checkpoint.start_file(self.filename, self.import_file_path)
+        # Compressed drops are read member by member, each one gets its own summary
+        source = StockImportSource(self.import_file_path, self.file_suffix)
+        members = source.iter_members()
+        try:
             while True:
                 try:
-                    current_line = next(csv_reader)
+                    self.member_name, csv_file = next(members)
                 except StopIteration:
                     break
-                except UnicodeDecodeError:
+                except READ_ERRORS:
                     raise StockImporterException('Cannot process file: {}'.format(self.import_file_path))
-                if self.validator.validate(current_line):
-                    validated_line = {name: value for name, value in current_line.items()}
-                    logger.debug('validated_line: {}'.format(validated_line))
-                    validated_lines += 1
-                    try:
-                        self.kafka_client.send_event(validated_line)
-                    except StockKafkaClientException as exc:
-                        logger.critical(exc)
-                        break
-                    logger.info('Record sent: {}'.format(validated_line['transaction_id']))
-                row_index += 1
-            self.processed_lines = row_index
-            logger.info('Validated {} lines.'.format(validated_lines))
-            logger.info('Processed {} lines.'.format(self.processed_lines))
+                self._process_member(csv_file)
+        finally:
+            members.close()
+        if self.checkpoint:
+            self.checkpoint.finish_file(self.filename)
 
     def get_files(self):
         filenames = os.listdir(self.input_dir)
-        return [filename for filename in filenames if filename.endswith(self.file_suffix)]
+        return [filename for filename in filenames if StockImportSource.is_supported(filename, self.file_suffix)]
 
-    def process_all(self):
-        for filename in self.get_files():
-            self.filename = filename
-            self.process()
+    def process_all(self, pipelined=False):
+        if pipelined:
+            pipeline = StockImportPipeline(self)
+            self.summaries = pipeline.run(self.get_files())
+        else:
+            for filename in self.get_files():
+                self.filename = filename
+                self.process()
+        self.kafka_client.close()
@@ -0,0 +1,180 @@
+import csv
+import mmap
+import os
+import re
+
+from .sources import StockImportSource
+
+from tools import logger
+logger = logger.get_logger(__name__)
+
+
+class StockRowView:
+    # One CSV row over the bytes of its line. The line is decoded and split on first access only: the
+    # validator reads every field once, and the same values are sent. Undecodable bytes are replaced, so
+    # the row fails the validation instead of the whole file.
+
+    __slots__ = ('reader', 'line', 'values')
+
+    def __init__(self, reader, line, values=None):
+        self.reader = reader
+        self.line = line
+        self.values = values
+
+    def _decode(self):
+        self.values = self.line.decode('utf-8', 'replace').split(self.reader.delimiter)
+        return self.values
+
+    def __len__(self):
+        if self.values is None:
+            return self.line.count(self.reader.delimiter_bytes) + 1
+        return len(self.values)
+
+    def __getitem__(self, name):
+        position = self.reader.index[name]
+        values = self.values if self.values is not None else self._decode()
+        return values[position] if position < len(values) else None
+
+    def get(self, name, default=None):
+        value = self[name] if name in self.reader.index else None
+        return default if value is None else value
+
+    def keys(self):
+        return self.reader.names
+
+    def items(self):
+        return zip(self.reader.names, self.values if self.values is not None else self._decode())
+
+    def to_dict(self):
+        return dict(self.items())
+
+
+class StockMmapReader:
+    # Reads a plain CSV file through a read-only memory map, in byte ranges cut at line ends: the pages
+    # stay in the page cache instead of the process memory, and every range can be parsed on its own,
+    # e.g. by another process. Rows are views over their line; lines with quotes go through the csv module,
+    # together with the next lines while a quoted field is open. Compressed drops cannot be mapped, they are
+    # read as text streams.
+
+    DEFAULT_RANGE_SIZE = 1024 * 1024
+    QUOTE = b'"'
+    QUOTE_PATTERN = re.compile(b'"')
+
+    def __init__(self, filepath, delimiter=','):
+        self.filepath = filepath
+        self.delimiter = delimiter
+        self.delimiter_bytes = delimiter.encode('utf-8')
+        self.file = None
+        self.map = None
+        self.size = 0
+        self.names = []
+        self.index = {}
+        self.data_start = 0
+        # Byte position after the last row read, for the checkpoints
+        self.position = 0
+
+    @staticmethod
+    def is_supported(filepath):
+        return not filepath.endswith(StockImportSource.COMPRESSED_SUFFIXES)
+
+    def open(self):
+        self.file = open(self.filepath, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        # An empty file cannot be mapped
+        if self.size:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            header_end = self.map.find(b'\n')
+            self.data_start = header_end + 1 if header_end >= 0 else self.size
+            header = self.map[:self.data_start].decode('utf-8').rstrip('\r\n')
+            self.names = next(csv.reader([header], delimiter=self.delimiter)) if header else []
+            self.index = {name: position for position, name in enumerate(self.names)}
+        self.position = self.data_start
+        return self
+
+    def close(self):
+        if self.map:
+            self.map.close()
+            self.map = None
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _get_line_end(self, position):
+        # Position after the line holding position - 1, i.e. the start of the next line
+        if position <= self.data_start or position >= self.size:
+            return min(max(position, self.data_start), self.size)
+        line_end = self.map.find(b'\n', position - 1)
+        return line_end + 1 if line_end >= 0 else self.size
+
+    def _count_quotes(self, start, end):
+        # Searched in the mapping, without a copy of the bytes
+        if self.map.find(self.QUOTE, start, end) < 0:
+            return 0
+        return sum(1 for _ in self.QUOTE_PATTERN.finditer(self.map, start, end))
+
+    def _iter_ranges(self, range_size=None, start=None):
+        range_size = range_size if range_size else self.DEFAULT_RANGE_SIZE
+        range_start = self._get_line_end(start if start else self.data_start)
+        while range_start < self.size:
+            range_end = self._get_line_end(range_start + range_size)
+            quote_count = self._count_quotes(range_start, range_end)
+            while quote_count % 2 and range_end < self.size:
+                next_end = self._get_line_end(range_end + 1)
+                quote_count += self._count_quotes(range_end, next_end)
+                range_end = next_end
+            self._release(range_start, range_end)
+            yield range_start, range_end
+            range_start = range_end
+
+    def get_ranges(self, range_size=None, start=None):
+        # (start, end) byte ranges of whole lines, about range_size bytes each, from start (default: after the
+        # header) to the end of the file. A range is never cut inside a quoted field spanning several lines.
+        # Produced lazily: a range is scanned when the one before it is taken.
+        return self._iter_ranges(range_size, start)
+
+    def _release(self, start, end):
+        # The pages of a read range still count in the RSS of the process; the rows hold a copy of their line,
+        # so the pages are dropped from the mapping once the range is read. They stay in the page cache.
+        if not self.map or not hasattr(mmap, 'MADV_DONTNEED'):
+            return
+        page_start = start - start % mmap.PAGESIZE
+        if end > page_start:
+            self.map.madvise(mmap.MADV_DONTNEED, page_start, end - page_start)
+
+    def _get_next_line_end(self, position, end):
+        line_end = self.map.find(b'\n', position, end)
+        return line_end if line_end >= 0 else end
+
+    def iter_rows(self, start=None, end=None):
+        # Row views of the lines between start and end; both are expected at line starts, see get_ranges
+        if end is None:
+            for range_start, range_end in self._iter_ranges(start=start):
+                yield from self.iter_rows(range_start, range_end)
+            return
+        range_start = position = start if start else self.data_start
+        # The mapping is scanned in place, only one line is copied at a time
+        while self.map and position < end:
+            line_end = self._get_next_line_end(position, end)
+            line = self.map[position:line_end]
+            values = None
+            if self.QUOTE in line:
+                # An odd number of quotes leaves a field open: the record goes on with the next line
+                while line.count(self.QUOTE) % 2 and line_end < end:
+                    line_end = self._get_next_line_end(line_end + 1, end)
+                    line = self.map[position:line_end]
+                values = next(csv.reader([line.decode('utf-8', 'replace').rstrip('\r')],
+                                         delimiter=self.delimiter), [])
+            position = line_end + 1
+            self.position = min(position, end)
+            if line.endswith(b'\r'):
+                line = line[:-1]
+            if not line:
+                continue
+            yield StockRowView(self, line, values)
+        self._release(range_start, end)
@@ -0,0 +1,323 @@
+import bisect
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import multiprocessing
+import os
+import queue
+import threading
+
+from kafka_client.client import StockKafkaClientException
+from .mmap_reader import StockMmapReader
+from .sources import READ_ERRORS, StockImportSource
+from .validator import StockRecordValidator
+
+from tools import logger
+logger = logger.get_logger(__name__)
+
+
+validator = None
+
+
+def init_validator(config):
+    global validator
+    validator = StockRecordValidator(config=config)
+
+
+def validate_chunk(filename, rows):
+    return filename, [row for row in rows if validator.validate(row)], len(rows)
+
+
+def validate_range(filename, delimiter, filepath, start, end):
+    # The validator process parses its own byte range of the file, only the valid rows are sent back
+    row_count = 0
+    valid_rows = []
+    with StockMmapReader(filepath, delimiter) as row_reader:
+        for row in row_reader.iter_rows(start, end):
+            row_count += 1
+            if validator.validate(row):
+                valid_rows.append(row.to_dict())
+    return filename, valid_rows, row_count
+
+
+class StockImportPipelineException(BaseException):
+    pass
+
+
+class StockImportPipeline:
+
+    DEFAULT_CHUNK_SIZE = 1000
+    DEFAULT_RANGE_SIZE = 1024 * 1024
+    DEFAULT_QUEUE_SIZE = 16
+    DEFAULT_READER_COUNT = 2
+    DEFAULT_VALIDATOR_COUNT = os.cpu_count()
+    DEFAULT_QUEUE_TIMEOUT_S = 0.5
+    DEFAULT_PROGRESS_INTERVAL = 100000
+
+    def __init__(self, importer):
+        self.importer = importer
+        self.chunk_size = self.DEFAULT_CHUNK_SIZE
+        # Bytes per chunk of the files read with the mmap reader
+        self.range_size = self.DEFAULT_RANGE_SIZE
+        self.queue_size = self.DEFAULT_QUEUE_SIZE
+        self.reader_count = self.DEFAULT_READER_COUNT
+        self.validator_count = self.DEFAULT_VALIDATOR_COUNT
+        self.file_queue = None
+        self.read_queue = None
+        self.send_queue = None
+        self.stop_event = threading.Event()
+        self.summaries = {}
+        self.sent_lines = 0
+        self.next_progress = self.DEFAULT_PROGRESS_INTERVAL
+        self.next_checkpoint = 0
+        # Line counts of the members read in byte ranges, counted by the sender
+        self.member_lines = {}
+        # First producer sequence of every sent chunk and its member, to credit delivery failures
+        self.chunk_sequences = []
+        self.chunk_members = []
+        # Members read to the end, finished once every file is sent and the producer is flushed
+        self.read_members = []
+
+    def _put(self, target_queue, item):
+        # Bounded queues give backpressure; the stop event keeps a blocked stage from hanging on errors
+        while not self.stop_event.is_set():
+            try:
+                target_queue.put(item, timeout=self.DEFAULT_QUEUE_TIMEOUT_S)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _add_summary(self, member_name):
+        return self.summaries.setdefault(member_name, {'validated_lines': 0, 'processed_lines': 0, 'failed_lines': 0,
+                                                       'partition_key': self.importer.kafka_client.partitioner.strategy})
+
+    def _start_member(self, filename, member_name):
+        checkpoint = self.importer.checkpoint
+        if not checkpoint:
+            self._add_summary(member_name)
+            return 0, None, False
+        resumed_lines, position, is_done = checkpoint.start_member(filename, member_name)
+        if is_done:
+            logger.info('Already imported, skipped: {}'.format(member_name))
+            self.summaries[member_name] = {'skipped': True}
+        elif resumed_lines:
+            logger.info('Resuming {} after {} lines.'.format(member_name, resumed_lines))
+            self._add_summary(member_name)['resumed_lines'] = resumed_lines
+        else:
+            self._add_summary(member_name)
+        return resumed_lines, position, is_done
+
+    def _read_ranges(self, filename, filepath):
+        # Items carry the byte range instead of the rows, and no line count: it is known once validated
+        line_count, position, is_done = self._start_member(filename, filename)
+        if is_done:
+            return True
+        self.member_lines[(filename, filename)] = line_count
+        logger.info('Reading: {}'.format(filename))
+        with StockMmapReader(filepath, self.importer.delimiter) as row_reader:
+            for start, end in row_reader.get_ranges(self.range_size, start=position):
+                if not self._put(self.read_queue, ((filename, filename), (filepath, start, end), None, end)):
+                    return False
+            return self._put(self.read_queue, ((filename, filename), None, None, row_reader.size))
+
+    def _read_file(self, filename):
+        # Every member of a compressed drop is read as a file of its own, with its own summary.
+        # Items carry the line count and stream position after the chunk, for the checkpoints.
+        filepath = os.path.join(self.importer.input_dir, filename)
+        checkpoint = self.importer.checkpoint
+        if checkpoint:
+            checkpoint.start_file(filename, filepath)
+        source = StockImportSource(filepath, self.importer.file_suffix)
+        member_name = None
+        chunk = []
+        line_count = 0
+        try:
+            if self.importer.reader == self.importer.MMAP_READER and StockMmapReader.is_supported(filepath):
+                member_name = filename
+                if self._read_ranges(filename, filepath) and checkpoint:
+                    checkpoint.finish_file(filename)
+                return
+            for member_name, csv_file in source.iter_members():
+                line_count, position, is_done = self._start_member(filename, member_name)
+                if is_done:
+                    continue
+                logger.info('Reading: {}'.format(member_name))
+                lines = self.importer._iter_lines(csv_file, position) if checkpoint else csv_file
+                for row in csv.DictReader(lines, delimiter=self.importer.delimiter):
+                    chunk.append(row)
+                    if len(chunk) < self.chunk_size:
+                        continue
+                    line_count += len(chunk)
+                    position = csv_file.tell() if checkpoint else None
+                    if not self._put(self.read_queue, ((filename, member_name), chunk, line_count, position)):
+                        return
+                    chunk = []
+                line_count += len(chunk)
+                position = csv_file.tell() if checkpoint else None
+                if chunk and not self._put(self.read_queue, ((filename, member_name), chunk, line_count, position)):
+                    return
+                chunk = []
+                # End-of-file marker travels behind the last chunk of the member
+                self._put(self.read_queue, ((filename, member_name), None, line_count, position))
+                member_name = None
+        except READ_ERRORS:
+            logger.error('Cannot process file: {}'.format(filepath))
+            member_name = member_name if member_name else filename
+            self._add_summary(member_name)['error'] = 'Cannot process file'
+            if chunk:
+                self._put(self.read_queue, ((filename, member_name), chunk, line_count + len(chunk), None))
+            self._put(self.read_queue, ((filename, member_name), None, line_count, None))
+            return
+        if checkpoint:
+            checkpoint.finish_file(filename)
+
+    def _run_reader(self):
+        while not self.stop_event.is_set():
+            try:
+                filename = self.file_queue.get_nowait()
+            except queue.Empty:
+                return
+            self._read_file(filename)
+
+    def _run_dispatcher(self, executor, readers):
+        while not self.stop_event.is_set():
+            try:
+                source, chunk, line_count, position = self.read_queue.get(timeout=self.DEFAULT_QUEUE_TIMEOUT_S)
+            except queue.Empty:
+                if not any(reader.is_alive() for reader in readers) and self.read_queue.empty():
+                    break
+                continue
+            if chunk is None:
+                future = None
+            elif isinstance(chunk, tuple):
+                future = executor.submit(validate_range, source[1], self.importer.delimiter, *chunk)
+            else:
+                future = executor.submit(validate_chunk, source[1], chunk)
+            if not self._put(self.send_queue, (source, future, line_count, position)):
+                return
+        self._put(self.send_queue, None)
+
+    def _send_chunk(self, filename, valid_rows, row_count):
+        summary = self.summaries[filename]
+        summary['processed_lines'] += row_count
+        summary['validated_lines'] += len(valid_rows)
+        if valid_rows:
+            self.chunk_sequences.append(self.importer.kafka_client.sent_count + 1)
+            self.chunk_members.append(filename)
+        for row in valid_rows:
+            self.importer.kafka_client.send_event(row)
+            logger.debug('Record sent: %s', row['transaction_id'])
+        self.sent_lines += len(valid_rows)
+        if self.sent_lines >= self.next_progress:
+            logger.info('Progress: {} lines sent.'.format(self.sent_lines))
+            self.next_progress += self.DEFAULT_PROGRESS_INTERVAL
+
+    def _add_checkpoint_mark(self, source, line_count, position):
+        checkpoint = self.importer.checkpoint
+        checkpoint.add_mark(source[0], source[1], self.importer.kafka_client.sent_count, line_count, position)
+        if self.sent_lines >= self.next_checkpoint:
+            checkpoint.advance(self.importer.kafka_client.get_acknowledged_count())
+            self.next_checkpoint = self.sent_lines + checkpoint.interval
+
+    def _get_failed_lines(self):
+        # Chunks of the files are interleaved: a failure belongs to the member of the chunk holding its sequence
+        failed_lines = {}
+        for sequence, transaction_id, exc in self.importer.kafka_client.get_sequenced_delivery_failures():
+            logger.error('Record delivery failed: {}; {}'.format(transaction_id, exc))
+            if sequence is None or sequence < self.chunk_sequences[0]:
+                # Not sent by this pipeline run, no member can be trusted as complete
+                failed_lines[None] = failed_lines.get(None, 0) + 1
+                continue
+            member_name = self.chunk_members[bisect.bisect_right(self.chunk_sequences, sequence) - 1]
+            failed_lines[member_name] = failed_lines.get(member_name, 0) + 1
+        return failed_lines
+
+    def _finish_files(self):
+        # One flush once every file is sent: a member is complete if none of its own events failed
+        self.importer.kafka_client.flush()
+        acknowledged_count = self.importer.kafka_client.get_acknowledged_count()
+        failed_lines = self._get_failed_lines() if self.chunk_sequences else {}
+        for (filename, member_name), line_count, position in self.read_members:
+            summary = self.summaries[member_name]
+            summary['failed_lines'] = failed_lines.get(member_name, 0)
+            if self.importer.checkpoint:
+                is_complete = not summary['failed_lines'] and None not in failed_lines and 'error' not in summary
+                self.importer.checkpoint.finish_member(filename, member_name, line_count, position,
+                                                       acknowledged_count, is_complete)
+            logger.info('Finished {}: {}'.format(member_name, summary))
+        self.read_members = []
+
+    def _run_sender(self):
+        while True:
+            item = self.send_queue.get()
+            if item is None:
+                return
+            source, future, line_count, position = item
+            if line_count is None and future is None:
+                line_count = self.member_lines.pop(source)
+            if future is None:
+                self.read_members.append((source, line_count, position))
+                continue
+            try:
+                filename, valid_rows, row_count = future.result()
+            except Exception as exc:
+                # A failed validator process, or a row it could not return: the member stays incomplete
+                self._add_summary(source[1])['error'] = 'Validation failed'
+                raise StockImportPipelineException('Validation failed: {}; {}'.format(source[1], exc))
+            self._send_chunk(filename, valid_rows, row_count)
+            if line_count is None:
+                self.member_lines[source] += row_count
+                line_count = self.member_lines[source]
+            if self.importer.checkpoint and position is not None:
+                self._add_checkpoint_mark(source, line_count, position)
+
+    def run(self, filenames):
+        self.stop_event.clear()
+        self.file_queue = queue.Queue()
+        self.read_queue = queue.Queue(maxsize=self.queue_size)
+        self.send_queue = queue.Queue(maxsize=self.queue_size)
+        self.summaries = {}
+        self.sent_lines = 0
+        self.next_progress = self.DEFAULT_PROGRESS_INTERVAL
+        self.next_checkpoint = 0
+        self.member_lines = {}
+        self.chunk_sequences = []
+        self.chunk_members = []
+        self.read_members = []
+        checkpoint = self.importer.checkpoint
+        for filename in filenames:
+            if checkpoint and checkpoint.is_done(filename, os.path.join(self.importer.input_dir, filename)):
+                logger.info('Already imported, skipped: {}'.format(filename))
+                self.summaries[filename] = {'skipped': True}
+                continue
+            self.file_queue.put(filename)
+        readers = [threading.Thread(target=self._run_reader, name='stockimporter-reader-{}'.format(index))
+                   for index in range(min(self.reader_count, self.file_queue.qsize()))]
+        for reader in readers:
+            reader.start()
+        # Spawned validators do not inherit the Kafka client threads of the importer
+        with ProcessPoolExecutor(max_workers=self.validator_count,
+                                 mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=init_validator,
+                                 initargs=(self.importer.validator.config,)) as executor:
+            dispatcher = threading.Thread(target=self._run_dispatcher, args=(executor, readers),
+                                          name='stockimporter-dispatcher')
+            dispatcher.start()
+            try:
+                self._run_sender()
+            except StockKafkaClientException as exc:
+                logger.critical(exc)
+                raise StockImportPipelineException('Import stopped! {}'.format(exc))
+            except StockImportPipelineException as exc:
+                logger.critical(exc)
+                raise
+            finally:
+                self.stop_event.set()
+                dispatcher.join()
+                for reader in readers:
+                    reader.join()
+                # Chunks queued behind a failure are not validated for nothing
+                executor.shutdown(cancel_futures=True)
+                self._finish_files()
+        logger.info('Pipeline finished. Sent {} lines.'.format(self.sent_lines))
+        return self.summaries
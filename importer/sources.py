@@ -0,0 +1,55 @@
+import bz2
+import gzip
+import io
+import os
+import zipfile
+
+from tools import logger
+logger = logger.get_logger(__name__)
+
+
+# Errors of a file that cannot be read or decompressed
+READ_ERRORS = (UnicodeDecodeError, OSError, EOFError, zipfile.BadZipFile)
+
+
+class StockImportSource:
+    # Opens a plain or compressed drop as text streams, one per CSV member. Members are decompressed
+    # while they are read, nothing is extracted to memory or disk.
+
+    ZIP_SUFFIX = '.zip'
+    GZIP_SUFFIX = '.gz'
+    BZIP2_SUFFIX = '.bz2'
+    COMPRESSED_SUFFIXES = (ZIP_SUFFIX, GZIP_SUFFIX, BZIP2_SUFFIX)
+
+    def __init__(self, filepath, member_suffix):
+        self.filepath = filepath
+        self.filename = os.path.basename(filepath)
+        self.member_suffix = member_suffix
+
+    @classmethod
+    def is_supported(cls, filename, member_suffix):
+        return filename.endswith(member_suffix) or filename.endswith(cls.COMPRESSED_SUFFIXES)
+
+    def _iter_zip_members(self):
+        with zipfile.ZipFile(self.filepath) as archive:
+            for member in archive.infolist():
+                if member.is_dir() or not member.filename.endswith(self.member_suffix):
+                    logger.debug('Skipped member: {}'.format(member.filename))
+                    continue
+                member_name = '{}/{}'.format(self.filename, member.filename)
+                logger.info('Member: {}; {} bytes'.format(member_name, member.file_size))
+                with io.TextIOWrapper(archive.open(member)) as csv_file:
+                    yield member_name, csv_file
+
+    def iter_members(self):
+        if self.filename.endswith(self.ZIP_SUFFIX):
+            yield from self._iter_zip_members()
+            return
+        if self.filename.endswith(self.GZIP_SUFFIX):
+            open_file = gzip.open
+        elif self.filename.endswith(self.BZIP2_SUFFIX):
+            open_file = bz2.open
+        else:
+            open_file = open
+        with open_file(self.filepath, 'rt') as csv_file:
+            yield self.filename, csv_file
@@ -1,3 +1,5 @@
+import datetime
+import logging
 from dateutil.parser import parse as parse_date
 from uuid import UUID
 
@@ -12,10 +14,20 @@ class StockValidatorException(BaseException):
 class StockRecordValidator:
 
     DEFAULT_RECORD_LINE_LENGTH = 6
+    DEFAULT_DATETIME_FALLBACK = True
+    # Config check names with a typed fast path
+    DEFAULT_CONVERTERS = {'_check_uuid': '_convert_uuid',
+                          '_check_datetime': '_convert_datetime',
+                          '_check_integer': '_convert_integer'}
 
-    def __init__(self, config):
+    def __init__(self, config, datetime_fallback=None):
         self.config = config
         self.line_length = self.DEFAULT_RECORD_LINE_LENGTH
+        self.datetime_fallback = self.DEFAULT_DATETIME_FALLBACK if datetime_fallback is None else datetime_fallback
+        self.checks = {}
+        self.error = None
+        self.unknown_check = self._compile_error('Unknown validation type: "None". Check config!')
+        self._compile()
 
     @staticmethod
     def _check_uuid(uuid_string):
@@ -38,45 +50,109 @@ class StockRecordValidator:
         except ValueError:
             raise StockValidatorException('Not a valid integer: "{}"'.format(int_string))
 
+    @staticmethod
+    def _convert_uuid(uuid_string):
+        try:
+            return UUID(uuid_string)
+        except ValueError:
+            raise StockValidatorException('Not a valid UUID: "{}"'.format(uuid_string))
+
+    def _convert_datetime(self, datetime_string):
+        # Strict fast path for the "%Y-%m-%dT%H:%M:%SZ" format of the incoming files
+        if len(datetime_string) == 20 and datetime_string[10] == 'T' and datetime_string[19] == 'Z':
+            try:
+                return datetime.datetime.fromisoformat(datetime_string[:19])
+            except ValueError:
+                pass
+        if not self.datetime_fallback:
+            raise StockValidatorException('Not a valid datetime string: "{}"'.format(datetime_string))
+        try:
+            parsed_datetime = parse_date(datetime_string)
+        except (ValueError, OverflowError):
+            raise StockValidatorException('Not a valid datetime string: "{}"'.format(datetime_string))
+        if parsed_datetime.tzinfo:
+            parsed_datetime = parsed_datetime.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return parsed_datetime
+
+    @staticmethod
+    def _convert_integer(int_string):
+        try:
+            return int(int_string)
+        except ValueError:
+            raise StockValidatorException('Not a valid integer: "{}"'.format(int_string))
+
+    @staticmethod
+    def _compile_error(message):
+        def _check_error(value):
+            raise StockValidatorException(message)
+        return _check_error
+
+    @staticmethod
+    def _compile_choice(choices):
+        choice_set = frozenset(choices)
+
+        def _check_choice(value):
+            if value.lower() not in choice_set:
+                raise StockValidatorException('"{}" is not a valid choice from: "{}"'.format(value, choices))
+            return value
+        return _check_choice
+
+    @staticmethod
+    def _compile_method(check_method):
+        def _check_method(value):
+            check_method(value)
+            return value
+        return _check_method
+
+    def _compile_check(self, check_type):
+        if isinstance(check_type, list):
+            return self._compile_choice(check_type)
+        if not isinstance(check_type, str):
+            return self._compile_error('Unknown validation type: "{}". Check config!'.format(check_type))
+        if check_type in self.DEFAULT_CONVERTERS:
+            return getattr(self, self.DEFAULT_CONVERTERS[check_type])
+        try:
+            return self._compile_method(getattr(self, check_type))
+        except AttributeError:
+            return self._compile_error('Unknown validation parameter: "{}". Check config!'.format(check_type))
+
+    def _compile(self):
+        self.checks = {column_name: self._compile_check(check_type)
+                       for column_name, check_type in self.config.items()}
+
     def _check_line_length(self, line_length):
         if line_length != self.line_length:
             raise StockValidatorException('Not a proper line length ! Current {}'.format(line_length))
 
-    def validate(self, record_line):
+    def _reject(self, message):
+        self.error = str(message)
+        logger.error(message)
+
+    def convert(self, record_line):
+        # Typed values for the bulk loader. The importer sends the text of the valid rows: the codecs write
+        # the events as text (JSON) or parse them again (binary), and typed rows cost more to pickle between
+        # the pipeline processes.
         try:
             self._check_line_length(len(record_line))
         except StockValidatorException as exc:
-            logger.error(exc)
-            return False
+            self._reject(exc)
+            return None
 
-        is_valid = True
+        is_debug = logger.isEnabledFor(logging.DEBUG)
+        converted_line = {}
         for column_name, value in record_line.items():
             if not value:
-                logger.error('No value for {}'.format(column_name))
-                is_valid = False
-                break
-            check_type = self.config.get(column_name, None)
-            logger.debug('check_type: {}; value: {}'.format(check_type, value))
-            if isinstance(check_type, str):
-                try:
-                    _check_method = getattr(self, check_type)
-                except AttributeError:
-                    logger.error('Unknown validation parameter: "{}". Check config!'.format(check_type))
-                    is_valid = False
-                    break
-                try:
-                    _check_method(value)
-                except StockValidatorException as exc:
-                    logger.error(exc)
-                    is_valid = False
-                    break
-            elif isinstance(check_type, list):
-                if value.lower() not in check_type:
-                    logger.error('"{}" is not a valid choice from: "{}"'.format(value, check_type))
-                    is_valid = False
-                    break
-            else:
-                logger.error('Unknown validation type: "{}". Check config!'.format(check_type))
-                is_valid = False
-                break
-        return is_valid
+                self._reject('No value for {}'.format(column_name))
+                return None
+            if is_debug:
+                logger.debug('check_type: %s; value: %s', self.config.get(column_name, None), value)
+            try:
+                converted_line[column_name] = self.checks.get(column_name, self.unknown_check)(value)
+            except StockValidatorException as exc:
+                self._reject(exc)
+                return None
+        self.error = None
+        return converted_line
+
+    def validate(self, record_line):
+        return self.convert(record_line) is not None
@@ -1,6 +1,10 @@
-import json
+import queue
 from pykafka import KafkaClient
-from pykafka.exceptions import NoBrokersAvailableError
+from pykafka.common import CompressionType
+from pykafka.exceptions import KafkaException, NoBrokersAvailableError
+
+from .codec import StockEventCodec
+from .partitioner import StockPartitioner
 
 
 class StockKafkaClientException(BaseException):
@@ -11,13 +15,32 @@ class StockKafkaClient:
 
     DEFAULT_TOPIC = 'events'
     DEFAULT_KAFKA_HOST = "127.0.0.1:9092"
+    DEFAULT_CONSUMER_GROUP = b'stockservice'
+    DEFAULT_CONSUMER_TIMEOUT_MS = 100
+    DEFAULT_LINGER_MS = 100
+    DEFAULT_BATCH_SIZE = 1000
+    DEFAULT_COMPRESSION = CompressionType.GZIP
 
     def __init__(self):
         self.host = self.DEFAULT_KAFKA_HOST
+        self.consumer_group = self.DEFAULT_CONSUMER_GROUP
+        self.consumer_timeout_ms = self.DEFAULT_CONSUMER_TIMEOUT_MS
         self.client = None
         self.topic = self.DEFAULT_TOPIC
         self.response = None
         self.consumer = None
+        self.producer = None
+        self.linger_ms = self.DEFAULT_LINGER_MS
+        self.batch_size = self.DEFAULT_BATCH_SIZE
+        self.compression = self.DEFAULT_COMPRESSION
+        self.pending_events = {}
+        self.failed_events = []
+        self.sent_count = 0
+        self.first_failed = None
+        # JSON by default; consumers accept both formats
+        self.codec = StockEventCodec()
+        # Keyed by (store_number, item_number) by default, so that the events of an item stay in order
+        self.partitioner = StockPartitioner()
         self._set_host()
 
     def _set_host(self):
@@ -28,17 +51,124 @@ class StockKafkaClient:
 
     @staticmethod
     def _convert_for_sending(event):
-        return bytes(json.dumps(event), encoding='utf-8')
+        return StockEventCodec.encode_json(event)
+
+    def _get_producer(self):
+        if not self.producer:
+            topic = self.client.topics[self.topic]
+            self.producer = topic.get_producer(delivery_reports=True,
+                                               linger_ms=self.linger_ms,
+                                               min_queued_messages=self.batch_size,
+                                               compression=self.compression,
+                                               partitioner=self.partitioner)
+        return self.producer
+
+    def _collect_delivery_reports(self):
+        while self.pending_events:
+            try:
+                message, exc = self.producer.get_delivery_report(block=False)
+            except queue.Empty:
+                break
+            sequence, transaction_id = self.pending_events.pop(id(message), (None, None))
+            if exc is not None:
+                self._add_failure(sequence, transaction_id, exc)
+
+    def _add_failure(self, sequence, transaction_id, exc):
+        self.failed_events.append((sequence, transaction_id, exc))
+        if sequence is not None and (self.first_failed is None or sequence < self.first_failed):
+            self.first_failed = sequence
 
     def send_event(self, event):
         if not self.client:
             raise StockKafkaClientException('No broker available!')
-        topic = self.client.topics[self.topic]
-        with topic.get_producer() as producer:
-            self.response = producer.produce(self._convert_for_sending(event))
+        try:
+            self.response = self._get_producer().produce(self.codec.encode(event),
+                                                         partition_key=self.partitioner.get_partition_key(event))
+        except KafkaException as exc:
+            raise StockKafkaClientException('Cannot send event! {}'.format(exc))
+        self.sent_count += 1
+        self.pending_events[id(self.response)] = (self.sent_count, event.get('transaction_id'))
+        self._collect_delivery_reports()
+
+    def flush(self):
+        if not self.producer:
+            return
+        # Stopping waits until every queued message is delivered or timed out
+        self.producer.stop()
+        self._collect_delivery_reports()
+        for sequence, transaction_id in self.pending_events.values():
+            self._add_failure(sequence, transaction_id, StockKafkaClientException('No delivery report!'))
+        self.pending_events = {}
+        self.producer = None
+
+    def close(self):
+        self.flush()
+
+    def get_delivery_failures(self):
+        return [(transaction_id, exc) for _, transaction_id, exc in self.get_sequenced_delivery_failures()]
+
+    def get_sequenced_delivery_failures(self):
+        # (sequence, transaction_id, exception) of the failed events; the sequence tells which send it was
+        failed_events = self.failed_events
+        self.failed_events = []
+        self.first_failed = None
+        return failed_events
+
+    def get_acknowledged_count(self):
+        # Events are numbered in sending order: every event up to the returned number is delivered
+        if self.producer:
+            self._collect_delivery_reports()
+        acknowledged_count = self.sent_count
+        if self.pending_events:
+            acknowledged_count = min(sequence for sequence, _ in self.pending_events.values()) - 1
+        if self.first_failed is not None:
+            acknowledged_count = min(acknowledged_count, self.first_failed - 1)
+        return acknowledged_count
 
     def get_consumer(self):
         if not self.client:
             raise StockKafkaClientException('No broker available!')
         topic = self.client.topics[self.topic]
-        self.consumer = topic.get_simple_consumer()
+        self.consumer = topic.get_simple_consumer(consumer_group=self.consumer_group,
+                                                  auto_commit_enable=False,
+                                                  consumer_timeout_ms=self.consumer_timeout_ms)
+
+    def get_balanced_consumer(self, post_rebalance_callback=None):
+        # post_rebalance_callback(consumer, old_offsets, new_offsets) may return {partition_id: last_offset}
+        if not self.client:
+            raise StockKafkaClientException('No broker available!')
+        topic = self.client.topics[self.topic]
+        self.consumer = topic.get_balanced_consumer(consumer_group=self.consumer_group,
+                                                    managed=True,
+                                                    auto_commit_enable=False,
+                                                    consumer_timeout_ms=self.consumer_timeout_ms,
+                                                    post_rebalance_callback=post_rebalance_callback)
+
+    def reset_offsets(self, offsets):
+        # offsets: {partition_id: last processed offset}, consuming resumes right after it
+        if not self.consumer:
+            raise StockKafkaClientException('No consumer available!')
+        partitions = self.consumer.partitions
+        partition_offsets = [(partitions[partition_id], last_offset)
+                             for partition_id, last_offset in offsets.items() if partition_id in partitions]
+        if partition_offsets:
+            self.consumer.reset_offsets(partition_offsets=partition_offsets)
+
+    def get_consumer_lag(self):
+        # Messages behind the end of each partition of the consumer, summed
+        if not self.consumer:
+            raise StockKafkaClientException('No consumer available!')
+        try:
+            latest_offsets = self.client.topics[self.topic].latest_available_offsets()
+        except KafkaException as exc:
+            raise StockKafkaClientException('Cannot get the latest offsets! {}'.format(exc))
+        lag = 0
+        for partition_id, held_offset in self.consumer.held_offsets.items():
+            if partition_id in latest_offsets:
+                lag += max(0, latest_offsets[partition_id].offset[0] - max(held_offset, -1) - 1)
+        return lag
+
+    def commit_offsets(self):
+        if not self.consumer:
+            raise StockKafkaClientException('No consumer available!')
+        self.consumer.commit_offsets()
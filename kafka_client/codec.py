@@ -0,0 +1,101 @@
+import datetime
+import json
+import struct
+
+
+class StockEventCodecException(BaseException):
+    pass
+
+
+class StockEventCodec:
+    # Wire formats of the events. Binary messages start with their version byte, JSON ones with "{",
+    # so decoding accepts both. Binary events are decoded with typed values: int numbers and a naive UTC
+    # datetime. Events that do not fit the fixed schema are sent as JSON.
+    #
+    # Version 1, 38 bytes: version (B), transaction id (16s), event type (B), epoch seconds (q),
+    # store number, item number and value (3 x i), big endian.
+
+    JSON_FORMAT = 'json'
+    BINARY_FORMAT = 'binary'
+    WIRE_FORMATS = [JSON_FORMAT, BINARY_FORMAT]
+    DEFAULT_WIRE_FORMAT = JSON_FORMAT
+    BINARY_VERSION = 1
+    BINARY_STRUCT = struct.Struct('>B16sBqiii')
+    EVENT_FIELDS = ['transaction_id', 'event_type', 'date', 'store_number', 'item_number', 'value']
+    EVENT_TYPES = ['incoming', 'sale']
+    DATE_FORMAT_LENGTH = 20
+    UUID_LENGTH = 36
+    EPOCH = datetime.datetime(1970, 1, 1)
+
+    def __init__(self, wire_format=None):
+        self.wire_format = wire_format if wire_format else self.DEFAULT_WIRE_FORMAT
+        if self.wire_format not in self.WIRE_FORMATS:
+            raise StockEventCodecException('Unknown wire format: {}'.format(self.wire_format))
+        self.event_type_codes = {event_type: code for code, event_type in enumerate(self.EVENT_TYPES)}
+
+    @classmethod
+    def _get_uuid_bytes(cls, transaction_id):
+        # bytes.fromhex is several times faster than uuid.UUID for the canonical form
+        transaction_id = str(transaction_id)
+        uuid_hex = transaction_id.replace('-', '')
+        if len(transaction_id) != cls.UUID_LENGTH or len(uuid_hex) != 32:
+            raise ValueError('Not a canonical UUID: {}'.format(transaction_id))
+        return bytes.fromhex(uuid_hex)
+
+    @staticmethod
+    def _get_uuid_string(uuid_bytes):
+        uuid_hex = uuid_bytes.hex()
+        return '{}-{}-{}-{}-{}'.format(uuid_hex[:8], uuid_hex[8:12], uuid_hex[12:16], uuid_hex[16:20], uuid_hex[20:])
+
+    @staticmethod
+    def encode_json(event):
+        return bytes(json.dumps(event), encoding='utf-8')
+
+    def _get_epoch_seconds(self, date):
+        if isinstance(date, datetime.datetime):
+            return (date - self.EPOCH) // datetime.timedelta(seconds=1)
+        # Only the "%Y-%m-%dT%H:%M:%SZ" format of the files, other dates keep their text in JSON
+        if len(date) != self.DATE_FORMAT_LENGTH or date[10] != 'T' or date[19] != 'Z':
+            raise ValueError('Unsupported date format: {}'.format(date))
+        return (datetime.datetime.fromisoformat(date[:19]) - self.EPOCH) // datetime.timedelta(seconds=1)
+
+    def encode_binary(self, event):
+        if list(event.keys()) != self.EVENT_FIELDS:
+            raise ValueError('Event fields are different.')
+        return self.BINARY_STRUCT.pack(self.BINARY_VERSION,
+                                       self._get_uuid_bytes(event['transaction_id']),
+                                       self.event_type_codes[event['event_type']],
+                                       self._get_epoch_seconds(event['date']),
+                                       int(event['store_number']),
+                                       int(event['item_number']),
+                                       int(event['value']))
+
+    def encode(self, event):
+        if self.wire_format == self.BINARY_FORMAT:
+            try:
+                return self.encode_binary(event)
+            except (KeyError, TypeError, ValueError, struct.error):
+                pass
+        return self.encode_json(event)
+
+    def decode_binary(self, value):
+        _, transaction_id, event_type_code, epoch_seconds, store_number, item_number, event_value = \
+            self.BINARY_STRUCT.unpack(value)
+        return {'transaction_id': self._get_uuid_string(transaction_id),
+                'event_type': self.EVENT_TYPES[event_type_code],
+                'date': self.EPOCH + datetime.timedelta(seconds=epoch_seconds),
+                'store_number': store_number,
+                'item_number': item_number,
+                'value': event_value}
+
+    def decode(self, value):
+        # value: message bytes, or text of a JSON message
+        if isinstance(value, (bytes, bytearray)) and value[:1] == bytes([self.BINARY_VERSION]):
+            try:
+                return self.decode_binary(value)
+            except (struct.error, IndexError) as exc:
+                raise StockEventCodecException('Event is not a valid binary event! {}'.format(exc))
+        try:
+            return json.loads(value)
+        except (json.decoder.JSONDecodeError, TypeError, UnicodeDecodeError) as exc:
+            raise StockEventCodecException('Event is not a valid JSON! {}'.format(exc))
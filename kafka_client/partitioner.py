@@ -0,0 +1,60 @@
+import random
+import zlib
+
+
+def _normalize_number(number):
+    # " 12" and "012" are stored as 12 by the service, they get the key of 12
+    try:
+        return int(number)
+    except (TypeError, ValueError):
+        return number
+
+
+def get_item_key(store_number, item_number):
+    return '{}:{}'.format(_normalize_number(store_number), _normalize_number(item_number)).encode('utf-8')
+
+
+def get_key_hash(key):
+    # Stable across processes and hosts, unlike hash(): producers and consumers agree on it
+    return zlib.crc32(key)
+
+
+class StockPartitionerException(BaseException):
+    pass
+
+
+class StockPartitioner:
+    # Partition key of the events and the pykafka partitioner using it. Events of the same key always go
+    # to the same partition, in sending order, as long as the partition count of the topic is unchanged.
+    #
+    # item: (store_number, item_number) key, the unit of ordering of the service
+    # store: store_number key, for consumers that need a whole store in order
+    # random: no key, the former behaviour
+
+    ITEM_STRATEGY = 'item'
+    STORE_STRATEGY = 'store'
+    RANDOM_STRATEGY = 'random'
+    STRATEGIES = [ITEM_STRATEGY, STORE_STRATEGY, RANDOM_STRATEGY]
+    DEFAULT_STRATEGY = ITEM_STRATEGY
+
+    def __init__(self, strategy=None):
+        self.strategy = strategy if strategy else self.DEFAULT_STRATEGY
+        if self.strategy not in self.STRATEGIES:
+            raise StockPartitionerException('Unknown partition strategy: {}'.format(self.strategy))
+
+    def get_partition_key(self, event):
+        try:
+            if self.strategy == self.ITEM_STRATEGY:
+                return get_item_key(event['store_number'], event['item_number'])
+            if self.strategy == self.STORE_STRATEGY:
+                return str(_normalize_number(event['store_number'])).encode('utf-8')
+        except (KeyError, TypeError):
+            pass
+        return None
+
+    def __call__(self, partitions, key):
+        # Called by the pykafka producer; sorted, so that a key maps to the same partition id everywhere
+        partitions = sorted(partitions, key=lambda partition: partition.id)
+        if key is None:
+            return random.choice(partitions)
+        return partitions[get_key_hash(key) % len(partitions)]
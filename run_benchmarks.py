@@ -0,0 +1,61 @@
+import argparse
+import json
+import logging
+import os
+import tempfile
+
+from benchmarks.generator import StockSampleGenerator
+from benchmarks.suite import StockBenchmarkSuite
+from kafka_client.codec import StockEventCodec
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Stock benchmarks: throughput of the validator, importer and service.')
+    parser.add_argument('--size', choices=sorted(StockSampleGenerator.SIZES), default=StockSampleGenerator.DEFAULT_SIZE,
+                        help='Generated rows: small (10k), medium (1M) or large (10M).')
+    parser.add_argument('--rows', type=int, default=None, help='Generated rows, overrides --size.')
+    parser.add_argument('--input', default=None, help='Benchmark this CSV file instead of a generated one.')
+    parser.add_argument('--seed', type=int, default=StockSampleGenerator.DEFAULT_SEED)
+    parser.add_argument('--hot-key-ratio', type=float, default=StockSampleGenerator.DEFAULT_HOT_KEY_RATIO,
+                        help='Share of the (store, item) keys that are hot.')
+    parser.add_argument('--hot-key-share', type=float, default=StockSampleGenerator.DEFAULT_HOT_KEY_SHARE,
+                        help='Share of the events that go to the hot keys.')
+    parser.add_argument('--duplicate-ratio', type=float, default=StockSampleGenerator.DEFAULT_DUPLICATE_RATIO)
+    parser.add_argument('--stale-ratio', type=float, default=StockSampleGenerator.DEFAULT_STALE_RATIO)
+    parser.add_argument('--benchmarks', nargs='+', choices=StockBenchmarkSuite.BENCHMARKS, default=None,
+                        help='Benchmarks to run, all by default.')
+    parser.add_argument('--wire-format', choices=StockEventCodec.WIRE_FORMATS, default=StockEventCodec.DEFAULT_WIRE_FORMAT,
+                        help='Message encoding between the importer and the service.')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON file of the results.')
+    parser.add_argument('--compare', default=None, help='Previous JSON results, to print the rows/s ratios.')
+    parser.add_argument('--keep-logs', action='store_true',
+                        help='Keep the logs. They are disabled by default, so that the code is measured and not the '
+                             'log output.')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = get_arguments()
+    if not arguments.keep_logs:
+        logging.disable(logging.ERROR)
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        generator_settings = None
+        input_path = arguments.input
+        if not input_path:
+            generator = StockSampleGenerator(
+                row_count=arguments.rows if arguments.rows else StockSampleGenerator.SIZES[arguments.size],
+                seed=arguments.seed)
+            generator.hot_key_ratio = arguments.hot_key_ratio
+            generator.hot_key_share = arguments.hot_key_share
+            generator.duplicate_ratio = arguments.duplicate_ratio
+            generator.stale_ratio = arguments.stale_ratio
+            generator_settings = generator.get_settings()
+            input_path = generator.write(os.path.join(temporary_dir, 'benchmark_events.csv'))
+        suite = StockBenchmarkSuite(input_path, generator_settings=generator_settings)
+        suite.wire_format = arguments.wire_format
+        for name, result in suite.run(arguments.benchmarks).items():
+            print('{}: {} rows/s'.format(name, result.get('rows_per_second', result.get('skipped'))))
+        suite.write_report(arguments.output)
+        print('Results: {}'.format(arguments.output))
+        if arguments.compare:
+            print('Against {}: {}'.format(arguments.compare, json.dumps(suite.compare(arguments.compare))))
@@ -0,0 +1,23 @@
+import argparse
+
+from service.bulk import StockBulkLoader
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Stock bulk loader: load the CSV records straight into the database.')
+    parser.add_argument('--input-dir', default=None,
+                        help='Directory of the CSV files. Defaults to the importer input directory.')
+    parser.add_argument('--report', default=None,
+                        help='Write the rejected rows with their reason to this CSV file.')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = get_arguments()
+    loader = StockBulkLoader()
+    if arguments.input_dir:
+        loader.input_dir = arguments.input_dir
+    loader.load()
+    if arguments.report:
+        loader.write_report(arguments.report)
+    loader.database.close()
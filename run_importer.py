@@ -1,4 +1,9 @@
+import argparse
+
+from importer.checkpoint import StockImportCheckpoint
 from importer.importer import StockImporter
+from kafka_client.codec import StockEventCodec
+from kafka_client.partitioner import StockPartitioner
 
 FILENAME_1 = 'csv_all_incoming.csv'
 FILENAME_2 = 'csv_sample_1.csv'
@@ -8,5 +13,43 @@ FILENAME_5 = 'csv_sample_1_mod.csv'
 FILENAME_6 = 'csv_all_incoming.zip'
 FILENAME_7 = 'all_csv_merged.csv'
 
-si = StockImporter()
-si.process_all()
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Stock importer: send the CSV records to Kafka.')
+    parser.add_argument('--pipelined', action='store_true',
+                        help='Read, validate and send the files concurrently, validating in a process pool.')
+    parser.add_argument('--engine', choices=[StockImporter.ROW_ENGINE, StockImporter.COLUMNAR_ENGINE],
+                        default=StockImporter.DEFAULT_ENGINE,
+                        help='Validation engine. The columnar engine validates blocks of rows with NumPy; not '
+                             'available with --pipelined, whose validator processes check row by row.')
+    parser.add_argument('--checkpoint', nargs='?', const=StockImportCheckpoint.DEFAULT_PATH, default=None,
+                        help='Record the delivered lines of every file in this checkpoint file. A restart skips the '
+                             'imported files and resumes the others after their last delivered line.')
+    parser.add_argument('--wire-format', choices=StockEventCodec.WIRE_FORMATS, default=StockEventCodec.DEFAULT_WIRE_FORMAT,
+                        help='Message encoding. The binary format is about 4 times smaller than JSON; the service '
+                             'accepts both.')
+    parser.add_argument('--partitioner', choices=StockPartitioner.STRATEGIES, default=StockPartitioner.DEFAULT_STRATEGY,
+                        help='Partition key of the events: (store, item), store, or none (random partitions). '
+                             'Events of the same key keep their order.')
+    parser.add_argument('--reader', choices=[StockImporter.CSV_READER, StockImporter.MMAP_READER],
+                        default=StockImporter.DEFAULT_READER,
+                        help='Reader of the plain CSV files in pipelined mode. The mmap reader maps the file and splits '
+                             'it in byte ranges across the validators; compressed drops read through csv.')
+    arguments = parser.parse_args()
+    if arguments.reader == StockImporter.MMAP_READER and not arguments.pipelined:
+        parser.error('--reader mmap needs --pipelined.')
+    if arguments.engine == StockImporter.COLUMNAR_ENGINE and arguments.pipelined:
+        parser.error('--engine columnar cannot be used with --pipelined.')
+    return arguments
+
+
+if __name__ == '__main__':
+    arguments = get_arguments()
+    si = StockImporter()
+    si.engine = arguments.engine
+    si.reader = arguments.reader
+    si.kafka_client.codec = StockEventCodec(arguments.wire_format)
+    si.kafka_client.partitioner = StockPartitioner(arguments.partitioner)
+    if arguments.checkpoint:
+        si.checkpoint = StockImportCheckpoint(path=arguments.checkpoint)
+    si.process_all(pipelined=arguments.pipelined)
@@ -1,7 +1,95 @@
+import argparse
+
+from service.async_service import StockAsyncService
+from service.dedup import StockDedupFilter
+from service.reorder import StockReorderBuffer
 from service.service import StockService
+from service.workers import StockServiceWorkerPool
+from tools.metrics import MetricsRegistry
 
 FILENAME_1 = 'csv_all_incoming.csv'
 FILENAME_2 = 'all_csv_merged.csv'
 
-service = StockService()
-service.get_events()
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Stock service: process the events from Kafka.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes. With more than 1, the service joins a balanced '
+                             'consumer group and routes each (store, item) to a fixed worker.')
+    parser.add_argument('--batch-size', type=int, default=StockService.DEFAULT_BATCH_SIZE,
+                        help='Maximum number of events applied in one transaction.')
+    parser.add_argument('--cache-size', type=int, default=StockService.DEFAULT_CACHE_SIZE,
+                        help='Number of stock rows kept in memory per service or worker. 0 disables the cache.')
+    parser.add_argument('--dedup-capacity', type=int, default=None,
+                        help='Transaction ids held by the dedup bloom filter. Sized from the seeded events by '
+                             'default. Not used with --asyncio, its inserts reject the duplicates.')
+    parser.add_argument('--dedup-days', type=int, default=StockDedupFilter.DEFAULT_SEED_DAYS,
+                        help='Days of stored events seeded into the dedup filter at startup.')
+    parser.add_argument('--asyncio', action='store_true',
+                        help='Process the events on an asyncio event loop, with concurrent database calls.')
+    parser.add_argument('--in-flight', type=int, default=StockAsyncService.DEFAULT_MAX_IN_FLIGHT,
+                        help='Maximum number of events processed concurrently in asyncio mode.')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='Serve the metrics on http://127.0.0.1:<port>/metrics. Disabled by default. With '
+                             '--workers, the worker metrics are added up as of their last offset commit.')
+    parser.add_argument('--metrics-interval', type=int, default=MetricsRegistry.DEFAULT_SUMMARY_INTERVAL_S,
+                        help='Seconds between two metrics summaries in the log.')
+    parser.add_argument('--snapshot-port', type=int, default=None,
+                        help='Serve the stock from memory on http://127.0.0.1:<port>/stock, /stock/<store>, '
+                             '/stock/<store>/<item> and /items/<item>. Not available with --workers.')
+    parser.add_argument('--reorder-window', type=int, default=None,
+                        help='Hold the events up to this many seconds of event time, and apply them sorted by date '
+                             'per item. Disabled by default, not available with --workers or --asyncio.')
+    parser.add_argument('--reorder-max-delay', type=int, default=StockReorderBuffer.DEFAULT_MAX_DELAY_S,
+                        help='Seconds (wall clock) an item is held at most by the reorder buffer.')
+    parser.add_argument('--reorder-max-events', type=int, default=StockReorderBuffer.DEFAULT_MAX_EVENTS,
+                        help='Events held at most by the reorder buffer.')
+    parser.add_argument('--compact', action='store_true',
+                        help='Fold the events of a batch per item: one stock write per item and batch instead of '
+                             'one per event. Not available with --asyncio.')
+    arguments = parser.parse_args()
+    if arguments.asyncio and arguments.workers > 1:
+        parser.error('--asyncio cannot be combined with --workers.')
+    if arguments.snapshot_port and arguments.workers > 1:
+        parser.error('--snapshot-port cannot be combined with --workers.')
+    if arguments.reorder_window is not None and (arguments.workers > 1 or arguments.asyncio):
+        parser.error('--reorder-window cannot be combined with --workers or --asyncio.')
+    if arguments.compact and arguments.asyncio:
+        parser.error('--compact cannot be combined with --asyncio.')
+    return arguments
+
+
+if __name__ == '__main__':
+    arguments = get_arguments()
+    if arguments.workers > 1:
+        worker_pool = StockServiceWorkerPool(worker_count=arguments.workers)
+        worker_pool.batch_size = arguments.batch_size
+        worker_pool.cache_size = arguments.cache_size
+        worker_pool.dedup_capacity = arguments.dedup_capacity
+        worker_pool.dedup_seed_days = arguments.dedup_days
+        worker_pool.compaction = arguments.compact
+        worker_pool.metrics_port = arguments.metrics_port
+        worker_pool.metrics_summary_interval_s = arguments.metrics_interval
+        worker_pool.run()
+    elif arguments.asyncio:
+        service = StockAsyncService()
+        service.max_in_flight = arguments.in_flight
+        service.cache.max_size = arguments.cache_size
+        service.metrics_port = arguments.metrics_port
+        service.metrics_summary_interval_s = arguments.metrics_interval
+        service.snapshot_port = arguments.snapshot_port
+        service.get_events()
+    else:
+        service = StockService()
+        service.batch_size = arguments.batch_size
+        service.cache.max_size = arguments.cache_size
+        service.dedup = StockDedupFilter(capacity=arguments.dedup_capacity, seed_days=arguments.dedup_days)
+        service.compaction = arguments.compact
+        service.metrics_port = arguments.metrics_port
+        service.metrics_summary_interval_s = arguments.metrics_interval
+        service.snapshot_port = arguments.snapshot_port
+        if arguments.reorder_window is not None:
+            service.reorder = StockReorderBuffer(window_s=arguments.reorder_window,
+                                                 max_delay_s=arguments.reorder_max_delay,
+                                                 max_events=arguments.reorder_max_events)
+        service.get_events()
@@ -1,4 +1,9 @@
+import argparse
+import datetime
 import logging
+import os
+import re
+
 import psycopg2
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 
@@ -26,12 +31,18 @@ class InitStockDB:
     DEFAULT_TABLES = {
         'events':
             {
-                'transaction_id': 'uuid PRIMARY KEY',
+                'transaction_id': 'uuid NOT NULL',  # primary: transaction id and date (the partition key)
                 'event_type': 'VARCHAR',
-                'date': 'TIMESTAMP',
+                'date': 'TIMESTAMP NOT NULL',
+                'PRIMARY KEY': '(transaction_id, date)',
                 'store_number': 'INTEGER',
                 'item_number': 'INTEGER',
-                'value': 'INTEGER'
+                'value': 'INTEGER',
+                'inserted_at': 'TIMESTAMP NOT NULL DEFAULT now()'  # when stored, whatever the event date
+            },
+        'event_ids':
+            {
+                'transaction_id': 'uuid PRIMARY KEY'  # one row per event, whatever its date
             },
         'stock':
             {
@@ -40,13 +51,55 @@ class InitStockDB:
                 'PRIMARY KEY': '(item_number, store_number)',
                 'current_value': 'INTEGER',
                 'last_update': 'TIMESTAMP'
+            },
+        'consumer_offsets':
+            {
+                'consumer_group': 'VARCHAR NOT NULL',  # primary: group, topic and partition
+                'topic': 'VARCHAR NOT NULL',
+                'partition_id': 'INTEGER NOT NULL',
+                'PRIMARY KEY': '(consumer_group, topic, partition_id)',
+                'last_offset': 'BIGINT'
             }
     }
+    # Tables range partitioned by month, on the given column. Every month has its own partition, rows out of the
+    # created months go to the default partition.
+    DEFAULT_PARTITIONED_TABLES = {
+        'events': 'date'
+    }
+    # The primary key of a partitioned table has to hold the partition column, so the transaction ids are kept
+    # unique in a table of their own, written with every event. Filled from the events when created.
+    DEFAULT_ID_TABLES = {
+        'event_ids': ('events', 'transaction_id')
+    }
+    DEFAULT_INDEXES = {
+        'events_store_item_date_idx': ('events', '(store_number, item_number, date)'),
+        'events_inserted_at_idx': ('events', '(inserted_at)')
+    }
+    DEFAULT_PARTITION_MONTHS_AHEAD = 3
+    DEFAULT_PARTITION_SUFFIX = 'default'
+    PARTITION_MONTH_FORMAT = '%Y_%m'
 
     def __init__(self):
         self.db_conn = None
         self.cursor = None
         self.db_config = self.DEFAULT_DB_CONFIG
+        self.partitions_from = None
+        self.months_ahead = self.DEFAULT_PARTITION_MONTHS_AHEAD
+
+    @staticmethod
+    def _get_month(date):
+        return datetime.date(date.year, date.month, 1)
+
+    @staticmethod
+    def _add_months(month, count):
+        month_index = month.year * 12 + month.month - 1 + count
+        return datetime.date(month_index // 12, month_index % 12 + 1, 1)
+
+    def _get_partition_name(self, table_name, month):
+        return '{}_{}'.format(table_name, month.strftime(self.PARTITION_MONTH_FORMAT))
+
+    def _get_default_partition_name(self, table_name):
+        return '{}_{}'.format(table_name, self.DEFAULT_PARTITION_SUFFIX)
 
     def create_db(self):
         main_connection = {
@@ -60,22 +113,127 @@ class InitStockDB:
         main_db.close()
 
     def create_tables(self):
+        created_tables = []
         for table_name, columns in self.DEFAULT_TABLES.items():
             table_sql = 'CREATE TABLE {} ('.format(table_name)
             column_sql = []
             for column_name, column_type in columns.items():
                 column_sql.append('{} {}'.format(column_name, column_type))
             table_sql += ', '.join(column_sql)
-            table_sql += ');'
+            table_sql += ')'
+            if table_name in self.DEFAULT_PARTITIONED_TABLES:
+                table_sql += ' PARTITION BY RANGE ({})'.format(self.DEFAULT_PARTITIONED_TABLES[table_name])
+            table_sql += ';'
             logger.info(table_sql)
             try:
                 self.cursor.execute(table_sql)
+                # Committed one by one: the rollback of an existing table would drop the tables created before
+                self.db_conn.commit()
+                created_tables.append(table_name)
             except psycopg2.errors.DuplicateTable:
                 logger.warning('Table "{}" already exists'.format(table_name))
                 self.db_conn.rollback()
         self.db_conn.commit()
+        for table_name in created_tables:
+            if table_name in self.DEFAULT_ID_TABLES:
+                self.fill_id_table(table_name)
+        self.create_indexes()
+        for table_name in self.DEFAULT_PARTITIONED_TABLES:
+            self.create_partitions(table_name, start=self.partitions_from)
 
-    def initialize(self):
+    def fill_id_table(self, table_name):
+        source_table, id_column = self.DEFAULT_ID_TABLES[table_name]
+        self.cursor.execute('INSERT INTO {table} ({column}) SELECT {column} FROM {source} ON CONFLICT DO NOTHING;'.format(
+            table=table_name, column=id_column, source=source_table))
+        filled_count = self.cursor.rowcount
+        self.db_conn.commit()
+        logger.info('Table "{}" filled with {} ids of "{}"'.format(table_name, filled_count, source_table))
+
+    def create_indexes(self):
+        # Indexes of a partitioned table are created on every partition, also on the later ones
+        for index_name, (table_name, columns) in self.DEFAULT_INDEXES.items():
+            self.cursor.execute('CREATE INDEX IF NOT EXISTS {} ON {} {};'.format(index_name, table_name, columns))
+        self.db_conn.commit()
+
+    def get_partitions(self, table_name):
+        # {first day of the month: partition name} of the monthly partitions
+        self.cursor.execute(
+            'SELECT partition.relname FROM pg_inherits '
+            'JOIN pg_class AS partition ON partition.oid = pg_inherits.inhrelid '
+            'JOIN pg_class AS parent ON parent.oid = pg_inherits.inhparent '
+            'WHERE parent.relname = %s;', (table_name,))
+        month_pattern = re.compile(r'^{}_(\d{{4}}_\d{{2}})$'.format(re.escape(table_name)))
+        partitions = {}
+        for partition_name, in self.cursor.fetchall():
+            match = month_pattern.match(partition_name)
+            if match:
+                month = datetime.datetime.strptime(match.group(1), self.PARTITION_MONTH_FORMAT).date()
+                partitions[month] = partition_name
+        return partitions
+
+    def create_partition(self, table_name, month):
+        partition_name = self._get_partition_name(table_name, month)
+        default_name = self._get_default_partition_name(table_name)
+        partition_column = self.DEFAULT_PARTITIONED_TABLES[table_name]
+        bounds = (month, self._add_months(month, 1))
+        # Rows of the month already in the default partition would block the attach, so they are moved first
+        self.cursor.execute('CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING CONSTRAINTS);'.format(
+            partition_name, table_name))
+        self.cursor.execute(
+            'WITH moved AS (DELETE FROM {default} WHERE {column} >= %s AND {column} < %s RETURNING *) '
+            'INSERT INTO {partition} SELECT * FROM moved;'.format(
+                default=default_name, column=partition_column, partition=partition_name), bounds)
+        moved_count = self.cursor.rowcount
+        self.cursor.execute('ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM (%s) TO (%s);'.format(
+            table_name, partition_name), bounds)
+        self.db_conn.commit()
+        logger.info('Partition "{}" created, {} rows moved from "{}"'.format(partition_name, moved_count, default_name))
+
+    def is_partitioned(self, table_name):
+        self.cursor.execute('SELECT 1 FROM pg_partitioned_table JOIN pg_class ON pg_class.oid = partrelid '
+                            'WHERE relname = %s;', (table_name,))
+        return self.cursor.fetchone() is not None
+
+    def create_partitions(self, table_name, start=None, end=None):
+        # Monthly partitions from start (default: this month) to end (default: months_ahead months from now)
+        if not self.is_partitioned(table_name):
+            # Tables created before the partitioning are kept as they are, they need a dump and reload
+            logger.warning('Table "{}" is not partitioned, no partitions created'.format(table_name))
+            return
+        self.cursor.execute('CREATE TABLE IF NOT EXISTS {} PARTITION OF {} DEFAULT;'.format(
+            self._get_default_partition_name(table_name), table_name))
+        self.db_conn.commit()
+        this_month = self._get_month(datetime.date.today())
+        month = self._get_month(start) if start else this_month
+        end = self._get_month(end) if end else self._add_months(this_month, self.months_ahead)
+        partitions = self.get_partitions(table_name)
+        while month <= end:
+            if month not in partitions:
+                self.create_partition(table_name, month)
+            month = self._add_months(month, 1)
+
+    def drop_partitions(self, table_name, before, export_dir=None):
+        # Drops the monthly partitions entirely before the given month, optionally exported to CSV files
+        # first. Rows of the default partition are kept, and so are the ids: an archived event sent again is
+        # still a duplicate.
+        before = self._get_month(before)
+        dropped = []
+        for month, partition_name in sorted(self.get_partitions(table_name).items()):
+            if month >= before:
+                continue
+            if export_dir:
+                export_path = os.path.join(export_dir, '{}.csv'.format(partition_name))
+                with open(export_path, 'w') as export_file:
+                    self.cursor.copy_expert('COPY {} TO STDOUT WITH CSV HEADER;'.format(partition_name), export_file)
+                logger.info('Partition "{}" exported to {}'.format(partition_name, export_path))
+            self.cursor.execute('ALTER TABLE {} DETACH PARTITION {};'.format(table_name, partition_name))
+            self.cursor.execute('DROP TABLE {};'.format(partition_name))
+            self.db_conn.commit()
+            logger.info('Partition "{}" dropped'.format(partition_name))
+            dropped.append(partition_name)
+        return dropped
+
+    def connect(self):
         connection_params = {**self.db_config}
         try:
             self.db_conn = psycopg2.connect(**connection_params)
@@ -84,10 +242,47 @@ class InitStockDB:
             self.db_conn = psycopg2.connect(**connection_params)
         logger.debug(self.db_conn.info)
         self.cursor = self.db_conn.cursor()
+
+    def initialize(self):
+        self.connect()
         self.create_tables()
         self.db_conn.close()
 
+    def archive(self, before, export_dir=None):
+        self.connect()
+        for table_name in self.DEFAULT_PARTITIONED_TABLES:
+            self.drop_partitions(table_name, before, export_dir=export_dir)
+        self.db_conn.close()
+
+
+def get_month_argument(value):
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m').date()
+    except ValueError:
+        raise argparse.ArgumentTypeError('Not a YYYY-MM month: {}'.format(value))
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(
+        description='Creates the stock database, its tables and the monthly event partitions. Safe to rerun, '
+                    'e.g. daily, to create the partitions of the coming months.')
+    parser.add_argument('--partitions-from', type=get_month_argument, default=None,
+                        help='First month (YYYY-MM) of the partitions, this month by default. Rows of these months '
+                             'are moved out of the default partition.')
+    parser.add_argument('--months-ahead', type=int, default=InitStockDB.DEFAULT_PARTITION_MONTHS_AHEAD,
+                        help='Partitions created ahead of this month.')
+    parser.add_argument('--drop-before', type=get_month_argument, default=None,
+                        help='Drops the event partitions before this month (YYYY-MM).')
+    parser.add_argument('--export-dir', default=None,
+                        help='Exports the dropped partitions into CSV files of this directory first.')
+    return parser.parse_args()
+
 
 if __name__ == '__main__':
+    arguments = get_arguments()
     init_db = InitStockDB()
+    init_db.partitions_from = arguments.partitions_from
+    init_db.months_ahead = arguments.months_ahead
     init_db.initialize()
+    if arguments.drop_before:
+        init_db.archive(arguments.drop_before, export_dir=arguments.export_dir)
@@ -0,0 +1,164 @@
+import asyncio
+import signal
+
+from kafka_client.client import StockKafkaClient, StockKafkaClientException
+from database.async_database import StockServiceAsyncDB
+from .offsets import StockOffsetStore
+from .service import StockService, StockServiceException
+
+from tools import logger
+event_logger = logger.get_sampled_logger(__name__)
+logger = logger.get_logger(__name__)
+
+
+class StockAsyncService(StockService):
+    # Same checks and stock rules as StockService, on an asyncio event loop. Events of the same
+    # (item_number, store_number) are chained one after the other, other items run concurrently.
+
+    DEFAULT_MAX_IN_FLIGHT = 100
+    DEFAULT_COMMIT_INTERVAL = 5000
+
+    def __init__(self, database=None, kafka_client=None):
+        super().__init__(database=database if database else StockServiceAsyncDB(), kafka_client=kafka_client)
+        self.max_in_flight = self.DEFAULT_MAX_IN_FLIGHT
+        self.commit_interval = self.DEFAULT_COMMIT_INTERVAL
+        self.insert_event_sql = self._get_event_insert_sql()
+        self.in_flight = None
+        self.item_tasks = {}
+        self.tasks = set()
+        self.errors = []
+        self.pending_events = 0
+        self.offsets = {}
+        self.is_running = False
+
+    async def _start(self):
+        await self.database.open()
+        self.offset_store = StockOffsetStore(self.database, self.kafka_client.consumer_group, self.kafka_client.topic)
+        rows, _ = await self.database.execute(self.offset_store.load_sql, self.offset_store.get_load_values())
+        logger.info('Stored offsets: {}'.format(dict(rows)))
+        self.kafka_client.reset_offsets(dict(rows))
+        self.in_flight = asyncio.Semaphore(self.max_in_flight)
+        rows, _ = await self.database.execute(
+            'SELECT item_number, store_number, current_value, last_update FROM {};'.format(self.table_stock))
+        for item_number, store_number, current_value, last_update in rows:
+            self.cache.put((item_number, store_number), (current_value, last_update))
+        logger.info('Stock cache warmed: {} items.'.format(len(self.cache)))
+        self.start_snapshot(rows)
+
+    async def _process_item_event(self, previous_task, event, item_key):
+        try:
+            if previous_task:
+                # A failed event stops the rest of its item, as a rolled back batch would
+                await previous_task
+            # The event and its stock change are committed together: a failed upsert drops the event too,
+            # so its replay is not rejected as a duplicate
+            rows = None
+            async with self.database.transaction() as transaction:
+                with self.metrics.timer('transaction_insert'):
+                    _, rowcount = await transaction.execute(self.insert_event_sql, event)
+                if not rowcount:
+                    event_logger.warning('Insert failed! Duplicate key: %s', event['transaction_id'])
+                    self.metrics.counter('events_duplicate').inc()
+                    return
+                # The shared helpers read self.event, they are called without awaiting in between
+                self.event = event
+                with self.metrics.timer('cache_check'):
+                    reason = self._check_cached_item(item_key) if item_key else None
+                if not reason:
+                    with self.metrics.timer('stock_upsert'):
+                        rows, _ = await transaction.execute(self.STOCK_UPSERT_SQL.format(table=self.table_stock),
+                                                            self._get_upsert_values())
+            if rows:
+                current_value, last_update, reason = rows[0]
+                self._cache_upsert_result(item_key, current_value, last_update)
+            self.event = event
+            self._log_upsert_reason(reason)
+        finally:
+            self.in_flight.release()
+            if self.item_tasks.get(item_key) is asyncio.current_task():
+                del self.item_tasks[item_key]
+
+    def _task_done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            self.errors.append(task.exception())
+
+    def _check_errors(self):
+        if self.errors:
+            raise StockServiceException('Event processing failed! Offsets are not committed. {}'.format(
+                self.errors[0]))
+
+    async def dispatch(self, event):
+        self._check_errors()
+        await self.in_flight.acquire()
+        self.event = event
+        if not self._parse_event():
+            self.in_flight.release()
+            return
+        item_key = self._get_item_key()
+        task = asyncio.get_running_loop().create_task(
+            self._process_item_event(self.item_tasks.get(item_key), self.event, item_key))
+        self.item_tasks[item_key] = task
+        self.tasks.add(task)
+        task.add_done_callback(self._task_done)
+        self.pending_events += 1
+        self.metrics.counter('events').inc()
+
+    async def _drain(self):
+        if self.tasks:
+            await asyncio.wait(list(self.tasks))
+        self._check_errors()
+
+    async def _commit_offsets(self):
+        await self._drain()
+        # Events are committed one by one, each with its stock change, and the offsets after them: the engine
+        # is at-least-once. A crash before the offsets are stored replays events whose ids are already stored,
+        # they are rejected as duplicates without touching the stock.
+        async with self.database.transaction() as transaction:
+            for store_values in self.offset_store.get_store_values(self.offsets):
+                await transaction.execute(self.offset_store.store_sql, store_values)
+        await asyncio.get_running_loop().run_in_executor(None, self.kafka_client.commit_offsets)
+        self.pending_events = 0
+        logger.debug('Offsets committed.')
+
+    def stop(self, *args):
+        self.is_running = False
+
+    async def get_events_async(self):
+        if not self.kafka_client:
+            self.kafka_client = StockKafkaClient()
+        try:
+            self.kafka_client.get_consumer()
+        except StockKafkaClientException as exc:
+            logger.critical(exc)
+            return
+        await self._start()
+        self.start_metrics()
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGINT, self.stop)
+        loop.add_signal_handler(signal.SIGTERM, self.stop)
+        self.is_running = True
+        try:
+            while self.is_running:
+                # pykafka is blocking, batches are consumed in the default executor
+                messages = await loop.run_in_executor(None, self._get_batch)
+                await loop.run_in_executor(None, self._update_consumer_lag)
+                for message in messages:
+                    await self.dispatch(message.value)
+                    self.offsets[message.partition_id] = message.offset
+                if self.pending_events >= self.commit_interval or (not messages and self.pending_events):
+                    await self._commit_offsets()
+            await self._commit_offsets()
+        finally:
+            for task in list(self.tasks):
+                task.cancel()
+            if self.tasks:
+                await asyncio.wait(list(self.tasks))
+            self.database.close()
+            self.metrics.stop()
+            if self.snapshot:
+                self.snapshot.stop()
+        logger.info('Async service stopped. Updated items: {}'.format(self.updated_item_count))
+
+    def get_events(self):
+        asyncio.run(self.get_events_async())
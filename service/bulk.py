@@ -0,0 +1,215 @@
+import csv
+import io
+import os
+
+from database.database import StockServiceDB
+from importer.importer import StockImporter
+from importer.validator import StockRecordValidator
+from .service import StockService
+
+from tools import logger
+logger = logger.get_logger(__name__)
+
+
+class StockBulkLoaderException(BaseException):
+    pass
+
+
+class StockBulkLoader:
+
+    DEFAULT_COPY_CHUNK_SIZE = 100000
+    DEFAULT_STAGING_EVENTS_TABLE = 'staging_events'
+    DEFAULT_STAGING_STOCK_TABLE = 'staging_stock'
+    REASON_INVALID = 'invalid'
+    REASON_DUPLICATE = 'duplicate'
+    STAGING_FIELDS = ['seq',
+                      'transaction_id',
+                      'event_type',
+                      'date',
+                      'store_number',
+                      'item_number',
+                      'value',
+                      'source_file',
+                      'source_line']
+
+    def __init__(self, database=None):
+        self.database = database if database else StockServiceDB()
+        self.input_dir = StockImporter.DEFAULT_INPUT_DIR
+        self.file_suffix = StockImporter.DEFAULT_FILE_SUFFIX
+        self.delimiter = StockImporter.DEFAULT_DELIMITER
+        self.validator = StockRecordValidator(config=StockImporter.DEFAULT_VALIDATOR_CONFIG)
+        self.table_events = StockService.DEFAULT_EVENTS_TABLE
+        self.table_event_ids = StockService.DEFAULT_EVENT_IDS_TABLE
+        self.table_stock = StockService.DEFAULT_STOCK_TABLE
+        self.table_staging_events = self.DEFAULT_STAGING_EVENTS_TABLE
+        self.table_staging_stock = self.DEFAULT_STAGING_STOCK_TABLE
+        self.copy_chunk_size = self.DEFAULT_COPY_CHUNK_SIZE
+        self.sequence = 0
+        self.rejected = []
+        self.report = {}
+
+    def _reject(self, source_file, source_line, transaction_id, reason, message=None):
+        self.rejected.append((source_file, source_line, transaction_id, reason, message))
+        self.report[reason] = self.report.get(reason, 0) + 1
+
+    def _create_staging_tables(self):
+        self.database.cursor.execute(
+            'CREATE TEMP TABLE {} (seq BIGINT PRIMARY KEY, transaction_id uuid, event_type VARCHAR, date TIMESTAMP, '
+            'store_number INTEGER, item_number INTEGER, value INTEGER, source_file VARCHAR, source_line INTEGER) '
+            'ON COMMIT DROP;'.format(self.table_staging_events))
+        self.database.cursor.execute(
+            'CREATE TEMP TABLE {} (item_number INTEGER, store_number INTEGER, current_value INTEGER, '
+            'last_update TIMESTAMP, is_stored BOOLEAN) ON COMMIT DROP;'.format(self.table_staging_stock))
+
+    def _copy(self, table, fields, buffer):
+        buffer.seek(0)
+        self.database.cursor.copy_expert('COPY {} ({}) FROM STDIN WITH (FORMAT csv);'.format(table, ', '.join(fields)),
+                                         buffer)
+
+    def _stage_file(self, filename):
+        filepath = os.path.join(self.input_dir, filename)
+        logger.info('Staging: {}'.format(filepath))
+        buffer = io.StringIO()
+        csv_writer = csv.writer(buffer)
+        buffered_rows = 0
+        with open(filepath, 'r') as csv_file:
+            csv_reader = csv.DictReader(csv_file, delimiter=self.delimiter)
+            while True:
+                try:
+                    record_line = next(csv_reader)
+                except StopIteration:
+                    break
+                except UnicodeDecodeError:
+                    raise StockBulkLoaderException('Cannot process file: {}'.format(filepath))
+                converted_line = self.validator.convert(record_line)
+                if converted_line is None:
+                    self._reject(filename, csv_reader.line_num, record_line.get('transaction_id'),
+                                 self.REASON_INVALID, self.validator.error)
+                    continue
+                self.sequence += 1
+                # The raw event type is kept, as the streaming path compares it as sent
+                csv_writer.writerow([self.sequence,
+                                     converted_line['transaction_id'],
+                                     record_line['event_type'],
+                                     converted_line['date'].isoformat(),
+                                     converted_line['store_number'],
+                                     converted_line['item_number'],
+                                     converted_line['value'],
+                                     filename,
+                                     csv_reader.line_num])
+                buffered_rows += 1
+                if buffered_rows >= self.copy_chunk_size:
+                    self._copy(self.table_staging_events, self.STAGING_FIELDS, buffer)
+                    buffer = io.StringIO()
+                    csv_writer = csv.writer(buffer)
+                    buffered_rows = 0
+        if buffered_rows:
+            self._copy(self.table_staging_events, self.STAGING_FIELDS, buffer)
+
+    def _remove_duplicates(self):
+        self.database.cursor.execute(
+            'DELETE FROM {staging} AS staged USING {staging} AS first_staged '
+            'WHERE staged.transaction_id = first_staged.transaction_id AND staged.seq > first_staged.seq '
+            'RETURNING staged.source_file, staged.source_line, staged.transaction_id;'.format(
+                staging=self.table_staging_events))
+        duplicates = self.database.cursor.fetchall()
+        self.database.cursor.execute(
+            'DELETE FROM {staging} AS staged USING {event_ids} AS event_ids '
+            'WHERE staged.transaction_id = event_ids.transaction_id '
+            'RETURNING staged.source_file, staged.source_line, staged.transaction_id;'.format(
+                staging=self.table_staging_events, event_ids=self.table_event_ids))
+        duplicates += self.database.cursor.fetchall()
+        for source_file, source_line, transaction_id in duplicates:
+            self._reject(source_file, source_line, transaction_id, self.REASON_DUPLICATE)
+
+    def _insert_events(self):
+        # An id stored by the service since the duplicate check fails the load, it is rolled back as a whole
+        self.database.cursor.execute(
+            'INSERT INTO {event_ids} (transaction_id) SELECT transaction_id FROM {staging};'.format(
+                event_ids=self.table_event_ids, staging=self.table_staging_events))
+        self.database.cursor.execute(
+            'INSERT INTO {events} (transaction_id, event_type, date, store_number, item_number, value) '
+            'SELECT transaction_id, event_type, date, store_number, item_number, value FROM {staging} '
+            'ORDER BY seq;'.format(events=self.table_events, staging=self.table_staging_events))
+        self.report['loaded'] = self.database.cursor.rowcount
+
+    def _apply_stock(self):
+        # The rules are sequential per item (stale dates, no negative stock), so the staged events are folded
+        # in arrival order, as the streaming path would apply them, and the final rows are written set-based.
+        # The stored items are locked in key order until the commit, their folded values cannot overwrite a
+        # write of the service.
+        item_states = {}
+        for item_number, store_number, current_value, last_update in self.database.stream(
+                'SELECT item_number, store_number, current_value, last_update FROM {stock} '
+                'WHERE (item_number, store_number) IN (SELECT item_number, store_number FROM {staging}) '
+                'ORDER BY item_number, store_number FOR UPDATE;'.format(
+                    stock=self.table_stock, staging=self.table_staging_events)):
+            item_states[(item_number, store_number)] = (current_value, last_update)
+        stored_items = set(item_states)
+        changed_items = set()
+        applied_count = 0
+        for transaction_id, event_type, date, store_number, item_number, value, source_file, source_line in \
+                self.database.stream('SELECT transaction_id, event_type, date, store_number, item_number, value, '
+                                     'source_file, source_line FROM {} ORDER BY seq;'.format(self.table_staging_events)):
+            item_key = (item_number, store_number)
+            item_state, reason = StockService.apply_stock_rules(item_states.get(item_key), event_type, date, value)
+            if reason != StockService.REASON_APPLIED:
+                self._reject(source_file, source_line, transaction_id, reason)
+                continue
+            item_states[item_key] = item_state
+            changed_items.add(item_key)
+            applied_count += 1
+        buffer = io.StringIO()
+        csv_writer = csv.writer(buffer)
+        for item_number, store_number in changed_items:
+            current_value, last_update = item_states[(item_number, store_number)]
+            csv_writer.writerow([item_number, store_number, current_value, last_update.isoformat(),
+                                 (item_number, store_number) in stored_items])
+        self._copy(self.table_staging_stock, ['item_number', 'store_number', 'current_value', 'last_update',
+                                              'is_stored'], buffer)
+        self.database.cursor.execute(
+            'UPDATE {stock} AS stock SET current_value = staged.current_value, last_update = staged.last_update '
+            'FROM {staging} AS staged WHERE staged.is_stored '
+            'AND stock.item_number = staged.item_number AND stock.store_number = staged.store_number;'.format(
+                stock=self.table_stock, staging=self.table_staging_stock))
+        # New items cannot be locked: one created by another writer since the read fails the load
+        self.database.cursor.execute(
+            'INSERT INTO {stock} (item_number, store_number, current_value, last_update) '
+            'SELECT item_number, store_number, current_value, last_update FROM {staging} WHERE NOT is_stored '
+            'ON CONFLICT (item_number, store_number) DO NOTHING '
+            'RETURNING item_number, store_number;'.format(stock=self.table_stock, staging=self.table_staging_stock))
+        conflicting_items = changed_items - stored_items - set(self.database.cursor.fetchall())
+        if conflicting_items:
+            raise StockBulkLoaderException('Items created during the load, retry it: {}'.format(
+                sorted(conflicting_items)))
+        self.report[StockService.REASON_APPLIED] = applied_count
+        self.report['updated_items'] = len(changed_items)
+
+    def get_files(self):
+        filenames = os.listdir(self.input_dir)
+        return [filename for filename in filenames if filename.endswith(self.file_suffix)]
+
+    def load(self, filenames=None):
+        self.sequence = 0
+        self.rejected = []
+        self.report = {}
+        try:
+            self._create_staging_tables()
+            for filename in filenames if filenames else self.get_files():
+                self._stage_file(filename)
+            self._remove_duplicates()
+            self._insert_events()
+            self._apply_stock()
+            self.database.commit()
+        except BaseException:
+            self.database.rollback()
+            raise
+        self.report['rejected'] = len(self.rejected)
+        logger.info('Bulk load finished: {}'.format(self.report))
+        return self.report
+
+    def write_report(self, report_path):
+        with open(report_path, 'w') as report_file:
+            csv_writer = csv.writer(report_file)
+            csv_writer.writerow(['source_file', 'source_line', 'transaction_id', 'reason', 'message'])
+            csv_writer.writerows(self.rejected)
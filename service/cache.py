@@ -0,0 +1,66 @@
+from collections import OrderedDict
+
+from tools import logger
+logger = logger.get_logger(__name__)
+
+
+class StockStateCache:
+    # Bounded LRU of stock rows: (item_number, store_number) -> (current_value, last_update)
+
+    DEFAULT_MAX_SIZE = 100000
+
+    def __init__(self, max_size=None):
+        self.max_size = self.DEFAULT_MAX_SIZE if max_size is None else max_size
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key):
+        item_state = self.items.get(key)
+        if item_state is None:
+            self.misses += 1
+            return None
+        self.items.move_to_end(key)
+        self.hits += 1
+        return item_state
+
+    def put(self, key, item_state):
+        if self.max_size <= 0:
+            return
+        self.items[key] = item_state
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        self.items.pop(key, None)
+
+    def clear(self):
+        self.items.clear()
+
+    def get_stats(self):
+        return {'size': len(self.items),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+    def warm(self, database, table, owns_key=None):
+        # owns_key filters the rows to the keys this consumer is responsible for
+        loaded_count = 0
+        for item_number, store_number, current_value, last_update in database.stream(
+                'SELECT item_number, store_number, current_value, last_update FROM {};'.format(table)):
+            key = (item_number, store_number)
+            if owns_key and not owns_key(key):
+                continue
+            self.put(key, (current_value, last_update))
+            loaded_count += 1
+        logger.info('Stock cache warmed: {} items loaded, {} kept.'.format(loaded_count, len(self.items)))
+        return loaded_count
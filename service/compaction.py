@@ -0,0 +1,41 @@
+from collections import OrderedDict
+
+
+class StockEventCompactor:
+    # Folds the accepted events of a batch into one stock state per (item_number, store_number). The stock
+    # rules are applied event by event on the running state (stale dates, no negative stock), so every event
+    # keeps its own outcome, but each item is written once per batch instead of once per event.
+
+    def __init__(self, apply_rules):
+        # apply_rules(item_state, event_type, event_date, event_value) -> (item_state, reason)
+        self.apply_rules = apply_rules
+        self.item_events = OrderedDict()
+        self.event_count = 0
+
+    def __len__(self):
+        return self.event_count
+
+    def add(self, item_key, event_type, event_date, event_value, event=None):
+        # Events of an item are folded in the order they are added
+        self.item_events.setdefault(item_key, []).append((event_type, event_date, event_value, event))
+        self.event_count += 1
+
+    def get_item_keys(self):
+        return list(self.item_events)
+
+    def fold(self, item_states):
+        # item_states: {item_key: (current_value, last_update)} of the stored items, missing ones are new.
+        # Returns the (event, reason) of every event and the final states of the changed items.
+        results = []
+        changed_states = OrderedDict()
+        for item_key, events in self.item_events.items():
+            item_state = item_states.get(item_key)
+            start_state = item_state
+            for event_type, event_date, event_value, event in events:
+                item_state, reason = self.apply_rules(item_state, event_type, event_date, event_value)
+                results.append((event, reason))
+            if item_state is not None and item_state != start_state:
+                changed_states[item_key] = item_state
+        self.item_events = OrderedDict()
+        self.event_count = 0
+        return results, changed_states
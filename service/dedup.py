@@ -0,0 +1,126 @@
+from collections import OrderedDict
+import hashlib
+import math
+
+from tools import logger
+logger = logger.get_logger(__name__)
+
+
+class StockDedupFilter:
+    # Seen transaction ids: a bloom filter of the recently stored events and an exact LRU set of the recent ones.
+    # A miss in both is a new event for sure; a bloom hit is only probable and has to be confirmed by the database.
+    # Older ids, and every id once the filter is over its capacity, are caught by the unique key of the insert.
+
+    DEFAULT_CAPACITY = 1000000
+    DEFAULT_ERROR_RATE = 0.001
+    DEFAULT_RECENT_SIZE = 100000
+    # Events stored in the last days are seeded, about the retention of the topic replays come from.
+    # Their business date can be much older, e.g. for backfills.
+    DEFAULT_SEED_DAYS = 7
+    # Room for the events of the run on top of the seeded ones, when the capacity is sized from the table
+    DEFAULT_CAPACITY_GROWTH = 2
+    DUPLICATE = 'duplicate'
+    PROBABLE_DUPLICATE = 'probable_duplicate'
+
+    def __init__(self, capacity=None, error_rate=None, recent_size=None, seed_days=None):
+        # Without a capacity, it is sized from the number of events seeded
+        self.is_sized = bool(capacity)
+        self.error_rate = error_rate if error_rate else self.DEFAULT_ERROR_RATE
+        self.recent_size = self.DEFAULT_RECENT_SIZE if recent_size is None else recent_size
+        self.seed_days = seed_days if seed_days else self.DEFAULT_SEED_DAYS
+        self.capacity = None
+        self.bit_count = None
+        self.hash_count = None
+        self.bits = None
+        self.recent = OrderedDict()
+        self.count = 0
+        self.duplicates = 0
+        self.probable_duplicates = 0
+        self.false_positives = 0
+        self._allocate(capacity if capacity else self.DEFAULT_CAPACITY)
+
+    def _allocate(self, capacity):
+        self.capacity = capacity
+        self.bit_count = max(8, int(-self.capacity * math.log(self.error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.bit_count / self.capacity * math.log(2)))
+        self.bits = bytearray(self.bit_count // 8 + 1)
+        self.count = 0
+
+    def is_saturated(self):
+        # Over its capacity, the false positive rate of the bloom filter climbs fast: it is not used any more
+        return self.count > self.capacity
+
+    @staticmethod
+    def _normalize(transaction_id):
+        # Postgres stores uuids in lower case
+        return str(transaction_id).lower()
+
+    def _get_positions(self, transaction_id):
+        # Double hashing: every position is derived from the two halves of one digest
+        digest = hashlib.blake2b(transaction_id.encode('utf-8'), digest_size=16).digest()
+        first_hash = int.from_bytes(digest[:8], 'little')
+        second_hash = int.from_bytes(digest[8:], 'little') | 1
+        return [(first_hash + index * second_hash) % self.bit_count for index in range(self.hash_count)]
+
+    def add(self, transaction_id):
+        transaction_id = self._normalize(transaction_id)
+        self.count += 1
+        if not self.is_saturated():
+            for position in self._get_positions(transaction_id):
+                self.bits[position >> 3] |= 1 << (position & 7)
+        elif self.count == self.capacity + 1:
+            logger.warning('Dedup filter is over its capacity of {} ids, only the recent ids are checked in '
+                           'memory.'.format(self.capacity))
+        if self.recent_size > 0:
+            self.recent[transaction_id] = True
+            self.recent.move_to_end(transaction_id)
+            if len(self.recent) > self.recent_size:
+                self.recent.popitem(last=False)
+
+    def check(self, transaction_id):
+        # Returns DUPLICATE, PROBABLE_DUPLICATE or None for a new id
+        transaction_id = self._normalize(transaction_id)
+        if transaction_id in self.recent:
+            self.duplicates += 1
+            return self.DUPLICATE
+        if self.is_saturated():
+            return None
+        for position in self._get_positions(transaction_id):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return None
+        self.probable_duplicates += 1
+        return self.PROBABLE_DUPLICATE
+
+    def add_false_positive(self):
+        self.false_positives += 1
+
+    def get_stats(self):
+        return {'size': self.count,
+                'recent': len(self.recent),
+                'duplicates': self.duplicates,
+                'probable_duplicates': self.probable_duplicates,
+                'false_positives': self.false_positives}
+
+    def _get_seed_where(self):
+        # Every partition has an index on the insertion time, old partitions cost one index lookup
+        return "inserted_at >= now() - interval '{} days'".format(int(self.seed_days))
+
+    def seed(self, database, table, owns_key=None):
+        # owns_key filters the events to the (item_number, store_number) keys this consumer is responsible for
+        if not self.is_sized:
+            database.execute('SELECT count(*) FROM {} WHERE {};'.format(table, self._get_seed_where()))
+            row_count = database.query_result[0][0]
+            self._allocate(max(self.DEFAULT_CAPACITY, row_count * self.DEFAULT_CAPACITY_GROWTH))
+        else:
+            self._allocate(self.capacity)
+        seeded_count = 0
+        for transaction_id, item_number, store_number in database.stream(
+                'SELECT transaction_id, item_number, store_number FROM {} WHERE {};'.format(
+                    table, self._get_seed_where())):
+            if owns_key and not owns_key((item_number, store_number)):
+                continue
+            self.add(transaction_id)
+            seeded_count += 1
+        logger.info('Dedup filter seeded: {} transaction ids of the last {} days, capacity {}.'.format(
+            seeded_count, self.seed_days, self.capacity))
+        return seeded_count
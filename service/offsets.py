@@ -0,0 +1,50 @@
+from tools import logger
+logger = logger.get_logger(__name__)
+
+
+class StockOffsetStore:
+    # Last processed Kafka offset per partition, kept in the database next to the events.
+    # Stored in the transaction of the batch, the offsets and the stock changes are committed together.
+
+    DEFAULT_TABLE = 'consumer_offsets'
+    LOAD_SQL = 'SELECT partition_id, last_offset FROM {table} ' \
+               'WHERE consumer_group = %(consumer_group)s AND topic = %(topic)s;'
+    STORE_SQL = 'INSERT INTO {table} (consumer_group, topic, partition_id, last_offset) ' \
+                'VALUES (%(consumer_group)s, %(topic)s, %(partition_id)s, %(last_offset)s) ' \
+                'ON CONFLICT (consumer_group, topic, partition_id) DO UPDATE SET last_offset = EXCLUDED.last_offset;'
+
+    def __init__(self, database, consumer_group, topic):
+        self.database = database
+        self.consumer_group = consumer_group.decode('utf-8') if isinstance(consumer_group, bytes) else consumer_group
+        self.topic = topic
+        self.table = self.DEFAULT_TABLE
+        self.load_sql = self.LOAD_SQL.format(table=self.table)
+        self.store_sql = self.STORE_SQL.format(table=self.table)
+
+    @staticmethod
+    def get_message_offsets(messages, offsets=None):
+        # Messages of a partition arrive in offset order, the last one is the last processed
+        offsets = offsets if offsets is not None else {}
+        for message in messages:
+            offsets[message.partition_id] = message.offset
+        return offsets
+
+    def get_load_values(self):
+        return {'consumer_group': self.consumer_group, 'topic': self.topic}
+
+    def get_store_values(self, offsets):
+        return [{'consumer_group': self.consumer_group,
+                 'topic': self.topic,
+                 'partition_id': partition_id,
+                 'last_offset': last_offset} for partition_id, last_offset in sorted(offsets.items())]
+
+    def load(self):
+        self.database.execute(self.load_sql, self.get_load_values())
+        offsets = dict(self.database.query_result)
+        logger.info('Stored offsets: {}'.format(offsets))
+        return offsets
+
+    def store(self, offsets):
+        # Committed by the caller, or right away in autocommit mode
+        for store_values in self.get_store_values(offsets):
+            self.database.execute(self.store_sql, store_values)
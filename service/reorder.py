@@ -0,0 +1,137 @@
+from collections import OrderedDict
+import bisect
+import datetime
+import heapq
+import itertools
+import time
+
+from tools import logger
+logger = logger.get_logger(__name__)
+
+
+class StockReorderBuffer:
+    # Holds the events of every (item_number, store_number) and releases them sorted by date, so that
+    # late arrivals are applied before the newer events of the item instead of being rejected as stale.
+    #
+    # The watermark trails the latest event date by window_s: events at or before it are released. An item
+    # is also released when its events wait for max_delay_s (wall clock), when it holds max_key_events, and
+    # the items waiting longest are released once the buffer holds max_events.
+
+    DEFAULT_WINDOW_S = 3600
+    DEFAULT_MAX_DELAY_S = 5
+    DEFAULT_MAX_KEY_EVENTS = 100
+    DEFAULT_MAX_EVENTS = 10000
+
+    def __init__(self, window_s=None, max_delay_s=None, max_key_events=None, max_events=None):
+        self.window = datetime.timedelta(seconds=window_s if window_s is not None else self.DEFAULT_WINDOW_S)
+        self.max_delay_s = max_delay_s if max_delay_s is not None else self.DEFAULT_MAX_DELAY_S
+        self.max_key_events = max_key_events if max_key_events else self.DEFAULT_MAX_KEY_EVENTS
+        self.max_events = max_events if max_events else self.DEFAULT_MAX_EVENTS
+        # item_key -> [(date, seq, event, partition_id, offset)] sorted by date, in the order the items got held
+        self.items = OrderedDict()
+        self.held_since = {}
+        # (date, seq, item_key) of every held event; released ones are skipped when they come up
+        self.dates = []
+        # partition_id -> offsets of the held events, in consuming order: the first one is the lowest
+        self.partition_offsets = {}
+        self.ready = []
+        self.sequence = itertools.count()
+        self.held_count = 0
+        self.max_date = None
+        self.reordered_count = 0
+
+    def __len__(self):
+        return self.held_count
+
+    @property
+    def watermark(self):
+        return self.max_date - self.window if self.max_date else None
+
+    def add(self, event, item_key, event_date, partition_id=None, offset=None, now=None):
+        # Events without a key or date cannot be ordered, they are released right away
+        if item_key is None or event_date is None:
+            self.ready.append(event)
+            return
+        if self.max_date is None or event_date > self.max_date:
+            self.max_date = event_date
+        entry = (event_date, next(self.sequence), event, partition_id, offset)
+        key_entries = self.items.get(item_key)
+        if key_entries is None:
+            key_entries = self.items[item_key] = []
+            self.held_since[item_key] = time.monotonic() if now is None else now
+        if key_entries and event_date < key_entries[-1][0]:
+            self.reordered_count += 1
+        # seq is unique, events are never compared
+        bisect.insort(key_entries, entry)
+        heapq.heappush(self.dates, (event_date, entry[1], item_key))
+        if partition_id is not None:
+            self.partition_offsets.setdefault(partition_id, OrderedDict())[offset] = None
+        self.held_count += 1
+        if len(key_entries) > self.max_key_events:
+            self._release_first(item_key)
+
+    def _release_entry(self, entry):
+        _, _, event, partition_id, offset = entry
+        if partition_id is not None:
+            self.partition_offsets[partition_id].pop(offset, None)
+        self.held_count -= 1
+        self.ready.append(event)
+
+    def _release_first(self, item_key):
+        key_entries = self.items[item_key]
+        self._release_entry(key_entries.pop(0))
+        if not key_entries:
+            del self.items[item_key]
+            del self.held_since[item_key]
+
+    def _release_key(self, item_key):
+        for entry in self.items.pop(item_key):
+            self._release_entry(entry)
+        del self.held_since[item_key]
+
+    def release(self, now=None):
+        # Events ready to be processed, in date order per item
+        watermark = self.watermark
+        while self.dates and watermark and self.dates[0][0] <= watermark:
+            _, seq, item_key = heapq.heappop(self.dates)
+            key_entries = self.items.get(item_key)
+            # The oldest held date of all is also the first of its item
+            if key_entries and key_entries[0][1] == seq:
+                self._release_first(item_key)
+        now = time.monotonic() if now is None else now
+        while self.items:
+            item_key = next(iter(self.items))
+            if now - self.held_since[item_key] < self.max_delay_s and self.held_count <= self.max_events:
+                break
+            self._release_key(item_key)
+        if len(self.dates) > 2 * self.held_count + self.max_key_events:
+            self.dates = [(entry[0], entry[1], item_key)
+                          for item_key, key_entries in self.items.items() for entry in key_entries]
+            heapq.heapify(self.dates)
+        ready, self.ready = self.ready, []
+        return ready
+
+    def flush(self):
+        while self.items:
+            self._release_key(next(iter(self.items)))
+        self.dates = []
+        ready, self.ready = self.ready, []
+        return ready
+
+    def get_safe_offsets(self, offsets):
+        # offsets: {partition_id: last consumed offset}. Held events are not processed yet, so a partition
+        # is only committed up to the offset before its first held event. Partitions without a processed
+        # event are left out, a negative offset would mean the latest one to Kafka.
+        safe_offsets = {}
+        for partition_id, last_offset in offsets.items():
+            held_offsets = self.partition_offsets.get(partition_id)
+            safe_offset = next(iter(held_offsets)) - 1 if held_offsets else last_offset
+            if safe_offset >= 0:
+                safe_offsets[partition_id] = safe_offset
+        return safe_offsets
+
+    def get_stats(self):
+        return {'held': self.held_count,
+                'items': len(self.items),
+                'reordered': self.reordered_count,
+                'watermark': self.watermark}
@@ -1,10 +1,21 @@
 import datetime
-import json
+import re
+import time
+import uuid
 
 from kafka_client.client import StockKafkaClient, StockKafkaClientException
+from kafka_client.codec import StockEventCodec, StockEventCodecException
 from database.database import StockServiceDB, StockServiceDBException
+from tools.metrics import MetricsRegistry
+from .cache import StockStateCache
+from .compaction import StockEventCompactor
+from .dedup import StockDedupFilter
+from .offsets import StockOffsetStore
+from .snapshot import StockSnapshot
 
 from tools import logger
+# Per-event lines are rate limited, the metrics keep the exact counts
+event_logger = logger.get_sampled_logger(__name__)
 logger = logger.get_logger(__name__)
 
 
@@ -21,148 +32,575 @@ class StockService:
                             'item_number',
                             'value']
     DEFAULT_EVENTS_TABLE = 'events'
+    DEFAULT_EVENT_IDS_TABLE = 'event_ids'
     DEFAULT_STOCK_TABLE = 'stock'
     DEFAULT_INCOMING_TYPE = 'incoming'
     DEFAULT_SALE_TYPE = 'sale'
+    DEFAULT_BATCH_SIZE = 500
+    DEFAULT_CACHE_SIZE = 100000
+    DEFAULT_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+    DEFAULT_INTEGER_FIELDS = ['store_number', 'item_number', 'value']
+    # Range of the integer columns
+    DEFAULT_INTEGER_RANGE = (-2 ** 31, 2 ** 31 - 1)
+    INTEGER_PATTERN = re.compile(r'\s*[+-]?[0-9]+\s*\Z')
+    REASON_APPLIED = 'applied'
+    REASON_STALE = 'stale'
+    REASON_OUT_OF_STOCK = 'out_of_stock'
+    REASON_NO_ITEM = 'no_item'
+    # Date and stock guards are evaluated on the server, in the same statement as the write
+    STOCK_UPSERT_SQL = '''
+        WITH current_item AS (
+            SELECT current_value, last_update FROM {table}
+            WHERE item_number = %(item_number)s AND store_number = %(store_number)s
+        ), upserted AS (
+            INSERT INTO {table} AS stock (item_number, store_number, current_value, last_update)
+            SELECT %(item_number)s::integer, %(store_number)s::integer, %(delta)s::integer, %(date)s::timestamp
+            WHERE %(event_type)s = %(incoming_type)s OR EXISTS (SELECT 1 FROM current_item)
+            ON CONFLICT (item_number, store_number) DO UPDATE
+            SET current_value = stock.current_value + EXCLUDED.current_value,
+                last_update = EXCLUDED.last_update
+            WHERE stock.last_update <= EXCLUDED.last_update
+              AND stock.current_value + EXCLUDED.current_value >= 0
+            RETURNING stock.current_value, stock.last_update
+        )
+        SELECT COALESCE(upserted.current_value, current_item.current_value),
+               COALESCE(upserted.last_update, current_item.last_update),
+               CASE WHEN upserted.current_value IS NOT NULL THEN %(reason_applied)s
+                    WHEN current_item.last_update IS NULL THEN %(reason_no_item)s
+                    WHEN current_item.last_update > %(date)s::timestamp THEN %(reason_stale)s
+                    ELSE %(reason_out_of_stock)s END
+        FROM (SELECT 1) AS event
+        LEFT JOIN upserted ON TRUE
+        LEFT JOIN current_item ON TRUE;'''
+    # The events are partitioned by date, their ids are unique in the ids table: an id stored with any date is a
+    # duplicate. The event is written only if its id was new, in the same statement.
+    EVENT_INSERT_SQL = '''
+        WITH new_id AS (
+            INSERT INTO {ids_table} (transaction_id) VALUES (%(transaction_id)s::uuid)
+            ON CONFLICT DO NOTHING
+            RETURNING transaction_id
+        )
+        INSERT INTO {table} (transaction_id, event_type, date, store_number, item_number, value)
+        SELECT transaction_id, %(event_type)s::varchar, %(date)s::timestamp, %(store_number)s::integer,
+               %(item_number)s::integer, %(value)s::integer
+        FROM new_id
+        RETURNING transaction_id;'''
+    # Compacted batches: the new events go in with one statement, the stored ones come back as duplicates
+    EVENTS_INSERT_SQL = '''
+        WITH batch (seq, transaction_id, event_type, date, store_number, item_number, value) AS (VALUES %s),
+        new_ids AS (
+            INSERT INTO {ids_table} (transaction_id)
+            SELECT transaction_id FROM batch ORDER BY seq
+            ON CONFLICT DO NOTHING
+            RETURNING transaction_id
+        ), inserted AS (
+            INSERT INTO {table} (transaction_id, event_type, date, store_number, item_number, value)
+            SELECT transaction_id, event_type, date, store_number, item_number, value
+            FROM batch JOIN new_ids USING (transaction_id) ORDER BY seq
+            RETURNING transaction_id
+        )
+        SELECT batch.seq, batch.date, batch.item_number, batch.store_number, batch.value
+        FROM batch JOIN inserted USING (transaction_id) ORDER BY batch.seq;'''
+    EVENTS_INSERT_TEMPLATE = '(%s, %s::uuid, %s::varchar, %s::timestamp, %s::integer, %s::integer, %s::integer)'
+    # Locked in key order, so that concurrent batches cannot deadlock on each other
+    STOCK_SELECT_SQL = '''
+        SELECT item_number, store_number, current_value, last_update FROM {table}
+        WHERE (item_number, store_number) IN (
+            SELECT * FROM unnest(%(item_numbers)s::integer[], %(store_numbers)s::integer[]))
+        ORDER BY item_number, store_number
+        FOR UPDATE;'''
+    STOCK_UPDATE_SQL = '''
+        UPDATE {table} AS stock SET current_value = item.current_value, last_update = item.last_update
+        FROM (VALUES %s) AS item (item_number, store_number, current_value, last_update)
+        WHERE stock.item_number = item.item_number AND stock.store_number = item.store_number;'''
+    STOCK_UPDATE_TEMPLATE = '(%s::integer, %s::integer, %s::integer, %s::timestamp)'
+    STOCK_INSERT_SQL = '''
+        INSERT INTO {table} (item_number, store_number, current_value, last_update) VALUES %s
+        ON CONFLICT (item_number, store_number) DO NOTHING
+        RETURNING item_number, store_number;'''
+    DEFAULT_BATCH_TIMEOUT_MS = 200
+    DEFAULT_LAG_INTERVAL_S = 10
 
     def __init__(self, database=None, kafka_client=None):
-        self.kafka_client = kafka_client if kafka_client else StockKafkaClient()
+        # Created on first use only: workers fed by a dispatcher do not consume from Kafka themselves
+        self.kafka_client = kafka_client
         self.database = database if database else StockServiceDB()
         self.table_events = self.DEFAULT_EVENTS_TABLE
+        self.table_event_ids = self.DEFAULT_EVENT_IDS_TABLE
         self.table_stock = self.DEFAULT_STOCK_TABLE
         self.event = None
         self.event_fields = self.DEFAULT_EVENT_FIELDS
         self.item_in_db = None
         self.updated_item_count = 0
+        self.batch_size = self.DEFAULT_BATCH_SIZE
+        self.batch_timeout_ms = self.DEFAULT_BATCH_TIMEOUT_MS
+        # Assumes this service is the only writer of the items it sees (one consumer, or one worker per item)
+        self.cache = StockStateCache(max_size=self.DEFAULT_CACHE_SIZE)
+        self.batch_keys = set()
+        # Ids are added once committed, a rolled back event can come again
+        self.dedup = StockDedupFilter()
+        self.batch_transaction_ids = []
+        # StockOffsetStore, set once the consumer is known
+        self.offset_store = None
+        self.codec = StockEventCodec()
+        self.metrics = MetricsRegistry()
+        # Local HTTP endpoint of the metrics, disabled without a port
+        self.metrics_port = None
+        self.metrics_summary_interval_s = MetricsRegistry.DEFAULT_SUMMARY_INTERVAL_S
+        self.lag_deadline = 0
+        # StockSnapshot served on a local HTTP port, kept current after every commit
+        self.snapshot = None
+        self.snapshot_port = None
+        self.batch_states = {}
+        # StockReorderBuffer releasing the events by date, disabled by default
+        self.reorder = None
+        self.consumed_offsets = {}
+        # Batches folded per item into one stock write, see process_compacted
+        self.compaction = False
+
+    def _get_event_insert_sql(self):
+        return self.EVENT_INSERT_SQL.format(table=self.table_events, ids_table=self.table_event_ids)
 
     def _insert_transaction(self):
-        self.database.table = self.table_events
-        self.database.fields = ['transaction_id',
-                                'event_type',
-                                'date',
-                                'store_number',
-                                'item_number',
-                                'value']
-        self.database.values = [self.event['transaction_id'],
-                                self.event['event_type'],
-                                self.event['date'],
-                                self.event['store_number'],
-                                self.event['item_number'],
-                                self.event['value']]
-        self.database.insert()
-
-    def _get_item(self):
-        self.database.table = self.table_stock
-        self.database.fields = ['item_number',
-                                'store_number',
-                                'current_value',
-                                'last_update']
-        self.database.where = "item_number={} AND store_number={}".format(self.event['item_number'],
-                                                                          self.event['store_number'])
-        self.database.query()
-        logger.debug(self.database.query_result)
-        self.item_in_db = self.database.query_result
-
-    def _insert_item(self):
-        if self.event['event_type'] != self.DEFAULT_INCOMING_TYPE:
+        self.database.execute(self._get_event_insert_sql(), {'transaction_id': self.event['transaction_id'],
+                                                             'event_type': self.event['event_type'],
+                                                             'date': self.event['date'],
+                                                             'store_number': self.event['store_number'],
+                                                             'item_number': self.event['item_number'],
+                                                             'value': self.event['value']})
+        if not self.database.query_result:
+            raise StockServiceDBException('Insert failed! Duplicate key: {}'.format(self.event['transaction_id']))
+
+    def _is_duplicate(self):
+        transaction_id = self.event['transaction_id']
+        with self.metrics.timer('dedup_check'):
+            result = self.dedup.check(transaction_id)
+        if result == StockDedupFilter.DUPLICATE:
+            return True
+        if result == StockDedupFilter.PROBABLE_DUPLICATE:
+            self.database.execute('SELECT 1 FROM {} WHERE transaction_id = %(transaction_id)s::uuid;'.format(
+                self.table_event_ids), {'transaction_id': transaction_id})
+            if self.database.query_result:
+                return True
+            self.dedup.add_false_positive()
+        return False
+
+    def _add_seen_transaction(self):
+        if self.database.autocommit:
+            self.dedup.add(self.event['transaction_id'])
+        else:
+            self.batch_transaction_ids.append(self.event['transaction_id'])
+
+    def _get_item_key(self):
+        try:
+            return int(self.event['item_number']), int(self.event['store_number'])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    @classmethod
+    def get_stock_delta(cls, event_type, event_value):
+        event_stock_value = int(event_value)
+        if event_type == cls.DEFAULT_INCOMING_TYPE:
+            return event_stock_value
+        if event_type == cls.DEFAULT_SALE_TYPE:
+            return -event_stock_value
+        return 0
+
+    @classmethod
+    def apply_stock_rules(cls, item_state, event_type, event_date, event_value):
+        # Same rules as STOCK_UPSERT_SQL; item_state is (current_value, last_update) or None
+        delta = cls.get_stock_delta(event_type, event_value)
+        if item_state is None:
+            if event_type != cls.DEFAULT_INCOMING_TYPE:
+                return None, cls.REASON_NO_ITEM
+            return (delta, event_date), cls.REASON_APPLIED
+        current_value, last_update = item_state
+        if last_update > event_date:
+            return item_state, cls.REASON_STALE
+        if current_value + delta < 0:
+            return item_state, cls.REASON_OUT_OF_STOCK
+        return (current_value + delta, event_date), cls.REASON_APPLIED
+
+    def _get_stock_delta(self):
+        return self.get_stock_delta(self.event['event_type'], self.event['value'])
+
+    def _check_cached_item(self, item_key):
+        # Stale and out of stock events are rejected from memory, applied ones still go through the upsert
+        item_state = self.cache.get(item_key)
+        if item_state is None:
+            return None
+        try:
+            event_date = self._get_event_date()
+            _, reason = self.apply_stock_rules(item_state, self.event['event_type'], event_date, self.event['value'])
+        except (TypeError, ValueError):
+            return None
+        return reason if reason != self.REASON_APPLIED else None
+
+    def _get_upsert_values(self):
+        return {'item_number': self.event['item_number'],
+                'store_number': self.event['store_number'],
+                'delta': self._get_stock_delta(),
+                'date': self.event['date'],
+                'event_type': self.event['event_type'],
+                'incoming_type': self.DEFAULT_INCOMING_TYPE,
+                'reason_applied': self.REASON_APPLIED,
+                'reason_no_item': self.REASON_NO_ITEM,
+                'reason_stale': self.REASON_STALE,
+                'reason_out_of_stock': self.REASON_OUT_OF_STOCK}
+
+    def _cache_upsert_result(self, item_key, current_value, last_update):
+        logger.debug('upsert result: %s, %s', current_value, last_update)
+        if not item_key:
             return
-        self.database.table = self.table_stock
-        self.database.fields = ['item_number',
-                                'store_number',
-                                'current_value',
-                                'last_update']
-        self.database.values = [self.event['item_number'],
-                                self.event['store_number'],
-                                self.event['value'],
-                                self.event['date']
-                                ]
-        self.database.insert()
-
-    def _update_item(self, value):
-        self.database.table = self.table_stock
-        self.database.fields = ['current_value']
-        self.database.values = [value]
-        self.database.where = "item_number={} AND store_number={}".format(self.event['item_number'],
-                                                                          self.event['store_number'])
-        self.database.update()
-        # Set new date
-        self.database.fields = ['last_update']
-        self.database.values = [self.event['date']]
-        self.database.update()
-
-    def _check_item_date(self):
-        item_date_in_db = self.item_in_db[3]
-        event_date = datetime.datetime.strptime(self.event['date'], '%Y-%m-%dT%H:%M:%SZ')
-        logger.debug('item_date_in_db: {}; event_date: {}'.format(item_date_in_db, event_date))
-        if item_date_in_db > event_date:
-            logger.warning('Cannot process event. Event date is before last update of the item!')
-            return False
-        return True
+        if current_value is None:
+            self.cache.invalidate(item_key)
+            return
+        self.cache.put(item_key, (current_value, last_update))
+        if self.snapshot:
+            self.batch_states[item_key] = (current_value, last_update)
+            if self.database.autocommit:
+                self._apply_snapshot_states()
 
-    def _set_stock_value(self):
-        item_stock_value = self.item_in_db[2]
-        event_stock_value = int(self.event['value'])
-        if self.event['event_type'] == self.DEFAULT_INCOMING_TYPE:
-            item_stock_value += event_stock_value
-        elif self.event['event_type'] == self.DEFAULT_SALE_TYPE:
-            if (item_stock_value - event_stock_value) < 0:
-                raise StockServiceException('Cannot run out of stock! Transaction ID: {}'.format(
-                    self.event['transaction_id']))
-            item_stock_value -= event_stock_value
-        self._update_item(item_stock_value)
+    def _upsert_item(self):
+        item_key = self._get_item_key()
+        if item_key:
+            if not self.database.autocommit:
+                self.batch_keys.add(item_key)
+            with self.metrics.timer('cache_check'):
+                reason = self._check_cached_item(item_key)
+            if reason:
+                return reason
+        with self.metrics.timer('stock_upsert'):
+            self.database.execute(self.STOCK_UPSERT_SQL.format(table=self.table_stock), self._get_upsert_values())
+        current_value, last_update, reason = self.database.query_result[0]
+        self._cache_upsert_result(item_key, current_value, last_update)
+        if reason == self.REASON_APPLIED:
+            self.item_in_db = (int(self.event['item_number']),
+                               int(self.event['store_number']),
+                               current_value,
+                               last_update)
+        return reason
 
     def _check_event_fields(self):
+        if not isinstance(self.event, dict):
+            raise StockServiceException('Event is not an object!')
         current_event_fields = self.event.keys()
         if not current_event_fields:
             raise StockServiceException('Cannot get event fields!')
         if list(current_event_fields) != self.event_fields:
             raise StockServiceException('Event fields are different. Event ID: {}'.format(self.event['transaction_id']))
 
-    def _check_json_format(self):
+    def _check_event_values(self):
+        # Values the database would refuse fail the whole batch, they are rejected with the event instead
+        transaction_id = self.event['transaction_id']
         try:
-            self.event = json.loads(self.event)
-        except (json.decoder.JSONDecodeError, TypeError, ):
-            raise StockServiceException('Event is not a valid JSON!')
+            uuid.UUID(transaction_id)
+        except (TypeError, ValueError, AttributeError):
+            raise StockServiceException('Not a valid transaction ID: {}'.format(transaction_id))
+        if not isinstance(self.event['event_type'], str):
+            raise StockServiceException('Not a valid event type. Event ID: {}'.format(transaction_id))
+        try:
+            self._get_event_date()
+        except (TypeError, ValueError):
+            raise StockServiceException('Not a valid date. Event ID: {}'.format(transaction_id))
+        min_value, max_value = self.DEFAULT_INTEGER_RANGE
+        for event_field in self.DEFAULT_INTEGER_FIELDS:
+            value = self.event[event_field]
+            if not (type(value) is int or isinstance(value, str) and self.INTEGER_PATTERN.match(value)) \
+                    or not min_value <= int(value) <= max_value:
+                raise StockServiceException('Not a valid {}. Event ID: {}'.format(event_field, transaction_id))
 
-    def process_event(self):
+    def _get_event_date(self):
+        # Binary events carry a datetime already
+        if isinstance(self.event['date'], datetime.datetime):
+            return self.event['date']
         try:
-            self._check_json_format()
-        except StockServiceException as exc:
-            logger.warning(exc)
+            return datetime.datetime.strptime(self.event['date'], self.DEFAULT_DATE_FORMAT)
+        except ValueError:
+            # Other ISO 8601 forms are read by the database as well, which ignores the offset of a timestamp
+            return datetime.datetime.fromisoformat(self.event['date']).replace(tzinfo=None)
+
+    def _check_json_format(self):
+        # JSON text or message bytes, in JSON or in the binary wire format
+        if isinstance(self.event, dict):
+            # Decoded already, held by the reorder buffer
             return
         try:
-            self._check_event_fields()
+            self.event = self.codec.decode(self.event)
+        except StockEventCodecException as exc:
+            raise StockServiceException(str(exc))
+
+    def _parse_event(self):
+        try:
+            with self.metrics.timer('event_decode'):
+                self._check_json_format()
+            with self.metrics.timer('field_check'):
+                self._check_event_fields()
+                self._check_event_values()
         except StockServiceException as exc:
             logger.warning(exc)
+            self.metrics.counter('events_malformed').inc()
+            return False
+        event_logger.info('Processing event: %s', self.event)
+        return True
+
+    def _log_upsert_reason(self, reason):
+        self.metrics.counter('events_{}'.format(reason)).inc()
+        if reason == self.REASON_NO_ITEM:
+            event_logger.warning('Cannot process event. No stock for item! Transaction ID: %s',
+                                 self.event['transaction_id'])
+            return
+        if reason == self.REASON_STALE:
+            event_logger.warning('Cannot process event. Event date is before last update of the item! '
+                                 'Transaction ID: %s', self.event['transaction_id'])
+            return
+        if reason == self.REASON_OUT_OF_STOCK:
+            logger.error('Cannot run out of stock! Transaction ID: %s', self.event['transaction_id'])
+            return
+        self.updated_item_count += 1
+        event_logger.info('Event process was success! ID: %s', self.event['transaction_id'])
+
+    def process_event(self):
+        if not self._parse_event():
+            return
+        if self._is_duplicate():
+            event_logger.warning('Duplicate event skipped: %s', self.event['transaction_id'])
+            self.metrics.counter('events_duplicate').inc()
             return
-        logger.info('Processing event: {}'.format(self.event))
         try:
-            self._insert_transaction()
+            with self.metrics.timer('transaction_insert'):
+                self._insert_transaction()
         except StockServiceDBException as exc:
-            logger.warning(exc)
+            event_logger.warning(exc)
+            self.metrics.counter('events_duplicate').inc()
+            return
+        self._add_seen_transaction()
+        self._log_upsert_reason(self._upsert_item())
+
+    def _get_batch(self):
+        batch = []
+        deadline = time.monotonic() + self.batch_timeout_ms / 1000
+        while len(batch) < self.batch_size and time.monotonic() < deadline:
+            message = self.kafka_client.consumer.consume(block=True)
+            if message is None:
+                break
+            batch.append(message)
+        return batch
+
+    def warm_cache(self, owns_key=None):
+        self.warm_stock_cache(owns_key=owns_key)
+        self.seed_dedup(owns_key=owns_key)
+
+    def warm_stock_cache(self, owns_key=None):
+        # Cleared first: after a rebalance, the items of the moved partitions were written by another consumer
+        self.cache.clear()
+        self.cache.warm(self.database, self.table_stock, owns_key=owns_key)
+        self.database.commit()
+
+    def seed_dedup(self, owns_key=None):
+        self.dedup.seed(self.database, self.table_events, owns_key=owns_key)
+        self.database.commit()
+
+    def _apply_snapshot_states(self):
+        if self.batch_states:
+            self.snapshot.apply(self.batch_states)
+            self.batch_states = {}
+
+    def start_snapshot(self, rows=None):
+        # rows: the stock table, when already read
+        if self.snapshot_port is None:
             return
-        self._get_item()
-        if not self.item_in_db:
-            self._insert_item()
-            self.updated_item_count += 1
+        self.snapshot = StockSnapshot()
+        if rows is None:
+            self.snapshot.load(self.database.stream(StockSnapshot.STOCK_SQL.format(self.table_stock)))
+            self.database.commit()
+        else:
+            self.snapshot.load(rows)
+        self.snapshot.start_server(self.snapshot_port)
+
+    def start_metrics(self):
+        if self.metrics_port:
+            self.metrics.start_server(self.metrics_port)
+        self.metrics.start_summary_log(self.metrics_summary_interval_s)
+
+    def _update_consumer_lag(self):
+        # One request to the brokers, sent every few seconds only
+        now = time.monotonic()
+        if now < self.lag_deadline:
             return
-        if not self._check_item_date():
+        self.lag_deadline = now + self.DEFAULT_LAG_INTERVAL_S
+        try:
+            self.metrics.gauge('consumer_lag').set(self.kafka_client.get_consumer_lag())
+        except StockKafkaClientException as exc:
+            logger.warning(exc)
+
+    def _get_item_states(self, item_keys):
+        # Every item of the batch is read and locked in one query, cached or not: the asyncio engine, the bulk
+        # loader or the previous owner of a partition may have written it since it was cached
+        self.database.execute(self.STOCK_SELECT_SQL.format(table=self.table_stock),
+                              {'item_numbers': [item_number for item_number, _ in item_keys],
+                               'store_numbers': [store_number for _, store_number in item_keys]})
+        return {(item_number, store_number): (current_value, last_update)
+                for item_number, store_number, current_value, last_update in self.database.query_result}
+
+    def _write_item_states(self, item_states, changed_states):
+        # Stored items are locked since the read and updated in place. New items are inserted unless another
+        # writer created them meanwhile: their keys are returned, the fold of these items is not valid.
+        stored_rows = [item_key + item_state for item_key, item_state in changed_states.items()
+                       if item_key in item_states]
+        new_rows = [item_key + item_state for item_key, item_state in changed_states.items()
+                    if item_key not in item_states]
+        if stored_rows:
+            self.database.execute_values(self.STOCK_UPDATE_SQL.format(table=self.table_stock), stored_rows,
+                                         template=self.STOCK_UPDATE_TEMPLATE)
+        if not new_rows:
+            return set()
+        self.database.execute_values(self.STOCK_INSERT_SQL.format(table=self.table_stock), new_rows)
+        return {row[:2] for row in new_rows} - set(self.database.query_result)
+
+    def process_compacted(self, events):
+        # Same outcomes as process_event for every event, with a few statements per batch: one insert of the
+        # new events, one locking read of the items and one update and one insert of the changed items
+        new_events = {}
+        batch_ids = set()
+        for event in events:
+            self.event = event
+            if not self._parse_event():
+                continue
+            transaction_id = str(self.event['transaction_id']).lower()
+            if transaction_id in batch_ids or self._is_duplicate():
+                event_logger.warning('Duplicate event skipped: %s', self.event['transaction_id'])
+                self.metrics.counter('events_duplicate').inc()
+                continue
+            batch_ids.add(transaction_id)
+            new_events[len(new_events)] = self.event
+        if not new_events:
             return
+        with self.metrics.timer('transaction_insert'):
+            self.database.execute_values(
+                self.EVENTS_INSERT_SQL.format(table=self.table_events, ids_table=self.table_event_ids),
+                [(seq, event['transaction_id'], event['event_type'], event['date'], event['store_number'],
+                  event['item_number'], event['value']) for seq, event in new_events.items()],
+                template=self.EVENTS_INSERT_TEMPLATE)
+        inserted_rows = self.database.query_result
+        compactor = StockEventCompactor(self.apply_stock_rules)
+        for seq in set(new_events) - {row[0] for row in inserted_rows}:
+            event_logger.warning('Duplicate event skipped: %s', new_events[seq]['transaction_id'])
+            self.metrics.counter('events_duplicate').inc()
+        # Typed values from the database
+        for seq, event_date, item_number, store_number, event_value in inserted_rows:
+            self.event = new_events[seq]
+            self._add_seen_transaction()
+            compactor.add((item_number, store_number), self.event['event_type'], event_date, event_value,
+                          event=self.event)
+        item_keys = compactor.get_item_keys()
+        self.batch_keys.update(item_keys)
+        item_states = self._get_item_states(item_keys)
+        with self.metrics.timer('stock_fold'):
+            results, changed_states = compactor.fold(item_states)
+        conflict_keys = set()
+        if changed_states:
+            with self.metrics.timer('stock_upsert'):
+                conflict_keys = self._write_item_states(item_states, changed_states)
+            for item_key, (current_value, last_update) in changed_states.items():
+                if item_key in conflict_keys:
+                    self.cache.invalidate(item_key)
+                else:
+                    self._cache_upsert_result(item_key, current_value, last_update)
+        for item_key, item_state in item_states.items():
+            if item_key not in changed_states:
+                self.cache.put(item_key, item_state)
+        for event, reason in results:
+            self.event = event
+            if conflict_keys and self._get_item_key() in conflict_keys:
+                # Created by another writer since the read: applied one by one through the guarded upsert
+                reason = self._upsert_item()
+            self._log_upsert_reason(reason)
+        logger.debug('Compacted %s events into %s stock writes.', len(results), len(changed_states))
+
+    def process_batch(self, events, offsets=None):
+        # offsets: {partition_id: last_offset} of the batch, stored in the same transaction as the events
+        self.database.autocommit = False
+        self.batch_keys = set()
+        self.batch_transaction_ids = []
         try:
-            self._set_stock_value()
-        except StockServiceException as exc:
-            logger.error(exc)
+            if self.compaction:
+                self.process_compacted(events)
+            else:
+                for event in events:
+                    self.event = event
+                    self.process_event()
+            if offsets:
+                self.offset_store.store(offsets)
+            with self.metrics.timer('batch_commit'):
+                self.database.commit()
+            for transaction_id in self.batch_transaction_ids:
+                self.dedup.add(transaction_id)
+            if self.snapshot:
+                self._apply_snapshot_states()
+        except BaseException:
+            self.database.rollback()
+            # Cached states written by the rolled back batch are not in the database anymore
+            for item_key in self.batch_keys:
+                self.cache.invalidate(item_key)
+            raise
+        finally:
+            self.database.autocommit = True
+            self.batch_keys = set()
+            self.batch_transaction_ids = []
+            self.batch_states = {}
+        self.metrics.counter('events').inc(len(events))
+        logger.info('Batch committed: %s events.', len(events))
+        logger.debug('Stock cache: %s', self.cache.get_stats())
+        logger.debug('Dedup filter: %s', self.dedup.get_stats())
+
+    def _hold_event(self, message):
+        self.event = message.value
+        if not self._parse_event():
             return
-        self.updated_item_count += 1
-        logger.info('Event process was success! ID: {}'.format(self.event['transaction_id']))
+        try:
+            event_date = self._get_event_date()
+        except (TypeError, ValueError):
+            event_date = None
+        self.reorder.add(self.event, self._get_item_key(), event_date,
+                         partition_id=message.partition_id, offset=message.offset)
+
+    def process_reordered(self, messages):
+        # The offsets stored with the batch stay below the events still held, a restart consumes them again
+        for message in messages:
+            self._hold_event(message)
+        events = self.reorder.release()
+        self.metrics.gauge('reorder_held_events').set(len(self.reorder))
+        self.offset_store.get_message_offsets(messages, self.consumed_offsets)
+        if events or messages:
+            self.process_batch(events, offsets=self.reorder.get_safe_offsets(self.consumed_offsets))
+        logger.debug('Reorder buffer: %s', self.reorder.get_stats())
 
     def get_events(self):
+        if not self.kafka_client:
+            self.kafka_client = StockKafkaClient()
         try:
             self.kafka_client.get_consumer()
         except StockKafkaClientException as exc:
             logger.critical(exc)
             return
-        for message in self.kafka_client.consumer:
-            self.event = message.value.decode('utf-8')
-            logger.debug('self.event: {}'.format(self.event))
-            self.process_event()
+        self.offset_store = StockOffsetStore(self.database, self.kafka_client.consumer_group, self.kafka_client.topic)
+        # The database is the reference: Kafka group offsets may lag behind the last committed batch
+        self.kafka_client.reset_offsets(self.offset_store.load())
+        self.warm_cache()
+        self.start_snapshot()
+        self.start_metrics()
+        while True:
+            messages = self._get_batch()
+            self._update_consumer_lag()
+            if self.reorder:
+                # Also called without messages, held events are released by their wall clock delay. Kafka
+                # offsets are not committed: they would include the held events.
+                self.process_reordered(messages)
+                continue
+            if not messages:
+                continue
+            self.process_batch([message.value for message in messages],
+                               offsets=self.offset_store.get_message_offsets(messages))
+            # Kept for lag monitoring, consuming resumes from the database offsets
+            self.kafka_client.commit_offsets()
@@ -0,0 +1,171 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+
+from database.database import StockServiceDB
+
+from tools import logger
+logger = logger.get_logger(__name__)
+
+
+def _get_row(item_key, item_state):
+    (item_number, store_number), (current_value, last_update) = item_key, item_state
+    return {'store_number': store_number,
+            'item_number': item_number,
+            'current_value': current_value,
+            'last_update': last_update}
+
+
+class StockSnapshot:
+    # In-memory copy of the stock table for readers, with store and item indexes. The service applies the
+    # committed states after every batch, so reads never wait on, or slow down, the database writes.
+
+    DEFAULT_HOST = '127.0.0.1'
+    STOCK_SQL = 'SELECT item_number, store_number, current_value, last_update FROM {};'
+
+    def __init__(self):
+        self.items = {}
+        self.store_items = {}
+        self.item_stores = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def __len__(self):
+        return len(self.items)
+
+    def _put(self, item_key, item_state):
+        item_number, store_number = item_key
+        self.items[item_key] = item_state
+        self.store_items.setdefault(store_number, set()).add(item_number)
+        self.item_stores.setdefault(item_number, set()).add(store_number)
+
+    def load(self, rows):
+        # rows: (item_number, store_number, current_value, last_update), e.g. from StockServiceDB.stream
+        with self.lock:
+            for item_number, store_number, current_value, last_update in rows:
+                self._put((item_number, store_number), (current_value, last_update))
+        logger.info('Stock snapshot loaded: {} items.'.format(len(self.items)))
+
+    def apply(self, item_states):
+        # item_states: {(item_number, store_number): (current_value, last_update)} of a committed batch
+        with self.lock:
+            for item_key, item_state in item_states.items():
+                self._put(item_key, item_state)
+
+    def get_item(self, store_number, item_number):
+        with self.lock:
+            item_state = self.items.get((item_number, store_number))
+        return _get_row((item_number, store_number), item_state) if item_state else None
+
+    def get_store(self, store_number):
+        with self.lock:
+            item_states = [((item_number, store_number), self.items[(item_number, store_number)])
+                           for item_number in sorted(self.store_items.get(store_number, ()))]
+        return [_get_row(item_key, item_state) for item_key, item_state in item_states]
+
+    def get_item_stores(self, item_number):
+        with self.lock:
+            item_states = [((item_number, store_number), self.items[(item_number, store_number)])
+                           for store_number in sorted(self.item_stores.get(item_number, ()))]
+        return [_get_row(item_key, item_state) for item_key, item_state in item_states]
+
+    def get_all(self):
+        # Only the copy holds the lock; the sort and the rows are done outside of it, rows one at a time
+        with self.lock:
+            item_states = list(self.items.items())
+        item_states.sort(key=lambda item: (item[0][1], item[0][0]))
+        return (_get_row(item_key, item_state) for item_key, item_state in item_states)
+
+    def get_rows(self, path):
+        # /stock, /stock/<store>, /stock/<store>/<item> and /items/<item>; None for an unknown path
+        parts = path.strip('/').split('/')
+        try:
+            numbers = [int(part) for part in parts[1:]]
+        except ValueError:
+            return None
+        if parts[0] == 'stock' and len(numbers) == 0:
+            return self.get_all()
+        if parts[0] == 'stock' and len(numbers) == 1:
+            return self.get_store(numbers[0])
+        if parts[0] == 'stock' and len(numbers) == 2:
+            row = self.get_item(*numbers)
+            return [row] if row else []
+        if parts[0] == 'items' and len(numbers) == 1:
+            return self.get_item_stores(numbers[0])
+        return None
+
+    def start_server(self, port, host=None):
+        snapshot = self
+
+        class SnapshotHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                rows = snapshot.get_rows(self.path.split('?')[0])
+                if rows is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                # Written row by row: the JSON of the whole response is never built, but the rows of a store or
+                # an item, and the (key, state) pairs of /stock, are copied first
+                self.wfile.write(b'[')
+                for index, row in enumerate(rows):
+                    row['last_update'] = row['last_update'].isoformat() if row['last_update'] else None
+                    self.wfile.write((',' if index else '').encode('utf-8') + json.dumps(row).encode('utf-8'))
+                self.wfile.write(b']')
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host if host else self.DEFAULT_HOST, port), SnapshotHandler)
+        threading.Thread(target=self.server.serve_forever, name='snapshot-server', daemon=True).start()
+        logger.info('Stock snapshot endpoint: http://{}:{}/stock'.format(*self.server.server_address[:2]))
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class StockReader:
+    # Stock reads straight from the database, for callers without a running service. Rows are streamed
+    # through server-side cursors, in batches. With a StockServiceDBPool, every read takes a connection of the
+    # pool and gives it back once its rows are read, so concurrent readers do not open one connection each.
+
+    DEFAULT_STOCK_TABLE = 'stock'
+    DEFAULT_FIELDS = ['item_number', 'store_number', 'current_value', 'last_update']
+
+    def __init__(self, database=None, pool=None):
+        self.pool = pool
+        self.database = database if database or pool else StockServiceDB()
+        self.table = self.DEFAULT_STOCK_TABLE
+
+    def _stream_rows(self, database, where):
+        database.table = self.table
+        database.fields = self.DEFAULT_FIELDS
+        database.where = where
+        try:
+            for item_number, store_number, current_value, last_update in database.stream_query():
+                yield _get_row((item_number, store_number), (current_value, last_update))
+        finally:
+            # Ends the read transaction of the cursor
+            database.commit()
+
+    def _iter_rows(self, where):
+        if not self.pool:
+            yield from self._stream_rows(self.database, where)
+            return
+        with self.pool.database() as database:
+            yield from self._stream_rows(database, where)
+
+    def iter_store(self, store_number):
+        return self._iter_rows({'store_number': store_number})
+
+    def iter_item_stores(self, item_number):
+        return self._iter_rows({'item_number': item_number})
+
+    def get_item(self, store_number, item_number):
+        rows = list(self._iter_rows({'item_number': item_number, 'store_number': store_number}))
+        return rows[0] if rows else None
@@ -0,0 +1,279 @@
+import hashlib
+import multiprocessing
+import queue
+import signal
+import time
+
+from kafka_client.client import StockKafkaClient, StockKafkaClientException
+from kafka_client.codec import StockEventCodec, StockEventCodecException
+from kafka_client.partitioner import get_item_key
+from database.database import StockServiceDB
+from database.pool import StockServiceDBPool
+from .dedup import StockDedupFilter
+from .offsets import StockOffsetStore
+from .service import StockService, StockServiceException
+from tools.metrics import MetricsRegistry
+
+from tools import logger
+logger = logger.get_logger(__name__)
+
+
+FLUSH_SIGNAL = 'FLUSH'
+STOP_SIGNAL = 'STOP'
+REWARM_SIGNAL = 'REWARM'
+
+
+def get_worker_index(store_number, item_number, worker_count):
+    # The same (store_number, item_number) is always handled by the same worker, keeping per-item ordering.
+    # Not the crc32 of the partitioner: the keys of a partition share their crc32 modulo the partition count,
+    # so they would all go to the same few workers. A salted crc32 would not do either, crc32 is linear.
+    digest = hashlib.blake2b(get_item_key(store_number, item_number), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') % worker_count
+
+
+def run_worker(worker_id, worker_count, event_queue, ack_queue, database_config, batch_size, batch_timeout_ms,
+               cache_size, metrics_summary_interval_s, compaction=False, dedup_capacity=None, dedup_seed_days=None):
+    # Shutdown is driven by the dispatcher, so that offsets are committed only after the last batch
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    service = StockService(database=StockServiceDB(config=database_config))
+    service.cache.max_size = cache_size
+    service.compaction = compaction
+    service.dedup = StockDedupFilter(capacity=dedup_capacity, seed_days=dedup_seed_days)
+
+    def owns_key(key):
+        return get_worker_index(key[1], key[0], worker_count) == worker_id
+
+    # The stock cache is warmed once the partitions of the consumer are assigned, see REWARM_SIGNAL
+    service.seed_dedup(owns_key=owns_key)
+    # Also logged by the worker itself; the dispatcher serves them with its own after every flush
+    service.metrics.start_summary_log(metrics_summary_interval_s)
+    batch = []
+    while True:
+        try:
+            event = event_queue.get(timeout=batch_timeout_ms / 1000)
+        except queue.Empty:
+            event = None
+        if event not in (None, FLUSH_SIGNAL, STOP_SIGNAL, REWARM_SIGNAL):
+            batch.append(event)
+            if len(batch) < batch_size:
+                continue
+        if batch:
+            service.process_batch(batch)
+            batch = []
+        if event == REWARM_SIGNAL:
+            # Sent on every partition assignment: cached items of partitions that moved between consumers may
+            # have been written by another node, they would reject events on stale values
+            service.warm_stock_cache(owns_key=owns_key)
+        if event in (FLUSH_SIGNAL, STOP_SIGNAL):
+            ack_queue.put((worker_id, service.metrics.get_state()))
+        if event == STOP_SIGNAL:
+            break
+    service.database.close()
+    service.metrics.stop()
+    service.metrics.log_summary()
+    logger.info('Worker {} stopped. Updated items: {}; stock cache: {}'.format(
+        worker_id, service.updated_item_count, service.cache.get_stats()))
+
+
+class StockServiceWorkerPool:
+
+    DEFAULT_WORKER_COUNT = 4
+    DEFAULT_QUEUE_SIZE = 1000
+    DEFAULT_COMMIT_INTERVAL = 5000
+    DEFAULT_ACK_TIMEOUT_S = 1
+    DEFAULT_DATABASE_POOL_SIZE = 2
+
+    def __init__(self, worker_count=None, database_config=None, kafka_client=None):
+        self.worker_count = worker_count if worker_count else self.DEFAULT_WORKER_COUNT
+        self.database_config = database_config if database_config else StockServiceDB.DEFAULT_CONFIG
+        self.kafka_client = kafka_client
+        self.queue_size = self.DEFAULT_QUEUE_SIZE
+        self.commit_interval = self.DEFAULT_COMMIT_INTERVAL
+        self.batch_size = StockService.DEFAULT_BATCH_SIZE
+        self.batch_timeout_ms = StockService.DEFAULT_BATCH_TIMEOUT_MS
+        self.cache_size = StockService.DEFAULT_CACHE_SIZE
+        self.compaction = False
+        # Sized from the seeded events and seeded with the default days, unless set
+        self.dedup_capacity = None
+        self.dedup_seed_days = None
+        # Spawned workers do not inherit the Kafka client threads of the dispatcher
+        self.context = multiprocessing.get_context('spawn')
+        self.workers = []
+        self.event_queues = []
+        self.ack_queue = None
+        self.is_running = False
+        self.pending_events = 0
+        # {partition_id: last_offset} of the dispatched events, stored once the workers committed them
+        self.offsets = {}
+        self.offset_store = None
+        # Connections of the dispatcher: the offset store, and the offset reads of every rebalance
+        self.database_pool = None
+        self.codec = StockEventCodec()
+        self.metrics = MetricsRegistry()
+        self.metrics_port = None
+        self.metrics_summary_interval_s = MetricsRegistry.DEFAULT_SUMMARY_INTERVAL_S
+        self.lag_deadline = 0
+
+    def _get_worker_index(self, event):
+        try:
+            event_data = self.codec.decode(event)
+            return get_worker_index(event_data['store_number'], event_data['item_number'], self.worker_count)
+        except (StockEventCodecException, TypeError, KeyError):
+            return 0
+
+    def _start_workers(self):
+        self.ack_queue = self.context.Queue()
+        for worker_id in range(self.worker_count):
+            event_queue = self.context.Queue(maxsize=self.queue_size)
+            worker = self.context.Process(target=run_worker,
+                                          args=(worker_id,
+                                                self.worker_count,
+                                                event_queue,
+                                                self.ack_queue,
+                                                self.database_config,
+                                                self.batch_size,
+                                                self.batch_timeout_ms,
+                                                self.cache_size,
+                                                self.metrics_summary_interval_s,
+                                                self.compaction,
+                                                self.dedup_capacity,
+                                                self.dedup_seed_days),
+                                          name='stockservice-worker-{}'.format(worker_id))
+            worker.start()
+            self.event_queues.append(event_queue)
+            self.workers.append(worker)
+        logger.info('Started {} workers.'.format(self.worker_count))
+
+    def _put(self, worker_index, item):
+        while True:
+            try:
+                self.event_queues[worker_index].put(item, timeout=self.DEFAULT_ACK_TIMEOUT_S)
+                return
+            except queue.Full:
+                if not self.workers[worker_index].is_alive():
+                    raise StockServiceException('Worker stopped unexpectedly! Offsets are not committed.')
+
+    def _wait_for_workers(self, signal_name):
+        for worker_index in range(self.worker_count):
+            self._put(worker_index, signal_name)
+        acked_workers = set()
+        while len(acked_workers) < self.worker_count:
+            try:
+                worker_id, metrics_state = self.ack_queue.get(timeout=self.DEFAULT_ACK_TIMEOUT_S)
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in self.workers):
+                    raise StockServiceException('Worker stopped unexpectedly! Offsets are not committed.')
+                continue
+            acked_workers.add(worker_id)
+            # Served by the metrics endpoint of the dispatcher, as of the last flush of the worker
+            self.metrics.set_source_state(worker_id, metrics_state)
+
+    def _store_offsets(self):
+        # Written after every worker committed its batch: a crash in between replays events, which the
+        # events primary key rejects, it never skips any
+        if not self.offset_store or not self.offsets:
+            return
+        self.offset_store.database.autocommit = False
+        try:
+            self.offset_store.store(dict(self.offsets))
+            self.offset_store.database.commit()
+        except BaseException:
+            self.offset_store.database.rollback()
+            raise
+        finally:
+            self.offset_store.database.autocommit = True
+
+    def _rewarm_workers(self):
+        # Queued behind the events of the former partitions, ahead of the events of the new ones
+        for worker_index in range(self.worker_count):
+            self._put(worker_index, REWARM_SIGNAL)
+
+    def _get_database_pool(self):
+        if not self.database_pool:
+            self.database_pool = StockServiceDBPool(config=self.database_config, max_size=self.DEFAULT_DATABASE_POOL_SIZE)
+        return self.database_pool
+
+    def _get_rebalance_offsets(self, consumer, old_partition_offsets, new_partition_offsets):
+        # Called from the consumer thread, a separate connection keeps it out of the dispatcher transactions.
+        # It goes back to the pool, the next rebalance reuses it.
+        with self._get_database_pool().database() as database:
+            offsets = StockOffsetStore(database, self.kafka_client.consumer_group, self.kafka_client.topic).load()
+        # Partitions moved to another consumer are not written anymore, their new owner tracks them
+        for partition_id in set(self.offsets) - set(new_partition_offsets):
+            self.offsets.pop(partition_id, None)
+        self._rewarm_workers()
+        return {partition_id: last_offset for partition_id, last_offset in offsets.items()
+                if partition_id in new_partition_offsets}
+
+    def _update_consumer_lag(self):
+        now = time.monotonic()
+        if now < self.lag_deadline:
+            return
+        self.lag_deadline = now + StockService.DEFAULT_LAG_INTERVAL_S
+        try:
+            self.metrics.gauge('consumer_lag').set(self.kafka_client.get_consumer_lag())
+        except StockKafkaClientException as exc:
+            logger.warning(exc)
+
+    def _commit_offsets(self):
+        with self.metrics.timer('worker_flush'):
+            self._wait_for_workers(FLUSH_SIGNAL)
+        self._store_offsets()
+        self.kafka_client.commit_offsets()
+        self.pending_events = 0
+        logger.debug('Offsets committed.')
+
+    def _stop_workers(self):
+        self._wait_for_workers(STOP_SIGNAL)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        self.event_queues = []
+
+    def stop(self, *args):
+        self.is_running = False
+
+    def dispatch(self, event):
+        self._put(self._get_worker_index(event), event)
+        self.pending_events += 1
+        self.metrics.counter('events_dispatched').inc()
+        if self.pending_events >= self.commit_interval:
+            self._commit_offsets()
+
+    def run(self):
+        self._start_workers()
+        if not self.kafka_client:
+            self.kafka_client = StockKafkaClient()
+        try:
+            self.kafka_client.get_balanced_consumer(post_rebalance_callback=self._get_rebalance_offsets)
+        except StockKafkaClientException as exc:
+            logger.critical(exc)
+            self._stop_workers()
+            return
+        self.offset_store = StockOffsetStore(StockServiceDB(pool=self._get_database_pool()),
+                                             self.kafka_client.consumer_group, self.kafka_client.topic)
+        if self.metrics_port:
+            self.metrics.start_server(self.metrics_port)
+        self.metrics.start_summary_log(self.metrics_summary_interval_s)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        self.is_running = True
+        try:
+            while self.is_running:
+                message = self.kafka_client.consumer.consume(block=True)
+                self._update_consumer_lag()
+                if message is None:
+                    continue
+                self.offsets[message.partition_id] = message.offset
+                self.dispatch(message.value)
+            self._commit_offsets()
+            self._stop_workers()
+        finally:
+            for worker in self.workers:
+                worker.terminate()
+            self.kafka_client.consumer.stop()
+            self.offset_store.database.close()
+            self.database_pool.close()
+            self.metrics.stop()
+        logger.info('Worker pool stopped.')
@@ -0,0 +1,178 @@
+import asyncio
+import json
+from unittest import TestCase, mock
+import testing.postgresql
+import psycopg2
+
+from database.async_database import StockServiceAsyncDB
+from service.async_service import StockAsyncService
+from service.service import StockServiceException
+
+
+def init_test_db(postgresql):
+    conn = psycopg2.connect(**postgresql.dsn())
+    cursor = conn.cursor()
+    cursor.execute(
+        "CREATE TABLE events (transaction_id uuid NOT NULL, event_type VARCHAR, date TIMESTAMP NOT NULL, PRIMARY KEY (transaction_id, date), store_number INTEGER, item_number INTEGER, value INTEGER, inserted_at TIMESTAMP NOT NULL DEFAULT now());")
+    cursor.execute(
+        "CREATE TABLE event_ids (transaction_id uuid PRIMARY KEY);")
+    cursor.execute(
+        "INSERT INTO events values('7c71fb42-1f5e-45e1-be16-7d4d772d1aab', 'sale', '2018-12-03T23:57:40Z', 9, 12, 116)")
+    cursor.execute(
+        "INSERT INTO event_ids values('7c71fb42-1f5e-45e1-be16-7d4d772d1aab')")
+    cursor.execute(
+        "CREATE TABLE stock (item_number INTEGER NOT NULL, store_number INTEGER NOT NULL, PRIMARY KEY (item_number, store_number), current_value INTEGER, last_update TIMESTAMP);")
+    cursor.execute(
+        "INSERT INTO stock values(12, 9, 116, '2018-12-03T23:57:40Z')")
+    cursor.execute(
+        "CREATE TABLE consumer_offsets (consumer_group VARCHAR NOT NULL, topic VARCHAR NOT NULL, partition_id INTEGER NOT NULL, PRIMARY KEY (consumer_group, topic, partition_id), last_offset BIGINT);")
+    cursor.close()
+    conn.commit()
+    conn.close()
+
+
+Postgresql = testing.postgresql.PostgresqlFactory(cache_initialized_db=True,
+                                                  on_initialized=init_test_db)
+
+
+def tearDownModule():
+    Postgresql.clear_cache()
+
+
+class StockAsyncServiceTest(TestCase):
+
+    def setUp(self):
+        self.postgresql = Postgresql()
+        self.service = StockAsyncService(database=StockServiceAsyncDB(config=self.postgresql.dsn(), size=4),
+                                         kafka_client=mock.Mock(consumer_group=b'stockservice', topic='events'))
+
+    def _process(self, events):
+        async def _dispatch_all():
+            await self.service._start()
+            for event in events:
+                await self.service.dispatch(event)
+            await self.service._drain()
+        asyncio.run(_dispatch_all())
+
+    def _query(self, sql):
+        conn = psycopg2.connect(**self.postgresql.dsn())
+        cursor = conn.cursor()
+        cursor.execute(sql)
+        result = cursor.fetchall()
+        conn.close()
+        return result
+
+    def test_execute(self):
+        async def _execute():
+            await self.service.database.open()
+            rows, rowcount = await self.service.database.execute(
+                'SELECT current_value FROM stock WHERE item_number = %(item_number)s;', {'item_number': 12})
+            self.assertEqual((rows, rowcount), ([(116,)], 1))
+            rows, rowcount = await self.service.database.execute(
+                'SELECT current_value FROM stock WHERE item_number = %(item_number)s;', {'item_number': 999})
+            self.assertEqual((rows, rowcount), ([], 0))
+            with self.assertRaises(psycopg2.DataError):
+                await self.service.database.execute('SELECT %(value)s::integer;', {'value': 'abc'})
+            # The connection is still usable after a failed statement
+            rows, _ = await self.service.database.execute('SELECT count(*) FROM stock;')
+            self.assertEqual(rows, [(1,)])
+            self.assertEqual(len(self.service.database.connections), 4)
+        asyncio.run(_execute())
+
+    def test_transaction(self):
+        async def _transaction():
+            await self.service.database.open()
+            with self.assertRaises(psycopg2.DataError):
+                async with self.service.database.transaction() as transaction:
+                    await transaction.execute("UPDATE stock SET current_value = 0;")
+                    await transaction.execute('SELECT %(value)s::integer;', {'value': 'abc'})
+            async with self.service.database.transaction() as transaction:
+                await transaction.execute("UPDATE stock SET current_value = 1;")
+            self.assertEqual(len(self.service.database.connections), 4)
+        asyncio.run(_transaction())
+        # The failed transaction is rolled back as a whole
+        self.assertEqual(self._query("SELECT current_value from stock;"), [(1,)])
+
+    def test_dispatch_upsert_failure(self):
+        # A failed upsert does not leave its event behind: the replay is applied, not a duplicate
+        event = ('{"transaction_id": "ceb2c843-3cbb-42c2-9140-697ffc278ef8", "event_type": "incoming", '
+                 '"date": "2019-09-22T06:23:02Z", "store_number": "9", "item_number": "12", "value": "10"}')
+        with mock.patch.object(self.service, 'STOCK_UPSERT_SQL', 'SELECT 1 / 0;'):
+            with self.assertRaises(StockServiceException):
+                self._process([event])
+        self.assertEqual(self._query("SELECT count(*) from events;"), [(1,)])
+        self.service.errors = []
+        self._process([event])
+        self.assertEqual(self._query("SELECT current_value from stock WHERE item_number=12 AND store_number=9;"),
+                         [(126,)])
+
+    def test_dispatch(self):
+        events = ['{"transaction_id": "ceb2c843-3cbb-42c2-9140-697ffc278ef8", "event_type": "incoming", '
+                  '"date": "2019-09-22T06:23:02Z", "store_number": "9", "item_number": "12", "value": "10"}',
+                  # Duplicate
+                  '{"transaction_id": "ceb2c843-3cbb-42c2-9140-697ffc278ef8", "event_type": "incoming", '
+                  '"date": "2019-09-22T06:23:02Z", "store_number": "9", "item_number": "12", "value": "10"}',
+                  # Stale
+                  '{"transaction_id": "2aeb32d6-a39e-459f-a77b-d81df3a71a95", "event_type": "incoming", '
+                  '"date": "2018-12-13T19:21:59Z", "store_number": "9", "item_number": "12", "value": "125"}',
+                  # Out of stock
+                  '{"transaction_id": "1e6c4bb8-0e0e-4a30-9a3c-cfa3d0e31e3d", "event_type": "sale", '
+                  '"date": "2019-10-01T10:00:00Z", "store_number": "9", "item_number": "12", "value": "500"}',
+                  '{"transaction_id": "5ef4b5c8-1e51-47df-a1d4-8b3f0e2f6a10", "event_type": "sale", '
+                  '"date": "2019-10-02T10:00:00Z", "store_number": "9", "item_number": "12", "value": "26"}',
+                  '<note>That is not a JSON</note>']
+        self._process(events)
+        self.assertEqual(self._query("SELECT current_value from stock WHERE item_number=12 AND store_number=9;"),
+                         [(100,)])
+        self.assertEqual(self._query("SELECT count(*) from events;"), [(5,)])
+        self.assertEqual(self.service.updated_item_count, 2)
+        self.assertEqual(self.service.item_tasks, {})
+
+    def test_dispatch_order(self):
+        # Interleaved items: every sale is only possible after the incoming events before it
+        events = []
+        for item_number in range(1, 5):
+            for day in range(1, 21):
+                event_type = 'incoming' if day % 2 else 'sale'
+                transaction_id = '00000000-0000-4000-8000-{:06d}{:06d}'.format(item_number, day)
+                events.append(json.dumps({'transaction_id': transaction_id,
+                                          'event_type': event_type,
+                                          'date': '2019-10-{:02d}T10:00:00Z'.format(day),
+                                          'store_number': '1',
+                                          'item_number': str(item_number),
+                                          'value': '5'}))
+        events = [events[index] for item_offset in range(20) for index in range(item_offset, len(events), 20)]
+        self._process(events)
+        self.assertEqual(self._query("SELECT item_number, current_value from stock WHERE store_number=1 "
+                                     "ORDER BY item_number;"),
+                         [(1, 0), (2, 0), (3, 0), (4, 0)])
+        self.assertEqual(self.service.updated_item_count, 80)
+
+    def test_dispatch_failure(self):
+        events = ['{"transaction_id": "2aeb32d6-a39e-459f-a77b-d81df3a71a95", "event_type": "incoming", '
+                  '"date": "2019-09-22T06:23:02Z", "store_number": "9", "item_number": "12", "value": "10"}',
+                  '{"transaction_id": "ceb2c843-3cbb-42c2-9140-697ffc278ef8", "event_type": "incoming", '
+                  '"date": "2019-09-22T06:23:02Z", "store_number": "9", "item_number": "12", "value": "10"}']
+        with mock.patch.object(self.service, '_check_cached_item', side_effect=ValueError('Cache failure')):
+            with self.assertRaises(StockServiceException) as context:
+                self._process(events)
+        self.assertTrue('Offsets are not committed' in str(context.exception))
+        # The later event of the same item is not applied before the failed one
+        self.assertEqual(self._query("SELECT count(*) from events;"), [(1,)])
+
+    def test_commit_offsets(self):
+        async def _commit():
+            await self.service._start()
+            self.service.kafka_client.reset_offsets.assert_called_once_with({})
+            self.service.offsets = {0: 41, 1: 7}
+            await self.service._commit_offsets()
+            self.service.offsets = {0: 42}
+            await self.service._commit_offsets()
+            await self.service._start()
+            self.service.kafka_client.reset_offsets.assert_called_with({0: 42, 1: 7})
+        asyncio.run(_commit())
+        self.assertEqual(self.service.kafka_client.commit_offsets.call_count, 2)
+
+    def tearDown(self):
+        self.service.database.close()
+        self.postgresql.stop()
@@ -0,0 +1,147 @@
+import csv
+import json
+import os
+from unittest import TestCase, mock
+import testing.postgresql
+import psycopg2
+
+from database.database import StockServiceDB
+from importer.importer import StockImporter
+from importer.validator import StockRecordValidator
+from service.bulk import StockBulkLoader, StockBulkLoaderException
+from service.service import StockService
+
+
+def init_test_db(postgresql):
+    conn = psycopg2.connect(**postgresql.dsn())
+    cursor = conn.cursor()
+    cursor.execute(
+        "CREATE TABLE events (transaction_id uuid NOT NULL, event_type VARCHAR, date TIMESTAMP NOT NULL, PRIMARY KEY (transaction_id, date), store_number INTEGER, item_number INTEGER, value INTEGER, inserted_at TIMESTAMP NOT NULL DEFAULT now());")
+    cursor.execute(
+        "CREATE TABLE event_ids (transaction_id uuid PRIMARY KEY);")
+    cursor.execute(
+        "INSERT INTO events values('7c71fb42-1f5e-45e1-be16-7d4d772d1aab', 'sale', '2018-12-03T23:57:40Z', 9, 12, 116)")
+    cursor.execute(
+        "INSERT INTO event_ids values('7c71fb42-1f5e-45e1-be16-7d4d772d1aab')")
+    cursor.execute(
+        "CREATE TABLE stock (item_number INTEGER NOT NULL, store_number INTEGER NOT NULL, PRIMARY KEY (item_number, store_number), current_value INTEGER, last_update TIMESTAMP);")
+    cursor.execute(
+        "INSERT INTO stock values(12, 9, 116, '2018-12-03T23:57:40Z')")
+    cursor.close()
+    conn.commit()
+    conn.close()
+
+
+Postgresql = testing.postgresql.PostgresqlFactory(cache_initialized_db=True,
+                                                  on_initialized=init_test_db)
+
+
+def tearDownModule():
+    Postgresql.clear_cache()
+
+
+class StockBulkLoaderTest(TestCase):
+
+    FILENAMES = ['csv_all_incoming.csv', 'csv_sample_1.csv', 'csv_sample_1_mod.csv', 'csv_sample_3.csv']
+
+    def setUp(self):
+        self.postgresql = Postgresql()
+        self.test_bulk_db = StockServiceDB(config=self.postgresql.dsn())
+        self.loader = StockBulkLoader(database=self.test_bulk_db)
+
+    @staticmethod
+    def _get_rows(database, sql):
+        database.cursor.execute(sql)
+        return sorted(database.cursor.fetchall())
+
+    def _process_streaming(self, database):
+        service = StockService(database=database, kafka_client=mock.Mock())
+        validator = StockRecordValidator(config=StockImporter.DEFAULT_VALIDATOR_CONFIG)
+        for filename in self.FILENAMES:
+            with open(os.path.join(StockImporter.DEFAULT_INPUT_DIR, filename), 'r') as csv_file:
+                for record_line in csv.DictReader(csv_file, delimiter=StockImporter.DEFAULT_DELIMITER):
+                    if not validator.validate(record_line):
+                        continue
+                    service.event = json.dumps(record_line)
+                    service.process_event()
+        return service
+
+    def test_load(self):
+        report = self.loader.load(self.FILENAMES)
+        streaming_postgresql = Postgresql()
+        streaming_db = StockServiceDB(config=streaming_postgresql.dsn())
+        try:
+            service = self._process_streaming(streaming_db)
+            stock_sql = "SELECT item_number, store_number, current_value, last_update from stock;"
+            events_sql = "SELECT transaction_id, event_type, date, store_number, item_number, value from events;"
+            self.assertEqual(self._get_rows(self.test_bulk_db, stock_sql), self._get_rows(streaming_db, stock_sql))
+            self.assertEqual(self._get_rows(self.test_bulk_db, events_sql), self._get_rows(streaming_db, events_sql))
+            self.assertEqual(report['applied'], service.updated_item_count)
+        finally:
+            streaming_db.close()
+            streaming_postgresql.stop()
+        # csv_sample_1_mod repeats the valid transactions of csv_sample_1, one is already in the events table
+        self.assertEqual(report['duplicate'], 998)
+        self.assertEqual(report[StockBulkLoader.REASON_INVALID], 3)
+        self.assertEqual(report['rejected'], len(self.loader.rejected))
+        self.assertTrue(all(rejected[3] != StockService.REASON_APPLIED for rejected in self.loader.rejected))
+
+    def test_load_invalid(self):
+        self.loader.load(['csv_sample_3.csv'])
+        invalid_lines = [rejected for rejected in self.loader.rejected
+                         if rejected[3] == StockBulkLoader.REASON_INVALID]
+        self.assertEqual(len(invalid_lines), self.loader.report.get(StockBulkLoader.REASON_INVALID, 0))
+        for source_file, source_line, transaction_id, reason, message in invalid_lines:
+            self.assertEqual(source_file, 'csv_sample_3.csv')
+            self.assertTrue(message)
+
+    def test_load_rollback(self):
+        with self.assertRaises(FileNotFoundError):
+            self.loader.load(['csv_all_incoming.csv', 'missing.csv'])
+        self.assertEqual(self._get_rows(self.test_bulk_db, "SELECT count(*) from events;"), [(1,)])
+
+    def _apply_concurrently(self, sql):
+        # Runs sql on another connection while the loader folds the events
+        connection = psycopg2.connect(**self.postgresql.dsn())
+        connection.autocommit = True
+        apply_stock_rules = StockService.apply_stock_rules
+        errors = []
+
+        def _apply_stock_rules(*args):
+            if not errors:
+                try:
+                    connection.cursor().execute(sql)
+                    errors.append(None)
+                except psycopg2.Error as exc:
+                    errors.append(exc)
+            return apply_stock_rules(*args)
+        return connection, errors, mock.patch.object(StockService, 'apply_stock_rules', _apply_stock_rules)
+
+    def test_load_locks_items(self):
+        connection, errors, patch = self._apply_concurrently(
+            "SET lock_timeout = '100ms'; UPDATE stock SET current_value = 0 WHERE item_number = 12 AND store_number = 9;")
+        try:
+            with patch:
+                self.loader.load(['csv_all_incoming.csv'])
+        finally:
+            connection.close()
+        # The stored item is locked until the commit, the concurrent write waits instead of being overwritten
+        self.assertIsInstance(errors[0], psycopg2.errors.LockNotAvailable)
+
+    def test_load_new_item_conflict(self):
+        connection, errors, patch = self._apply_concurrently(
+            "INSERT INTO stock values(17, 6, 5, '2018-12-03T23:57:40Z');")
+        try:
+            with patch:
+                with self.assertRaises(StockBulkLoaderException):
+                    self.loader.load(['csv_all_incoming.csv'])
+        finally:
+            connection.close()
+        self.assertEqual(errors, [None])
+        self.assertEqual(self._get_rows(self.test_bulk_db, "SELECT count(*) from events;"), [(1,)])
+        self.assertEqual(self._get_rows(self.test_bulk_db, "SELECT current_value from stock WHERE item_number = 17;"),
+                         [(5,)])
+
+    def tearDown(self):
+        self.test_bulk_db.close()
+        self.postgresql.stop()
@@ -0,0 +1,38 @@
+from unittest import TestCase
+
+from service.cache import StockStateCache
+
+
+class StockStateCacheTest(TestCase):
+
+    def setUp(self):
+        self.cache = StockStateCache(max_size=2)
+
+    def test_get(self):
+        self.assertIsNone(self.cache.get((12, 9)))
+        self.cache.put((12, 9), (116, '2018-12-03T23:57:40Z'))
+        self.assertEqual(self.cache.get((12, 9)), (116, '2018-12-03T23:57:40Z'))
+        self.assertEqual(self.cache.get_stats(), {'size': 1, 'hits': 1, 'misses': 1, 'evictions': 0})
+
+    def test_put(self):
+        self.cache.put((1, 1), (1, None))
+        self.cache.put((2, 2), (2, None))
+        # The least recently used item is evicted
+        self.cache.get((1, 1))
+        self.cache.put((3, 3), (3, None))
+        self.assertIn((1, 1), self.cache)
+        self.assertNotIn((2, 2), self.cache)
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.evictions, 1)
+        disabled_cache = StockStateCache(max_size=0)
+        disabled_cache.put((1, 1), (1, None))
+        self.assertEqual(len(disabled_cache), 0)
+
+    def test_invalidate(self):
+        self.cache.put((1, 1), (1, None))
+        self.cache.invalidate((1, 1))
+        self.cache.invalidate((2, 2))
+        self.assertNotIn((1, 1), self.cache)
+        self.cache.put((1, 1), (1, None))
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
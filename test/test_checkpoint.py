@@ -0,0 +1,55 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from importer.checkpoint import StockImportCheckpoint
+
+
+class StockImportCheckpointTest(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.filepath = os.path.join(self.work_dir.name, 'drop.csv')
+        with open(self.filepath, 'w') as csv_file:
+            csv_file.write('transaction_id,value\n' + 'd2a531fa-a417-4983-ab7d-4bb1411c6250,1\n' * 10000)
+        self.checkpoint_path = os.path.join(self.work_dir.name, 'checkpoint.json')
+        self.checkpoint = StockImportCheckpoint(path=self.checkpoint_path)
+
+    def test_get_fingerprint(self):
+        fingerprint = StockImportCheckpoint.get_fingerprint(self.filepath)
+        self.assertEqual(fingerprint, StockImportCheckpoint.get_fingerprint(self.filepath))
+        with open(self.filepath, 'a') as csv_file:
+            csv_file.write('407f9c78-13a1-4745-a491-84c4bb09468c,2\n')
+        self.assertNotEqual(fingerprint, StockImportCheckpoint.get_fingerprint(self.filepath))
+
+    def test_advance(self):
+        self.checkpoint.start_file('drop.csv', self.filepath)
+        self.assertEqual(self.checkpoint.start_member('drop.csv', 'drop.csv'), (0, None, False))
+        self.checkpoint.add_mark('drop.csv', 'drop.csv', 10, 12, 500)
+        self.checkpoint.add_mark('drop.csv', 'drop.csv', 20, 24, 1000)
+        # Only the marks whose events are all delivered are recorded
+        self.checkpoint.advance(15)
+        self.assertEqual(StockImportCheckpoint(path=self.checkpoint_path).start_member('drop.csv', 'drop.csv'),
+                         (12, 500, False))
+        self.checkpoint.finish_member('drop.csv', 'drop.csv', 30, 1200, 19, False)
+        self.checkpoint.finish_file('drop.csv')
+        self.assertFalse(self.checkpoint.is_done('drop.csv', self.filepath))
+        self.assertEqual(self.checkpoint.start_member('drop.csv', 'drop.csv'), (12, 500, False))
+        self.checkpoint.finish_member('drop.csv', 'drop.csv', 30, 1200, 30, True)
+        self.assertTrue(StockImportCheckpoint(path=self.checkpoint_path).is_done('drop.csv', self.filepath))
+
+    def test_start_file(self):
+        self.checkpoint.start_file('drop.csv', self.filepath)
+        self.checkpoint.start_member('drop.csv', 'drop.csv')
+        self.checkpoint.finish_member('drop.csv', 'drop.csv', 10000, 100, 0, True)
+        self.checkpoint.finish_file('drop.csv')
+        self.assertTrue(self.checkpoint.is_done('drop.csv', self.filepath))
+        # A changed file starts over
+        with open(self.filepath, 'a') as csv_file:
+            csv_file.write('407f9c78-13a1-4745-a491-84c4bb09468c,2\n')
+        self.assertFalse(self.checkpoint.is_done('drop.csv', self.filepath))
+        self.checkpoint.start_file('drop.csv', self.filepath)
+        self.assertEqual(self.checkpoint.start_member('drop.csv', 'drop.csv'), (0, None, False))
+
+    def tearDown(self):
+        self.work_dir.cleanup()
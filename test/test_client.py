@@ -1,8 +1,9 @@
 from pykafka.client import KafkaClient
 from pykafka.protocol.message import Message
 from pykafka.simpleconsumer import SimpleConsumer
-from unittest import TestCase
+from unittest import TestCase, mock
 import os
+import queue
 
 from kafka_client.client import StockKafkaClient, StockKafkaClientException
 
@@ -50,6 +51,79 @@ class StockKafkaClientTest(TestCase):
             self.kafka.send_event(dummy_event)
         self.assertTrue('No broker available!' in str(context.exception))
 
+    def test_delivery_reports(self):
+        self.kafka.client = mock.Mock()
+        self.kafka.producer = mock.Mock()
+        sent_message = mock.Mock()
+        failed_message = mock.Mock()
+        self.kafka.producer.produce.side_effect = [sent_message, failed_message]
+        self.kafka.producer.get_delivery_report.side_effect = [queue.Empty,
+                                                               (sent_message, None),
+                                                               (failed_message, Exception('Delivery failed')),
+                                                               queue.Empty]
+        self.kafka.send_event({"transaction_id": "8947695b-7f19-44b6-96b6-7f8ed041fe57"})
+        self.kafka.send_event({"transaction_id": "7c71fb42-1f5e-45e1-be16-7d4d772d1aab"})
+        producer = self.kafka.producer
+        self.kafka.flush()
+        producer.stop.assert_called_once()
+        self.assertIsNone(self.kafka.producer)
+        failed_events = self.kafka.get_delivery_failures()
+        self.assertEqual(len(failed_events), 1)
+        self.assertEqual(failed_events[0][0], "7c71fb42-1f5e-45e1-be16-7d4d772d1aab")
+        self.assertEqual(self.kafka.get_delivery_failures(), [])
+
+    def test_send_event_partition_key(self):
+        self.kafka.client = mock.Mock()
+        self.kafka.producer = mock.Mock()
+        self.kafka.producer.get_delivery_report.side_effect = queue.Empty
+        self.kafka.send_event({"transaction_id": "8947695b-7f19-44b6-96b6-7f8ed041fe57",
+                               "store_number": "9",
+                               "item_number": "12"})
+        self.assertEqual(self.kafka.producer.produce.call_args.kwargs['partition_key'], b'9:12')
+
+    def test_get_acknowledged_count(self):
+        self.kafka.client = mock.Mock()
+        self.kafka.producer = mock.Mock()
+        messages = [mock.Mock(), mock.Mock(), mock.Mock()]
+        self.kafka.producer.produce.side_effect = messages
+        self.kafka.producer.get_delivery_report.side_effect = [queue.Empty,
+                                                               queue.Empty,
+                                                               queue.Empty,
+                                                               (messages[1], None),
+                                                               queue.Empty,
+                                                               (messages[0], None),
+                                                               (messages[2], Exception('Delivery failed')),
+                                                               queue.Empty]
+        for _ in messages:
+            self.kafka.send_event({"transaction_id": "8947695b-7f19-44b6-96b6-7f8ed041fe57"})
+        # The second event is delivered, but the first one is still pending
+        self.assertEqual(self.kafka.get_acknowledged_count(), 0)
+        self.assertEqual(self.kafka.get_acknowledged_count(), 2)
+        self.kafka.get_delivery_failures()
+        self.assertEqual(self.kafka.get_acknowledged_count(), 3)
+
+    def test_reset_offsets(self):
+        with self.assertRaises(StockKafkaClientException):
+            self.kafka.reset_offsets({0: 10})
+        partitions = {0: mock.Mock(), 1: mock.Mock()}
+        self.kafka.consumer = mock.Mock(partitions=partitions)
+        # Partitions not owned by the consumer are ignored
+        self.kafka.reset_offsets({1: 10, 5: 20})
+        self.kafka.consumer.reset_offsets.assert_called_once_with(partition_offsets=[(partitions[1], 10)])
+        self.kafka.consumer.reset_offsets.reset_mock()
+        self.kafka.reset_offsets({})
+        self.kafka.consumer.reset_offsets.assert_not_called()
+
+    def test_get_consumer_lag(self):
+        with self.assertRaises(StockKafkaClientException):
+            self.kafka.get_consumer_lag()
+        self.kafka.client = mock.MagicMock()
+        self.kafka.client.topics[self.kafka.topic].latest_available_offsets.return_value = {
+            0: mock.Mock(offset=[100]), 1: mock.Mock(offset=[50])}
+        # Nothing consumed yet from partition 1
+        self.kafka.consumer = mock.Mock(held_offsets={0: 89, 1: -2})
+        self.assertEqual(self.kafka.get_consumer_lag(), 60)
+
     def test_get_consumer(self):
         self.kafka.host = '127.0.0.1:9092'
         self.kafka._set_host()
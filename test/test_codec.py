@@ -0,0 +1,45 @@
+import datetime
+from unittest import TestCase
+
+from kafka_client.codec import StockEventCodec, StockEventCodecException
+
+
+class StockEventCodecTest(TestCase):
+
+    def setUp(self):
+        self.codec = StockEventCodec(StockEventCodec.BINARY_FORMAT)
+        self.event = {'transaction_id': '7c71fb42-1f5e-45e1-be16-7d4d772d1aab',
+                      'event_type': 'sale',
+                      'date': '2018-12-03T23:57:40Z',
+                      'store_number': '9',
+                      'item_number': '12',
+                      'value': '116'}
+
+    def test_encode(self):
+        encoded_event = self.codec.encode(self.event)
+        self.assertEqual(len(encoded_event), 38)
+        self.assertLess(len(encoded_event) * 3, len(StockEventCodec.encode_json(self.event)))
+        self.assertEqual(self.codec.decode(encoded_event), {'transaction_id': '7c71fb42-1f5e-45e1-be16-7d4d772d1aab',
+                                                            'event_type': 'sale',
+                                                            'date': datetime.datetime(2018, 12, 3, 23, 57, 40),
+                                                            'store_number': 9,
+                                                            'item_number': 12,
+                                                            'value': 116})
+        # Events out of the schema are sent as JSON
+        for field, value in [('event_type', 'Sale'), ('date', '2018-12-03 23:57:40+01:00'), ('value', str(2 ** 31))]:
+            event = dict(self.event, **{field: value})
+            self.assertEqual(self.codec.encode(event), StockEventCodec.encode_json(event))
+        self.assertEqual(StockEventCodec().encode(self.event), StockEventCodec.encode_json(self.event))
+        with self.assertRaises(StockEventCodecException):
+            StockEventCodec('xml')
+
+    def test_decode(self):
+        json_event = StockEventCodec.encode_json(self.event)
+        self.assertEqual(self.codec.decode(json_event), self.event)
+        self.assertEqual(self.codec.decode(json_event.decode('utf-8')), self.event)
+        with self.assertRaises(StockEventCodecException) as context:
+            self.codec.decode(self.codec.encode(self.event)[:20])
+        self.assertTrue('not a valid binary event' in str(context.exception))
+        with self.assertRaises(StockEventCodecException) as context:
+            self.codec.decode(b'\xff\xfe')
+        self.assertTrue('not a valid JSON' in str(context.exception))
@@ -0,0 +1,58 @@
+from unittest import TestCase, mock
+import io
+
+from importer.columnar import StockColumnarValidator
+from importer.importer import StockImporter
+from importer.validator import StockRecordValidator
+
+
+class StockColumnarValidatorTest(TestCase):
+
+    def setUp(self):
+        self.row_validator = StockRecordValidator(config=StockImporter.DEFAULT_VALIDATOR_CONFIG)
+        self.validator = StockColumnarValidator(self.row_validator)
+        self.header = ['transaction_id', 'event_type', 'date', 'store_number', 'item_number', 'value']
+
+    def test_check_columns(self):
+        self.assertEqual(list(self.validator._check_uuid_column(['7c71fb42-1f5e-45e1-be16-7d4d772d1aab',
+                                                                 '7c71fb42-1f5e-45e1-be16-7d4d772d1aabc',
+                                                                 '7c71fb42+1f5e-45e1-be16-7d4d772d1aab'])),
+                         [True, False, False])
+        self.assertEqual(list(self.validator._check_datetime_column(['2018-12-03T23:57:40Z',
+                                                                     '2019-02-29T23:57:40Z',
+                                                                     '2020-02-29T23:57:40Z',
+                                                                     '2018-12-03 23:57:40'])),
+                         [True, False, True, False])
+        self.assertEqual(list(self.validator._check_integer_column(['116', '-4', '-', '1.5', ''])),
+                         [True, True, False, False, False])
+
+    def test_validate_block(self):
+        rows = [['7c71fb42-1f5e-45e1-be16-7d4d772d1aab', 'sale', '2018-12-03T23:57:40Z', '9', '8', '116'],
+                ['notanuuid', 'sale', '2018-12-03T23:57:40Z', '9', '8', '116'],
+                ['a1c66bf0-b6c3-40d2-b82b-bb29f655ed46', 'broken', '2019-08-11T00:35:56Z', '2', '22', '148'],
+                # Accepted by the row rules only
+                ['a1c66bf0-b6c3-40d2-b82b-bb29f655ed46', 'Incoming', '2019-08-11 00:35:56', '2', '22', '148'],
+                ['2aeb32d6-a39e-459f-a77b-d81df3a71a95', 'sale', '2018-12-13T19:21:59Z', '8', '', '125'],
+                ['2aeb32d6-a39e-459f-a77b-d81df3a71a95', 'sale', '2018-12-13T19:21:59Z', '8', '8']]
+        is_valid, reasons = self.validator.validate_block(self.header, rows)
+        self.assertEqual(list(is_valid), [True, False, False, True, False, False])
+        self.assertEqual(reasons, {1: 'Not a valid UUID: "notanuuid"',
+                                   2: '"broken" is not a valid choice from: "[\'incoming\', \'sale\']"',
+                                   4: 'No value for item_number',
+                                   5: 'No value for value'})
+
+    def test_iter_blocks(self):
+        self.validator.block_size = 2
+        csv_file = io.StringIO('a,b\n1,2\n\n3,4\n5,6\n')
+        self.assertEqual(list(self.validator.iter_blocks(csv_file, ',')),
+                         [(['a', 'b'], [['1', '2'], ['3', '4']]), (['a', 'b'], [['5', '6']])])
+
+    def test_process(self):
+        importer = StockImporter()
+        importer.kafka_client = mock.MagicMock()
+        importer.engine = importer.COLUMNAR_ENGINE
+        importer.filename = 'csv_sample_1_mod.csv'
+        importer.process()
+        self.assertEqual(importer.summaries['csv_sample_1_mod.csv']['processed_lines'], 1000)
+        self.assertEqual(importer.summaries['csv_sample_1_mod.csv']['validated_lines'], 997)
+        self.assertEqual(importer.kafka_client.send_event.call_count, 997)
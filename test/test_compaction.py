@@ -0,0 +1,32 @@
+import datetime
+from unittest import TestCase
+
+from service.compaction import StockEventCompactor
+from service.service import StockService
+
+
+class StockEventCompactorTest(TestCase):
+
+    def setUp(self):
+        self.compactor = StockEventCompactor(StockService.apply_stock_rules)
+        self.date = datetime.datetime(2019, 9, 22, 6, 0)
+
+    def test_fold(self):
+        events = [((12, 9), 'incoming', 1, 10, 'a'),
+                  ((12, 9), 'sale', 2, 200, 'b'),
+                  ((13, 9), 'sale', 1, 1, 'c'),
+                  ((12, 9), 'sale', 3, 26, 'd'),
+                  ((12, 9), 'incoming', 0, 5, 'e'),
+                  ((14, 9), 'incoming', 1, 5, 'f'),
+                  ((15, 9), 'sale', 1, 50, 'g')]
+        for item_key, event_type, minutes, value, name in events:
+            self.compactor.add(item_key, event_type, self.date + datetime.timedelta(minutes=minutes), value, event=name)
+        self.assertEqual(len(self.compactor), 7)
+        self.assertEqual(self.compactor.get_item_keys(), [(12, 9), (13, 9), (14, 9), (15, 9)])
+        results, changed_states = self.compactor.fold({(12, 9): (116, self.date), (15, 9): (10, self.date)})
+        # The running value is checked per event: the large sale is rejected, the later one applied
+        self.assertEqual(results, [('a', 'applied'), ('b', 'out_of_stock'), ('d', 'applied'), ('e', 'stale'),
+                                   ('c', 'no_item'), ('f', 'applied'), ('g', 'out_of_stock')])
+        self.assertEqual(changed_states, {(12, 9): (100, self.date + datetime.timedelta(minutes=3)),
+                                          (14, 9): (5, self.date + datetime.timedelta(minutes=1))})
+        self.assertEqual(len(self.compactor), 0)
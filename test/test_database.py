@@ -50,6 +50,17 @@ class StockServiceDBTest(TestCase):
         self.db.query()
         self.assertEqual(self.db.query_result, raw_result[0])
 
+    def test_stream_query(self):
+        self.db.cursor.execute("INSERT INTO events values('8947695b-7f19-44b6-96b6-7f8ed041fe57', 'incoming', "
+                               "'2019-04-14T03:47:13Z', 9, 13, 400)")
+        self.db.commit()
+        self.db.fields = ['item_number']
+        self.db.table = 'events'
+        self.db.where = {'store_number': 9}
+        self.assertEqual(sorted(self.db.stream_query(batch_size=1)), [(12,), (13,)])
+        self.db.where = {'store_number': 1}
+        self.assertEqual(list(self.db.stream_query()), [])
+
     def test_insert(self):
         transaction_id = '8947695b-7f19-44b6-96b6-7f8ed041fe57'
         self.db.table = 'events'
@@ -89,5 +100,64 @@ class StockServiceDBTest(TestCase):
         raw_result = self.db.cursor.fetchone()
         self.assertEqual(raw_result[0], update_value)
 
+    def test_to_prepared(self):
+        prepared_sql, parameters = self.db._to_prepared('SELECT * from stock WHERE item_number=%s AND store_number=%s;')
+        self.assertEqual(prepared_sql, 'SELECT * from stock WHERE item_number=$1 AND store_number=$2;')
+        self.assertEqual(parameters, [0, 1])
+        prepared_sql, parameters = self.db._to_prepared('SELECT %(value)s::integer + %(delta)s::integer, %(value)s;')
+        self.assertEqual(prepared_sql, 'SELECT $1::integer + $2::integer, $1;')
+        self.assertEqual(parameters, ['value', 'delta'])
+
+    def test_prepared_statements(self):
+        self.db.table = 'events'
+        self.db.fields = ['transaction_id', 'value']
+        self.db.where = {'store_number': 9}
+        self.db.query()
+        self.assertEqual(self.db.query_result[1], 116)
+        self.db.where = {'store_number': 10}
+        self.db.query()
+        self.assertEqual(self.db.query_result, [])
+        # Same table, fields and where-shape reuse one statement
+        self.assertEqual(len(self.db.statements), 1)
+        self.db.fields = ['value', 'store_number']
+        self.db.values = [120, 9]
+        self.db.where = {'transaction_id': '7c71fb42-1f5e-45e1-be16-7d4d772d1aab'}
+        self.db.update()
+        self.assertEqual(len(self.db.statements), 2)
+        self.db.cursor.execute("SELECT value, store_number from events WHERE store_number=9;")
+        self.assertEqual(self.db.cursor.fetchone(), (120, 9))
+        self.db.execute('SELECT count(*) from events WHERE value > %(value)s;', {'value': 100})
+        self.assertEqual(self.db.query_result, [(1,)])
+
+    def test_transaction(self):
+        transaction_id = 'a1c66bf0-b6c3-40d2-b82b-bb29f655ed46'
+        self.db.autocommit = False
+        self.db.table = 'events'
+        self.db.fields = ['transaction_id',
+                          'event_type',
+                          'date',
+                          'store_number',
+                          'item_number',
+                          'value']
+        self.db.values = [transaction_id,
+                          'incoming',
+                          '2019-08-11T00:35:56Z',
+                          '2',
+                          '22',
+                          '148'
+                          ]
+        self.db.insert()
+        # Duplicate does not abort the open transaction
+        with self.assertRaises(StockServiceDBException) as context:
+            self.db.insert()
+        self.assertTrue('Insert failed' in str(context.exception))
+        raw_sql = "SELECT transaction_id from events WHERE transaction_id='{}';".format(transaction_id)
+        self.db.cursor.execute(raw_sql)
+        self.assertEqual(self.db.cursor.fetchone()[0], transaction_id)
+        self.db.rollback()
+        self.db.cursor.execute(raw_sql)
+        self.assertIsNone(self.db.cursor.fetchone())
+
     def tearDown(self):
+        self.db.close()
         self.postgresql.stop()
@@ -0,0 +1,62 @@
+from unittest import TestCase, mock
+import uuid
+
+from service.dedup import StockDedupFilter
+
+
+class StockDedupFilterTest(TestCase):
+
+    def setUp(self):
+        self.dedup = StockDedupFilter(capacity=1000, error_rate=0.01, recent_size=2)
+
+    def test_check(self):
+        self.assertIsNone(self.dedup.check('7c71fb42-1f5e-45e1-be16-7d4d772d1aab'))
+        self.dedup.add('7C71FB42-1F5E-45E1-BE16-7D4D772D1AAB')
+        self.assertEqual(self.dedup.check('7c71fb42-1f5e-45e1-be16-7d4d772d1aab'), StockDedupFilter.DUPLICATE)
+        # Out of the recent ids, only the bloom filter knows it
+        self.dedup.add('ceb2c843-3cbb-42c2-9140-697ffc278ef8')
+        self.dedup.add('407f9c78-13a1-4745-a491-84c4bb09468c')
+        self.assertEqual(self.dedup.check('7c71fb42-1f5e-45e1-be16-7d4d772d1aab'),
+                         StockDedupFilter.PROBABLE_DUPLICATE)
+        self.assertEqual(self.dedup.get_stats(), {'size': 3,
+                                                  'recent': 2,
+                                                  'duplicates': 1,
+                                                  'probable_duplicates': 1,
+                                                  'false_positives': 0})
+
+    def test_error_rate(self):
+        for _ in range(1000):
+            self.dedup.add(uuid.uuid4())
+        false_positives = sum(1 for _ in range(10000) if self.dedup.check(uuid.uuid4()))
+        self.assertLess(false_positives, 300)
+
+    def test_seed(self):
+        database = mock.Mock()
+        database.stream.return_value = [('7c71fb42-1f5e-45e1-be16-7d4d772d1aab', 12, 9),
+                                        ('ceb2c843-3cbb-42c2-9140-697ffc278ef8', 13, 9)]
+        self.assertEqual(self.dedup.seed(database, 'events', owns_key=lambda key: key == (12, 9)), 1)
+        self.assertEqual(self.dedup.check('7c71fb42-1f5e-45e1-be16-7d4d772d1aab'), StockDedupFilter.DUPLICATE)
+        self.assertIsNone(self.dedup.check('ceb2c843-3cbb-42c2-9140-697ffc278ef8'))
+        # Only the recent events are read, a configured capacity is kept
+        self.assertIn("WHERE inserted_at >= now() - interval '7 days'", database.stream.call_args.args[0])
+        database.execute.assert_not_called()
+        self.assertEqual(self.dedup.capacity, 1000)
+
+    def test_seed_capacity(self):
+        database = mock.Mock()
+        database.query_result = [(5000000,)]
+        database.stream.return_value = []
+        dedup = StockDedupFilter(seed_days=30)
+        dedup.seed(database, 'events')
+        self.assertEqual(dedup.capacity, 10000000)
+        self.assertIn("interval '30 days'", database.stream.call_args.args[0])
+
+    def test_saturated(self):
+        dedup = StockDedupFilter(capacity=10, recent_size=2)
+        transaction_ids = [str(uuid.uuid4()) for _ in range(11)]
+        for transaction_id in transaction_ids:
+            dedup.add(transaction_id)
+        self.assertTrue(dedup.is_saturated())
+        # The bloom filter is skipped, the insert catches the older ids
+        self.assertIsNone(dedup.check(transaction_ids[0]))
+        self.assertEqual(dedup.check(transaction_ids[-1]), StockDedupFilter.DUPLICATE)
@@ -1,6 +1,12 @@
+import os
+import shutil
+import tempfile
 from unittest import TestCase, mock
 
+from importer.checkpoint import StockImportCheckpoint
 from importer.importer import StockImporter, StockImporterException
+from kafka_client.client import StockKafkaClientException
+from kafka_client.partitioner import StockPartitioner
 
 
 class StockImporterTest(TestCase):
@@ -33,18 +39,71 @@ class StockImporterTest(TestCase):
         self.importer._set_filepath()
         self.importer.process()
         self.assertEqual(self.importer.processed_lines, 1000)
-        # Invalid file
+        self.assertEqual(self.importer.failed_lines, 0)
+        # Compressed file
         self.importer.filename = 'csv_all_incoming.zip'
         self.importer._set_filepath()
-        with self.assertRaises(StockImporterException) as context:
-            self.importer.process()
+        self.importer.process()
+        self.assertEqual(self.importer.processed_lines, 1000)
+        self.assertEqual(self.importer.summaries['csv_all_incoming.zip/csv_all_incoming.csv']['processed_lines'], 1000)
+        # Invalid file
+        with tempfile.TemporaryDirectory() as input_dir:
+            with open(os.path.join(input_dir, 'csv_invalid.csv.gz'), 'wb') as invalid_file:
+                invalid_file.write(b'transaction_id,event_type\n\xff\xfe')
+            self.importer.input_dir = input_dir
+            self.importer.filename = 'csv_invalid.csv.gz'
+            self.importer._set_filepath()
+            with self.assertRaises(StockImporterException) as context:
+                self.importer.process()
         self.assertTrue('Cannot process file' in str(context.exception))
 
+    def test_process_checkpoint(self):
+        sent_ids = []
+        broker_state = {'is_down': True}
+        kafka_client = mock.Mock(sent_count=0, partitioner=StockPartitioner())
+
+        def _send_event(event):
+            # The broker goes down after 450 events
+            if broker_state['is_down'] and len(sent_ids) == 450:
+                raise StockKafkaClientException('Cannot send event!')
+            sent_ids.append(event['transaction_id'])
+            kafka_client.sent_count += 1
+
+        kafka_client.send_event.side_effect = _send_event
+        kafka_client.get_acknowledged_count.side_effect = lambda: kafka_client.sent_count
+        kafka_client.get_delivery_failures.return_value = []
+        self.importer.kafka_client = kafka_client
+        with tempfile.TemporaryDirectory() as input_dir:
+            shutil.copy('samples/csv_sample_1.csv', input_dir)
+            self.importer.input_dir = input_dir
+            self.importer.checkpoint = StockImportCheckpoint(path=os.path.join(input_dir, 'checkpoint.json'))
+            self.importer.checkpoint.interval = 100
+            self.importer.filename = 'csv_sample_1.csv'
+            self.importer.process()
+            self.assertEqual(len(sent_ids), 450)
+            # The restart resumes after the last checkpoint before the failure
+            broker_state['is_down'] = False
+            self.importer.process()
+            self.assertEqual(self.importer.summaries['csv_sample_1.csv'],
+                             {'validated_lines': 600, 'processed_lines': 600, 'failed_lines': 0, 'partition_key': 'item',
+                              'resumed_lines': 400})
+            self.assertEqual(len(sent_ids), 1050)
+            with open('samples/csv_sample_1.csv') as csv_file:
+                file_ids = [line.split(',')[0] for line in csv_file.readlines()[1:]]
+            self.assertEqual(sent_ids[:450], file_ids[:450])
+            self.assertEqual(sent_ids[450:], file_ids[400:])
+            # Imported files are skipped
+            self.importer.process()
+            self.assertEqual(self.importer.summaries['csv_sample_1.csv'], {'skipped': True})
+            self.assertEqual(len(sent_ids), 1050)
+
     def test_get_files(self):
         file_list = ['csv_all_incoming.csv',
                      'csv_sample_1_mod.csv',
                      'csv_sample_3.csv',
                      'csv_sample_1.csv',
                      'all_csv_merged.csv',
-                     'csv_sample_2.csv']
-        self.assertEqual(self.importer.get_files(), file_list)
+                     'csv_sample_2.csv',
+                     'csv_all_incoming.zip']
+        # The order of os.listdir depends on the file system
+        self.assertCountEqual(self.importer.get_files(), file_list)
@@ -0,0 +1,104 @@
+import datetime
+import os
+import tempfile
+from unittest import TestCase
+
+import testing.postgresql
+import psycopg2
+
+from scripts.init_db import InitStockDB
+
+
+Postgresql = testing.postgresql.PostgresqlFactory(cache_initialized_db=True)
+
+
+def tearDownModule():
+    Postgresql.clear_cache()
+
+
+class InitStockDBTest(TestCase):
+
+    def setUp(self):
+        self.postgresql = Postgresql()
+        self.init_db = InitStockDB()
+        self.init_db.db_conn = psycopg2.connect(**self.postgresql.dsn())
+        self.init_db.cursor = self.init_db.db_conn.cursor()
+        self.init_db.months_ahead = 1
+        self.init_db.create_tables()
+        self.this_month = InitStockDB._get_month(datetime.date.today())
+
+    def tearDown(self):
+        self.init_db.db_conn.close()
+        self.postgresql.stop()
+
+    def _insert_event(self, transaction_id, date):
+        self.init_db.cursor.execute(
+            "INSERT INTO events VALUES (%s, 'incoming', %s, 1, 1, 10);", (transaction_id, date))
+        self.init_db.db_conn.commit()
+
+    def _count(self, table_name):
+        self.init_db.cursor.execute('SELECT count(*) FROM {};'.format(table_name))
+        return self.init_db.cursor.fetchone()[0]
+
+    def test_add_months(self):
+        self.assertEqual(InitStockDB._add_months(datetime.date(2019, 11, 1), 3), datetime.date(2020, 2, 1))
+        self.assertEqual(InitStockDB._add_months(datetime.date(2019, 1, 1), -1), datetime.date(2018, 12, 1))
+
+    def test_create_tables(self):
+        partitions = self.init_db.get_partitions('events')
+        self.assertEqual(sorted(partitions), [self.this_month, InitStockDB._add_months(self.this_month, 1)])
+        self.init_db.cursor.execute("SELECT indexname FROM pg_indexes WHERE tablename = %s;",
+                                    (partitions[self.this_month],))
+        index_names = [index_name for index_name, in self.init_db.cursor.fetchall()]
+        self.assertEqual(len(index_names), 3)
+        # Reruns keep the tables and the partitions
+        self.init_db.create_tables()
+        self.assertEqual(self.init_db.get_partitions('events'), partitions)
+
+    def test_create_partitions_moves_default_rows(self):
+        self._insert_event('0a3e1bb1-a0b8-4a2d-b7d2-7e0b8a0a6d01', datetime.datetime(2019, 8, 31, 23, 59))
+        self._insert_event('0a3e1bb1-a0b8-4a2d-b7d2-7e0b8a0a6d02', datetime.datetime(2019, 9, 1))
+        self.assertEqual(self._count('events_default'), 2)
+        self.init_db.create_partitions('events', start=datetime.date(2019, 8, 15), end=datetime.date(2019, 8, 1))
+        self.assertEqual(self._count('events_2019_08'), 1)
+        self.assertEqual(self._count('events_default'), 1)
+        self.assertEqual(self._count('events'), 2)
+
+    def test_same_transaction_id(self):
+        date = datetime.datetime(2019, 9, 1)
+        self._insert_event('0a3e1bb1-a0b8-4a2d-b7d2-7e0b8a0a6d01', date)
+        with self.assertRaises(psycopg2.errors.UniqueViolation):
+            self._insert_event('0a3e1bb1-a0b8-4a2d-b7d2-7e0b8a0a6d01', date)
+        self.init_db.db_conn.rollback()
+        # Ids are unique on their own, whatever the date of the event
+        self.init_db.cursor.execute("INSERT INTO event_ids VALUES ('0a3e1bb1-a0b8-4a2d-b7d2-7e0b8a0a6d01');")
+        with self.assertRaises(psycopg2.errors.UniqueViolation):
+            self.init_db.cursor.execute("INSERT INTO event_ids VALUES ('0a3e1bb1-a0b8-4a2d-b7d2-7e0b8a0a6d01');")
+        self.init_db.db_conn.rollback()
+
+    def test_fill_id_table(self):
+        self._insert_event('0a3e1bb1-a0b8-4a2d-b7d2-7e0b8a0a6d01', datetime.datetime(2019, 9, 1))
+        self.init_db.cursor.execute('DROP TABLE event_ids;')
+        self.init_db.db_conn.commit()
+        self.init_db.create_tables()
+        self.assertEqual(self._count('event_ids'), 1)
+
+    def test_drop_partitions(self):
+        self.init_db.create_partitions('events', start=datetime.date(2019, 7, 1), end=datetime.date(2019, 8, 1))
+        self._insert_event('0a3e1bb1-a0b8-4a2d-b7d2-7e0b8a0a6d01', datetime.datetime(2019, 7, 10))
+        self._insert_event('0a3e1bb1-a0b8-4a2d-b7d2-7e0b8a0a6d02', datetime.datetime(2019, 8, 10))
+        with tempfile.TemporaryDirectory() as export_dir:
+            dropped = self.init_db.drop_partitions('events', datetime.date(2019, 8, 1), export_dir=export_dir)
+            self.assertEqual(dropped, ['events_2019_07'])
+            with open(os.path.join(export_dir, 'events_2019_07.csv')) as export_file:
+                lines = export_file.read().splitlines()
+        self.assertEqual(lines[0], 'transaction_id,event_type,date,store_number,item_number,value,inserted_at')
+        self.assertTrue(lines[1].startswith('0a3e1bb1-a0b8-4a2d-b7d2-7e0b8a0a6d01,incoming,2019-07-10'))
+        self.assertNotIn(datetime.date(2019, 7, 1), self.init_db.get_partitions('events'))
+        self.assertEqual(self._count('events'), 1)
+
+    def test_not_partitioned(self):
+        self.init_db.cursor.execute('CREATE TABLE legacy_events (transaction_id uuid PRIMARY KEY);')
+        self.init_db.db_conn.commit()
+        self.assertFalse(self.init_db.is_partitioned('legacy_events'))
+        self.assertTrue(self.init_db.is_partitioned('events'))
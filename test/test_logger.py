@@ -0,0 +1,38 @@
+import logging
+from unittest import TestCase, mock
+
+from tools import logger
+
+
+class LoggerTest(TestCase):
+
+    def test_get_logger(self):
+        test_logger = logger.get_logger('test.logger')
+        self.assertIs(logger.get_logger('test.logger'), test_logger)
+        self.assertEqual(len(test_logger.handlers), 1)
+        self.assertIsInstance(test_logger.handlers[0], logging.handlers.QueueHandler)
+        # Every logger shares the same queue
+        self.assertIs(logger.get_logger('test.other').handlers[0], test_logger.handlers[0])
+
+    def test_sampled_logger(self):
+        test_logger = mock.Mock()
+        test_logger.isEnabledFor.return_value = True
+        sampled_logger = logger.SampledLogger(test_logger, max_records=2, interval_s=60)
+        for index in range(5):
+            sampled_logger.info('Record sent: %s', index)
+        self.assertEqual(test_logger.log.call_args_list, [mock.call(logging.INFO, 'Record sent: %s', 0),
+                                                          mock.call(logging.INFO, 'Record sent: %s', 1)])
+        self.assertEqual(sampled_logger.suppressed_count, 3)
+        # The next window reports the suppressed records first
+        sampled_logger.window_start -= 60
+        sampled_logger.warning('Record sent: %s', 5)
+        self.assertEqual(test_logger.log.call_args_list[2:], [mock.call(logging.WARNING, '%s similar records suppressed.', 3),
+                                                              mock.call(logging.WARNING, 'Record sent: %s', 5)])
+
+    def test_sampled_logger_level(self):
+        test_logger = mock.Mock()
+        test_logger.isEnabledFor.return_value = False
+        sampled_logger = logger.SampledLogger(test_logger, max_records=0)
+        sampled_logger.debug('Record sent: %s', 1)
+        test_logger.log.assert_not_called()
+        self.assertEqual(sampled_logger.window_count, 0)
@@ -0,0 +1,76 @@
+from unittest import TestCase
+import urllib.error
+import urllib.request
+
+from tools.metrics import MetricsHistogram, MetricsRegistry
+
+
+class MetricsRegistryTest(TestCase):
+
+    def setUp(self):
+        self.metrics = MetricsRegistry()
+
+    def test_histogram(self):
+        histogram = MetricsHistogram(buckets=(0.001, 0.01, 0.1))
+        self.assertIsNone(histogram.get_percentile(50))
+        for value in [0.0005] * 98 + [0.05, 0.5]:
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [98, 0, 1, 1])
+        self.assertEqual(histogram.get_percentile(50), 0.001)
+        self.assertEqual(histogram.get_percentile(99), 0.1)
+        self.assertEqual(histogram.get_percentile(100), 0.5)
+        self.assertAlmostEqual(histogram.get_summary()['mean'], 0.00599)
+
+    def test_timer(self):
+        with self.metrics.timer('stage'):
+            pass
+        with self.metrics.timer('stage'):
+            pass
+        self.assertEqual(self.metrics.histogram('stage').count, 2)
+        self.metrics.counter('events').inc(3)
+        self.metrics.gauge('consumer_lag').set(7)
+        summary = self.metrics.get_summary()
+        self.assertEqual(summary['counters'], {'events': 3})
+        self.assertEqual(summary['gauges'], {'consumer_lag': 7})
+        self.assertEqual(summary['timings']['stage']['count'], 2)
+
+    def test_render(self):
+        self.metrics.counter('events').inc()
+        self.metrics.gauge('consumer_lag')
+        self.metrics.histogram('stage').observe(0.0000015)
+        lines = self.metrics.render().splitlines()
+        self.assertIn('stockservice_events_total 1', lines)
+        self.assertNotIn('consumer_lag', ' '.join(lines))
+        self.assertIn('stockservice_stage_seconds_bucket{le="1e-06"} 0', lines)
+        self.assertIn('stockservice_stage_seconds_bucket{le="2e-06"} 1', lines)
+        self.assertIn('stockservice_stage_seconds_count 1', lines)
+
+    def test_source_state(self):
+        self.metrics.counter('events_dispatched').inc(2)
+        worker_metrics = MetricsRegistry()
+        worker_metrics.counter('events').inc(3)
+        worker_metrics.histogram('stage').observe(0.0000015)
+        self.metrics.set_source_state(0, worker_metrics.get_state())
+        self.metrics.set_source_state(1, worker_metrics.get_state())
+        # The latest state of a source replaces the one before
+        worker_metrics.counter('events').inc()
+        self.metrics.set_source_state(1, worker_metrics.get_state())
+        summary = self.metrics.get_summary()
+        self.assertEqual(summary['counters'], {'events': 7, 'events_dispatched': 2})
+        self.assertEqual(summary['timings']['stage']['count'], 2)
+        lines = self.metrics.render().splitlines()
+        self.assertIn('stockservice_events_total 7', lines)
+        self.assertIn('stockservice_stage_seconds_bucket{le="2e-06"} 2', lines)
+        self.assertEqual(self.metrics.counters['events_dispatched'].value, 2)
+
+    def test_start_server(self):
+        self.metrics.counter('events').inc(5)
+        self.metrics.start_server(0)
+        url = 'http://127.0.0.1:{}'.format(self.metrics.server.server_address[1])
+        with urllib.request.urlopen(url + '/metrics') as response:
+            self.assertIn('stockservice_events_total 5', response.read().decode('utf-8'))
+        with self.assertRaises(urllib.error.HTTPError):
+            urllib.request.urlopen(url + '/other')
+
+    def tearDown(self):
+        self.metrics.stop()
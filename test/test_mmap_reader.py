@@ -0,0 +1,91 @@
+import csv
+import os
+import tempfile
+from unittest import TestCase
+
+from importer.mmap_reader import StockMmapReader
+
+
+class StockMmapReaderTest(TestCase):
+
+    def setUp(self):
+        self.input_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.input_dir.cleanup()
+
+    def _write(self, content):
+        filepath = os.path.join(self.input_dir.name, 'drop.csv')
+        with open(filepath, 'wb') as csv_file:
+            csv_file.write(content)
+        return filepath
+
+    def test_iter_rows(self):
+        with StockMmapReader('samples/csv_sample_1.csv') as row_reader:
+            rows = [row.to_dict() for row in row_reader.iter_rows()]
+            self.assertEqual(row_reader.position, row_reader.size)
+        with open('samples/csv_sample_1.csv') as csv_file:
+            self.assertEqual(rows, list(csv.DictReader(csv_file)))
+
+    def test_row_view(self):
+        filepath = self._write(b'transaction_id,event_type,value\r\n'
+                               b'1,sale,5\r\n'
+                               b'\r\n'
+                               b'2,"sale, online",\xff\r\n'
+                               b'3,incoming\n')
+        with StockMmapReader(filepath) as row_reader:
+            rows = list(row_reader.iter_rows())
+        self.assertEqual([len(row) for row in rows], [3, 3, 2])
+        self.assertEqual(rows[0]['event_type'], 'sale')
+        self.assertEqual(list(rows[0].keys()), ['transaction_id', 'event_type', 'value'])
+        # Quoted fields go through the csv module, undecodable bytes are replaced
+        self.assertEqual(rows[1].to_dict(), {'transaction_id': '2', 'event_type': 'sale, online', 'value': '�'})
+        # Missing fields are None, like in DictReader
+        self.assertIsNone(rows[2]['value'])
+        self.assertEqual(rows[2].get('value', '0'), '0')
+        self.assertIsNone(rows[2].get('date'))
+
+    def test_get_ranges(self):
+        with StockMmapReader('samples/csv_sample_1.csv') as row_reader:
+            ranges = list(row_reader.get_ranges(range_size=10000))
+            self.assertEqual(ranges[0][0], row_reader.data_start)
+            self.assertEqual(ranges[-1][1], row_reader.size)
+            # Ranges follow each other and are cut at line ends
+            for (_, end), (start, _) in zip(ranges, ranges[1:]):
+                self.assertEqual(end, start)
+                self.assertEqual(row_reader.map[end - 1:end], b'\n')
+            range_rows = [row.to_dict() for start, end in ranges for row in row_reader.iter_rows(start, end)]
+            self.assertEqual(range_rows, [row.to_dict() for row in row_reader.iter_rows()])
+            # A start inside a line moves to the next line
+            start, _ = ranges[1]
+            self.assertEqual(next(row_reader.get_ranges(range_size=10000, start=start - 5))[0], start)
+
+    def test_quoted_newline(self):
+        content = (b'transaction_id,event_type,value\n'
+                   b'1,"sale\nonline, ""web""",5\n'
+                   b'2,sale,6\n'
+                   b'3,"in\r\ncoming",7\r\n')
+        filepath = self._write(content)
+        with StockMmapReader(filepath) as row_reader:
+            rows = [row.to_dict() for row in row_reader.iter_rows()]
+            with open(filepath, newline='') as csv_file:
+                self.assertEqual(rows, list(csv.DictReader(csv_file)))
+            # Ranges are not cut inside a quoted field
+            ranges = list(row_reader.get_ranges(range_size=1))
+            self.assertEqual(ranges[0], (row_reader.data_start, content.index(b'2,sale')))
+            range_rows = [row.to_dict() for start, end in ranges for row in row_reader.iter_rows(start, end)]
+            self.assertEqual(range_rows, rows)
+
+    def test_empty_file(self):
+        filepath = self._write(b'')
+        with StockMmapReader(filepath) as row_reader:
+            self.assertEqual(list(row_reader.get_ranges()), [])
+            self.assertEqual(list(row_reader.iter_rows()), [])
+        filepath = self._write(b'transaction_id,event_type')
+        with StockMmapReader(filepath) as row_reader:
+            self.assertEqual(row_reader.names, ['transaction_id', 'event_type'])
+            self.assertEqual(list(row_reader.iter_rows()), [])
+
+    def test_is_supported(self):
+        self.assertTrue(StockMmapReader.is_supported('csv_sample_1.csv'))
+        self.assertFalse(StockMmapReader.is_supported('csv_all_incoming.zip'))
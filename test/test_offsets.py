@@ -0,0 +1,62 @@
+from unittest import TestCase, mock
+import testing.postgresql
+import psycopg2
+
+from database.database import StockServiceDB
+from service.offsets import StockOffsetStore
+
+
+def init_test_db(postgresql):
+    conn = psycopg2.connect(**postgresql.dsn())
+    cursor = conn.cursor()
+    cursor.execute(
+        "CREATE TABLE consumer_offsets (consumer_group VARCHAR NOT NULL, topic VARCHAR NOT NULL, partition_id INTEGER NOT NULL, PRIMARY KEY (consumer_group, topic, partition_id), last_offset BIGINT);")
+    cursor.execute(
+        "INSERT INTO consumer_offsets values('othergroup', 'events', 0, 999)")
+    cursor.close()
+    conn.commit()
+    conn.close()
+
+
+Postgresql = testing.postgresql.PostgresqlFactory(cache_initialized_db=True,
+                                                  on_initialized=init_test_db)
+
+
+def tearDownModule():
+    Postgresql.clear_cache()
+
+
+class StockOffsetStoreTest(TestCase):
+
+    def setUp(self):
+        self.postgresql = Postgresql()
+        self.database = StockServiceDB(config=self.postgresql.dsn())
+        self.offset_store = StockOffsetStore(self.database, b'stockservice', 'events')
+
+    def test_get_message_offsets(self):
+        messages = [mock.Mock(partition_id=0, offset=10),
+                    mock.Mock(partition_id=1, offset=3),
+                    mock.Mock(partition_id=0, offset=11)]
+        self.assertEqual(StockOffsetStore.get_message_offsets(messages), {0: 11, 1: 3})
+        self.assertEqual(StockOffsetStore.get_message_offsets([], {2: 5}), {2: 5})
+
+    def test_store(self):
+        self.assertEqual(self.offset_store.consumer_group, 'stockservice')
+        self.assertEqual(self.offset_store.load(), {})
+        self.offset_store.store({0: 10, 1: 3})
+        self.offset_store.store({0: 11})
+        self.assertEqual(self.offset_store.load(), {0: 11, 1: 3})
+        # Other groups keep their own offsets
+        other_store = StockOffsetStore(self.database, 'othergroup', 'events')
+        self.assertEqual(other_store.load(), {0: 999})
+
+    def test_store_rollback(self):
+        self.database.autocommit = False
+        self.offset_store.store({0: 10})
+        self.database.rollback()
+        self.database.autocommit = True
+        self.assertEqual(self.offset_store.load(), {})
+
+    def tearDown(self):
+        self.database.close()
+        self.postgresql.stop()
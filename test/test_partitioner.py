@@ -0,0 +1,54 @@
+from unittest import TestCase, mock
+import zlib
+
+from kafka_client.partitioner import StockPartitioner, StockPartitionerException, get_item_key
+from service.workers import get_worker_index
+
+
+class StockPartitionerTest(TestCase):
+
+    def setUp(self):
+        self.partitioner = StockPartitioner()
+        self.event = {'transaction_id': '7c71fb42-1f5e-45e1-be16-7d4d772d1aab',
+                      'event_type': 'sale',
+                      'date': '2018-12-03T23:57:40Z',
+                      'store_number': '9',
+                      'item_number': '12',
+                      'value': '116'}
+        self.partitions = [mock.Mock(id=partition_id) for partition_id in [3, 0, 2, 1]]
+
+    def test_get_partition_key(self):
+        self.assertEqual(self.partitioner.get_partition_key(self.event), b'9:12')
+        # Binary events carry numbers
+        self.assertEqual(self.partitioner.get_partition_key(dict(self.event, store_number=9, item_number=12)), b'9:12')
+        # Padded numbers are the same item
+        self.assertEqual(self.partitioner.get_partition_key(dict(self.event, store_number=' 9', item_number='012')),
+                         b'9:12')
+        self.assertIsNone(self.partitioner.get_partition_key({'transaction_id': '7c71fb42'}))
+        self.assertEqual(StockPartitioner(StockPartitioner.STORE_STRATEGY).get_partition_key(self.event), b'9')
+        self.assertEqual(StockPartitioner(StockPartitioner.STORE_STRATEGY).get_partition_key(
+            dict(self.event, store_number='09')), b'9')
+        self.assertIsNone(StockPartitioner(StockPartitioner.RANDOM_STRATEGY).get_partition_key(self.event))
+        with self.assertRaises(StockPartitionerException):
+            StockPartitioner('round_robin')
+
+    def test_partition(self):
+        key = get_item_key(9, 12)
+        partition = self.partitioner(self.partitions, key)
+        self.assertEqual(partition.id, zlib.crc32(b'9:12') % 4)
+        # Independent of the order of the partitions
+        self.assertIs(self.partitioner(list(reversed(self.partitions)), key), partition)
+        self.assertIn(self.partitioner(self.partitions, None), self.partitions)
+
+    def test_worker_index(self):
+        self.assertEqual(get_worker_index('9', '12', 4), get_worker_index(9, 12, 4))
+        self.assertEqual(get_worker_index(' 9', '012', 4), get_worker_index(9, 12, 4))
+        # The keys of one partition spread over every worker
+        partitions = [mock.Mock(id=partition_id) for partition_id in range(8)]
+        for partition_id in (0, 4):
+            worker_counts = [0] * 4
+            for store_number in range(1, 21):
+                for item_number in range(1, 101):
+                    if self.partitioner(partitions, get_item_key(store_number, item_number)).id == partition_id:
+                        worker_counts[get_worker_index(store_number, item_number, 4)] += 1
+            self.assertTrue(all(worker_count > sum(worker_counts) / 8 for worker_count in worker_counts))
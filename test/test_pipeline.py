@@ -0,0 +1,123 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase, mock
+
+from importer.checkpoint import StockImportCheckpoint
+from importer.importer import StockImporter
+from importer.pipeline import StockImportPipeline, StockImportPipelineException
+from kafka_client.partitioner import StockPartitioner
+
+
+def fail_validation(filename, rows):
+    raise ValueError('Validator failed')
+
+
+class StockImportPipelineTest(TestCase):
+
+    def setUp(self):
+        self.importer = StockImporter()
+        self.importer.kafka_client = mock.MagicMock()
+        self.importer.kafka_client.get_sequenced_delivery_failures.return_value = []
+        self.importer.kafka_client.partitioner = StockPartitioner()
+        self.importer.kafka_client.sent_count = 0
+        self.sent_ids = []
+        self.importer.kafka_client.send_event.side_effect = self._send_event
+        self.pipeline = StockImportPipeline(self.importer)
+        self.pipeline.chunk_size = 100
+        self.pipeline.queue_size = 2
+        self.pipeline.validator_count = 2
+
+    def _send_event(self, event):
+        self.importer.kafka_client.sent_count += 1
+        self.sent_ids.append(event['transaction_id'])
+
+    def test_run(self):
+        summaries = self.pipeline.run(['csv_sample_1.csv', 'csv_sample_2.csv'])
+        self.assertEqual(summaries['csv_sample_1.csv'],
+                         {'validated_lines': 1000, 'processed_lines': 1000, 'failed_lines': 0, 'partition_key': 'item'})
+        self.assertEqual(summaries['csv_sample_2.csv']['processed_lines'], 1000)
+        validated_lines = sum(summary['validated_lines'] for summary in summaries.values())
+        self.assertEqual(self.importer.kafka_client.send_event.call_count, validated_lines)
+        self.importer.kafka_client.flush.assert_called_once()
+        # Rows of one file keep their order
+        sent_ids = self.sent_ids
+        with open('samples/csv_sample_1.csv') as csv_file:
+            file_ids = [line.split(',')[0] for line in csv_file.readlines()[1:]]
+        self.assertEqual([transaction_id for transaction_id in sent_ids if transaction_id in set(file_ids)], file_ids)
+
+    def test_run_checkpoint(self):
+        self.importer.kafka_client.get_acknowledged_count.return_value = 0
+        with tempfile.TemporaryDirectory() as input_dir:
+            shutil.copy('samples/csv_sample_1.csv', input_dir)
+            shutil.copy('samples/csv_all_incoming.zip', input_dir)
+            self.importer.input_dir = input_dir
+            self.importer.checkpoint = StockImportCheckpoint(path=os.path.join(input_dir, 'checkpoint.json'))
+            self.pipeline.run(['csv_sample_1.csv', 'csv_all_incoming.zip'])
+            self.assertEqual(self.importer.kafka_client.send_event.call_count, 2000)
+            summaries = self.pipeline.run(['csv_sample_1.csv', 'csv_all_incoming.zip'])
+            self.assertEqual(summaries, {'csv_sample_1.csv': {'skipped': True},
+                                         'csv_all_incoming.zip': {'skipped': True}})
+            self.assertEqual(self.importer.kafka_client.send_event.call_count, 2000)
+
+    def test_run_delivery_failure(self):
+        with open('samples/csv_sample_1.csv') as csv_file:
+            failed_id = csv_file.readlines()[1].split(',')[0]
+
+        def get_failures():
+            return [(self.sent_ids.index(failed_id) + 1, failed_id, Exception('Delivery failed'))]
+
+        self.importer.kafka_client.get_sequenced_delivery_failures.side_effect = get_failures
+        self.importer.kafka_client.get_acknowledged_count.return_value = 0
+        with tempfile.TemporaryDirectory() as input_dir:
+            shutil.copy('samples/csv_sample_1.csv', input_dir)
+            shutil.copy('samples/csv_sample_2.csv', input_dir)
+            self.importer.input_dir = input_dir
+            self.importer.checkpoint = StockImportCheckpoint(path=os.path.join(input_dir, 'checkpoint.json'))
+            summaries = self.pipeline.run(['csv_sample_1.csv', 'csv_sample_2.csv'])
+            # The failure is credited to the file that sent the row, whichever file finished first
+            self.assertEqual(summaries['csv_sample_1.csv']['failed_lines'], 1)
+            self.assertEqual(summaries['csv_sample_2.csv']['failed_lines'], 0)
+            self.assertFalse(self.importer.checkpoint.is_done('csv_sample_1.csv',
+                                                              os.path.join(input_dir, 'csv_sample_1.csv')))
+            self.assertTrue(self.importer.checkpoint.is_done('csv_sample_2.csv',
+                                                             os.path.join(input_dir, 'csv_sample_2.csv')))
+
+    def test_run_compressed_file(self):
+        summaries = self.pipeline.run(['csv_all_incoming.zip'])
+        self.assertEqual(summaries['csv_all_incoming.zip/csv_all_incoming.csv'],
+                         {'validated_lines': 1000, 'processed_lines': 1000, 'failed_lines': 0, 'partition_key': 'item'})
+
+    def test_run_invalid_file(self):
+        with tempfile.TemporaryDirectory() as input_dir:
+            with open(os.path.join(input_dir, 'csv_invalid.zip'), 'wb') as invalid_file:
+                invalid_file.write(b'Not a zip file')
+            self.importer.input_dir = input_dir
+            summaries = self.pipeline.run(['csv_invalid.zip'])
+        self.assertEqual(summaries['csv_invalid.zip']['error'], 'Cannot process file')
+
+    def test_run_validation_failure(self):
+        with mock.patch('importer.pipeline.validate_chunk', fail_validation):
+            with self.assertRaises(StockImportPipelineException) as context:
+                self.pipeline.run(['csv_sample_1.csv'])
+        self.assertIn('Validator failed', str(context.exception))
+        self.assertEqual(self.pipeline.summaries['csv_sample_1.csv']['error'], 'Validation failed')
+        self.importer.kafka_client.send_event.assert_not_called()
+        self.importer.kafka_client.flush.assert_called_once()
+
+    def test_run_mmap(self):
+        self.importer.reader = StockImporter.MMAP_READER
+        self.pipeline.range_size = 10000
+        summaries = self.pipeline.run(['csv_sample_1.csv', 'csv_all_incoming.zip'])
+        self.assertEqual(summaries['csv_sample_1.csv'],
+                         {'validated_lines': 1000, 'processed_lines': 1000, 'failed_lines': 0, 'partition_key': 'item'})
+        self.assertEqual(summaries['csv_all_incoming.zip/csv_all_incoming.csv']['processed_lines'], 1000)
+        sent_ids = self.sent_ids
+        with open('samples/csv_sample_1.csv') as csv_file:
+            file_ids = [line.split(',')[0] for line in csv_file.readlines()[1:]]
+        self.assertEqual([transaction_id for transaction_id in sent_ids if transaction_id in set(file_ids)], file_ids)
+
+    def test_run_mmap_checkpoint(self):
+        self.importer.reader = StockImporter.MMAP_READER
+        self.pipeline.range_size = 10000
+        self.test_run_checkpoint()
@@ -0,0 +1,73 @@
+from unittest import TestCase
+import testing.postgresql
+import psycopg2
+
+from database.database import StockServiceDBException
+from database.pool import StockServiceDBPool
+
+
+def init_test_db(postgresql):
+    conn = psycopg2.connect(**postgresql.dsn())
+    cursor = conn.cursor()
+    cursor.execute(
+        "CREATE TABLE stock (item_number INTEGER NOT NULL, store_number INTEGER NOT NULL, PRIMARY KEY (item_number, store_number), current_value INTEGER, last_update TIMESTAMP);")
+    cursor.execute(
+        "INSERT INTO stock values(12, 9, 116, '2018-12-03T23:57:40Z')")
+    cursor.close()
+    conn.commit()
+    conn.close()
+
+
+Postgresql = testing.postgresql.PostgresqlFactory(cache_initialized_db=True,
+                                                  on_initialized=init_test_db)
+
+
+def tearDownModule():
+    Postgresql.clear_cache()
+
+
+class StockServiceDBPoolTest(TestCase):
+
+    def setUp(self):
+        self.postgresql = Postgresql()
+        self.pool = StockServiceDBPool(config=self.postgresql.dsn(), min_size=1, max_size=2)
+
+    def test_connect(self):
+        self.pool.min_size = 3
+        with self.assertRaises(StockServiceDBException) as context:
+            self.pool._connect()
+        self.assertTrue('Pool min size is bigger than max size' in str(context.exception))
+
+    def test_get_connection(self):
+        connection_1 = self.pool.get_connection()
+        connection_2 = self.pool.get_connection()
+        with self.assertRaises(StockServiceDBException) as context:
+            self.pool.get_connection()
+        self.assertTrue('Cannot get connection from pool' in str(context.exception))
+        self.pool.put_connection(connection_1)
+        self.pool.put_connection(connection_2)
+        # Above min size, the returned connection is closed, together with its statement cache
+        self.assertTrue(connection_2.closed)
+        self.assertNotIn(id(connection_2), self.pool.statement_caches)
+
+    def test_database(self):
+        with self.pool.database() as database:
+            database.table = 'stock'
+            database.fields = ['current_value']
+            database.where = {'item_number': 12, 'store_number': 9}
+            database.query()
+            self.assertEqual(database.query_result, (116,))
+            connection = database.connection
+        # Prepared statements are kept for the pooled connection
+        with self.pool.database() as database:
+            self.assertIs(database.connection, connection)
+            self.assertEqual(len(database.statements), 1)
+            database.table = 'stock'
+            database.fields = ['current_value']
+            database.where = {'item_number': 12, 'store_number': 9}
+            database.query()
+            self.assertEqual(database.query_result, (116,))
+
+    def tearDown(self):
+        self.pool.close()
+        self.postgresql.stop()
@@ -0,0 +1,60 @@
+import datetime
+from unittest import TestCase
+
+from service.reorder import StockReorderBuffer
+
+
+class StockReorderBufferTest(TestCase):
+
+    def setUp(self):
+        self.reorder = StockReorderBuffer(window_s=60, max_delay_s=5, max_key_events=3, max_events=5)
+        self.date = datetime.datetime(2019, 9, 22, 6, 0)
+
+    def _add(self, name, item_key, minutes, offset=None, now=0):
+        self.reorder.add(name, item_key, self.date + datetime.timedelta(minutes=minutes),
+                         partition_id=0 if offset is not None else None, offset=offset, now=now)
+
+    def test_release_watermark(self):
+        self._add('b', (1, 1), 1, offset=10)
+        self._add('a', (1, 1), 0.5, offset=11)
+        self._add('c', (2, 1), 1.4, offset=12)
+        self.assertEqual(self.reorder.release(now=0), [])
+        self.assertEqual(self.reorder.get_safe_offsets({0: 12}), {0: 9})
+        # The watermark passes a and b
+        self._add('d', (2, 1), 2.2, offset=13)
+        self.assertEqual(self.reorder.release(now=0), ['a', 'b'])
+        self.assertEqual(self.reorder.get_safe_offsets({0: 13, 1: 3}), {0: 11, 1: 3})
+        self.assertEqual(self.reorder.get_stats(), {'held': 2,
+                                                    'items': 1,
+                                                    'reordered': 1,
+                                                    'watermark': self.date + datetime.timedelta(minutes=1.2)})
+        self.assertEqual(self.reorder.flush(), ['c', 'd'])
+        self.assertEqual(self.reorder.get_safe_offsets({0: 13}), {0: 13})
+
+    def test_release_limits(self):
+        self._add('a', (1, 1), 0, now=0)
+        self._add('b', (2, 1), 0, now=1)
+        # Wall clock delay
+        self.assertEqual(self.reorder.release(now=5.5), ['a'])
+        # Events per item
+        for name, minutes in [('e', 0.4), ('d', 0.3), ('c', 0.2)]:
+            self._add(name, (3, 1), minutes, now=5.5)
+        self.assertEqual(self.reorder.release(now=6), ['b'])
+        self._add('f', (3, 1), 0.1, now=5.5)
+        self.assertEqual(self.reorder.release(now=6), ['f'])
+        # Held events in total: the items held first go out first
+        self._add('g', (4, 1), 0.5, now=5.6)
+        self._add('h', (5, 1), 0.5, now=5.7)
+        self._add('i', (6, 1), 0.5, now=5.8)
+        self.assertEqual(self.reorder.release(now=5.8), ['c', 'd', 'e'])
+        self.assertEqual(len(self.reorder), 3)
+
+    def test_get_safe_offsets_first_offset(self):
+        self._add('a', (1, 1), 0, offset=0)
+        # Nothing processed on the partition yet
+        self.assertEqual(self.reorder.get_safe_offsets({0: 0}), {})
+
+    def test_unordered_events(self):
+        self.reorder.add('malformed', None, None)
+        self.assertEqual(self.reorder.release(), ['malformed'])
+        self.assertIsNone(self.reorder.watermark)
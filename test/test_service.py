@@ -1,7 +1,12 @@
+import datetime
+import json
 from unittest import TestCase, mock
 import testing.postgresql
 import psycopg2
 
+from kafka_client.codec import StockEventCodec
+from service.offsets import StockOffsetStore
+from service.reorder import StockReorderBuffer
 from service.service import StockService, StockServiceException
 from database.database import StockServiceDB, StockServiceDBException
 
@@ -10,13 +15,19 @@ def init_test_db(postgresql):
     conn = psycopg2.connect(**postgresql.dsn())
     cursor = conn.cursor()
     cursor.execute(
-        "CREATE TABLE events (transaction_id uuid PRIMARY KEY, event_type VARCHAR, date TIMESTAMP, store_number INTEGER, item_number INTEGER, value INTEGER);")
+        "CREATE TABLE events (transaction_id uuid NOT NULL, event_type VARCHAR, date TIMESTAMP NOT NULL, PRIMARY KEY (transaction_id, date), store_number INTEGER, item_number INTEGER, value INTEGER, inserted_at TIMESTAMP NOT NULL DEFAULT now());")
+    cursor.execute(
+        "CREATE TABLE event_ids (transaction_id uuid PRIMARY KEY);")
     cursor.execute(
         "INSERT INTO events values('7c71fb42-1f5e-45e1-be16-7d4d772d1aab', 'sale', '2018-12-03T23:57:40Z', 9, 12, 116)")
+    cursor.execute(
+        "INSERT INTO event_ids values('7c71fb42-1f5e-45e1-be16-7d4d772d1aab')")
     cursor.execute(
         "CREATE TABLE stock (item_number INTEGER NOT NULL, store_number INTEGER NOT NULL, PRIMARY KEY (item_number, store_number), current_value INTEGER, last_update TIMESTAMP);")
     cursor.execute(
         "INSERT INTO stock values(12, 9, 116, '2018-12-03T23:57:40Z')")
+    cursor.execute(
+        "CREATE TABLE consumer_offsets (consumer_group VARCHAR NOT NULL, topic VARCHAR NOT NULL, partition_id INTEGER NOT NULL, PRIMARY KEY (consumer_group, topic, partition_id), last_offset BIGINT);")
     cursor.close()
     conn.commit()
     conn.close()
@@ -94,14 +105,14 @@ class StockServiceTest(TestCase):
             self.service._insert_transaction()
         self.assertTrue('Insert failed' in str(context.exception))
 
-    def test_get_item(self):
+    def test_upsert_item_stored_state(self):
         self.service.event = {'transaction_id': 'd2a531fa-a417-4983-ab7d-4bb1411c6250',
                               'event_type': 'incoming',
                               'date': '2019-08-07T05:48:12Z',
                               'store_number': 9,
                               'item_number': 12,
                               'value': '400'}
-        self.service._get_item()
+        self.assertEqual(self.service._upsert_item(), self.service.REASON_APPLIED)
         raw_sql = "SELECT * from stock WHERE item_number={} AND store_number={};".format(
             self.service.event['item_number'],
             self.service.event['store_number']
@@ -109,92 +120,383 @@ class StockServiceTest(TestCase):
         self.test_service_db.cursor.execute(raw_sql)
         raw_result = self.test_service_db.cursor.fetchone()
         self.assertEqual(raw_result, self.service.item_in_db)
-        self.service.event = {'transaction_id': 'd2a531fa-a417-4983-ab7d-4bb1411c6250',
-                              'event_type': 'incoming',
-                              'date': '2019-08-07T05:48:12Z',
-                              'store_number': 999,
-                              'item_number': 999,
-                              'value': '400'}
-        self.service._get_item()
-        self.assertFalse(self.service.item_in_db)
+        self.assertEqual(raw_result[2], 516)
+        self.assertEqual(self.service.cache.get((12, 9)), raw_result[2:])
 
-    def test_insert_item(self):
+    def test_upsert_item_new_item(self):
         self.service.event = {'transaction_id': '407f9c78-13a1-4745-a491-84c4bb09468c',
-                              'event_type': 'incoming',
+                              'event_type': 'sale',
                               'date': '2019-06-06T19:14:48Z',
                               'store_number': '2',
                               'item_number': '10',
                               'value': '400'}
-        item_values = (int(self.service.event['item_number']),
-                       int(self.service.event['store_number']),
-                       int(self.service.event['value']),)
-        self.service._insert_item()
+        # Only incoming events create an item
+        self.assertEqual(self.service._upsert_item(), self.service.REASON_NO_ITEM)
+        self.service.event['event_type'] = 'incoming'
+        self.assertEqual(self.service._upsert_item(), self.service.REASON_APPLIED)
         raw_sql = "SELECT * from stock WHERE item_number={} AND store_number={};".format(
             self.service.event['item_number'],
             self.service.event['store_number']
         )
         self.test_service_db.cursor.execute(raw_sql)
         raw_result = self.test_service_db.cursor.fetchone()
-        self.assertEqual(raw_result[:3], item_values)
+        self.assertEqual(raw_result[:3], (10, 2, 400))
 
-    def test_update_item(self):
-        update_value = 999
+    def test_upsert_item_stock_value(self):
         self.service.event = {'transaction_id': '407f9c78-13a1-4745-a491-84c4bb09468c',
                               'event_type': 'incoming',
                               'date': '2019-06-06T19:14:48Z',
-                              'store_number': '9',
-                              'item_number': '12',
-                              'value': update_value}
-        self.service._update_item(update_value)
+                              'store_number': 9,
+                              'item_number': 12,
+                              'value': 34}
+        self.assertEqual(self.service._upsert_item(), self.service.REASON_APPLIED)
+        self.service.event = {'transaction_id': 'cc855c81-7ada-45ed-be6b-4e466df1fad2',
+                              'event_type': 'sale',
+                              'date': '2019-06-06T19:14:48Z',
+                              'store_number': 9,
+                              'item_number': 12,
+                              'value': 160}
+        self.assertEqual(self.service._upsert_item(), self.service.REASON_OUT_OF_STOCK)
         raw_sql = "SELECT * from stock WHERE item_number={} AND store_number={};".format(
             self.service.event['item_number'],
             self.service.event['store_number']
         )
         self.test_service_db.cursor.execute(raw_sql)
         raw_result = self.test_service_db.cursor.fetchone()
-        self.assertEqual(raw_result[2], update_value)
+        self.assertEqual(raw_result[2], 150)
 
-    def test_set_stock_value(self):
-        self.service.event = {'store_number': 9,
-                              'item_number': 12,
-                              'value': 116}
-        self.service._get_item()
+    def test_upsert_item_date(self):
         self.service.event = {'transaction_id': '407f9c78-13a1-4745-a491-84c4bb09468c',
                               'event_type': 'incoming',
-                              'date': '2019-06-06T19:14:48Z',
+                              'date': '2018-06-06T19:14:48Z',
                               'store_number': 9,
                               'item_number': 12,
-                              'value': 34}
-        self.service._set_stock_value()
-        raw_sql = "SELECT * from stock WHERE item_number={} AND store_number={};".format(
-            self.service.event['item_number'],
-            self.service.event['store_number']
-        )
+                              'value': 1}
+        # Events before the last update of the item are stale
+        self.assertEqual(self.service._upsert_item(), self.service.REASON_STALE)
+        self.service.event['date'] = '2019-06-06T19:14:48Z'
+        self.assertEqual(self.service._upsert_item(), self.service.REASON_APPLIED)
+        self.assertEqual(self.service.item_in_db[3], datetime.datetime(2019, 6, 6, 19, 14, 48))
+
+    def test_upsert_item(self):
+        # New item
+        self.service.event = {'transaction_id': '407f9c78-13a1-4745-a491-84c4bb09468c',
+                              'event_type': 'incoming',
+                              'date': '2019-06-06T19:14:48Z',
+                              'store_number': '2',
+                              'item_number': '10',
+                              'value': '400'}
+        self.assertEqual(self.service._upsert_item(), self.service.REASON_APPLIED)
+        self.assertEqual(self.service.item_in_db[:3], (10, 2, 400))
+        # Sale on existing item
+        self.service.event = {'transaction_id': 'cc855c81-7ada-45ed-be6b-4e466df1fad2',
+                              'event_type': 'sale',
+                              'date': '2019-06-07T19:14:48Z',
+                              'store_number': '9',
+                              'item_number': '12',
+                              'value': '16'}
+        self.assertEqual(self.service._upsert_item(), self.service.REASON_APPLIED)
+        self.assertEqual(self.service.item_in_db[2], 100)
+        # Out of stock
+        self.service.event['date'] = '2019-06-08T19:14:48Z'
+        self.service.event['value'] = '101'
+        self.assertEqual(self.service._upsert_item(), self.service.REASON_OUT_OF_STOCK)
+        # Stale
+        self.service.event['date'] = '2018-06-08T19:14:48Z'
+        self.service.event['value'] = '1'
+        self.assertEqual(self.service._upsert_item(), self.service.REASON_STALE)
+        # Sale on missing item
+        self.service.event['item_number'] = '999'
+        self.assertEqual(self.service._upsert_item(), self.service.REASON_NO_ITEM)
+        raw_sql = "SELECT current_value, last_update from stock WHERE item_number=12 AND store_number=9;"
         self.test_service_db.cursor.execute(raw_sql)
         raw_result = self.test_service_db.cursor.fetchone()
-        self.assertEqual(raw_result[2], 150)
+        self.assertEqual(raw_result[0], 100)
+        self.assertEqual(str(raw_result[1]), '2019-06-07 19:14:48')
+        self.test_service_db.cursor.execute("SELECT count(*) from stock WHERE item_number=999;")
+        self.assertEqual(self.test_service_db.cursor.fetchone()[0], 0)
 
+    def test_process_batch(self):
+        events = ['{"transaction_id": "ceb2c843-3cbb-42c2-9140-697ffc278ef8", "event_type": "incoming", '
+                  '"date": "2019-09-22T06:23:02Z", "store_number": "9", "item_number": "12", "value": "10"}',
+                  # Duplicate
+                  '{"transaction_id": "ceb2c843-3cbb-42c2-9140-697ffc278ef8", "event_type": "incoming", '
+                  '"date": "2019-09-22T06:23:02Z", "store_number": "9", "item_number": "12", "value": "10"}',
+                  # Stale
+                  '{"transaction_id": "2aeb32d6-a39e-459f-a77b-d81df3a71a95", "event_type": "incoming", '
+                  '"date": "2018-12-13T19:21:59Z", "store_number": "9", "item_number": "12", "value": "125"}',
+                  # Out of stock
+                  '{"transaction_id": "1e6c4bb8-0e0e-4a30-9a3c-cfa3d0e31e3d", "event_type": "sale", '
+                  '"date": "2019-10-01T10:00:00Z", "store_number": "9", "item_number": "12", "value": "500"}',
+                  '{"transaction_id": "5ef4b5c8-1e51-47df-a1d4-8b3f0e2f6a10", "event_type": "sale", '
+                  '"date": "2019-10-02T10:00:00Z", "store_number": "9", "item_number": "12", "value": "26"}']
+        self.service.process_batch(events)
+        self.assertTrue(self.test_service_db.autocommit)
+        self.test_service_db.cursor.execute("SELECT current_value from stock WHERE item_number=12 AND store_number=9;")
+        self.assertEqual(self.test_service_db.cursor.fetchone()[0], 100)
+        self.test_service_db.cursor.execute("SELECT count(*) from events;")
+        self.assertEqual(self.test_service_db.cursor.fetchone()[0], 5)
+        self.assertEqual(self.service.updated_item_count, 2)
+
+    def test_stock_cache(self):
+        self.service.warm_cache(owns_key=lambda key: key == (12, 9))
+        self.assertEqual(self.service.cache.get((12, 9)), (116, datetime.datetime(2018, 12, 3, 23, 57, 40)))
+        # Rejections are answered from memory
+        self.test_service_db.cursor.execute("UPDATE stock SET current_value=0 WHERE item_number=12 AND store_number=9;")
+        self.test_service_db.commit()
         self.service.event = {'transaction_id': 'cc855c81-7ada-45ed-be6b-4e466df1fad2',
                               'event_type': 'sale',
-                              'date': '2019-06-06T19:14:48Z',
-                              'store_number': 9,
-                              'item_number': 12,
-                              'value': 160}
-        with self.assertRaises(StockServiceException) as context:
-            self.service._set_stock_value()
-        self.assertTrue('Cannot run out of stock' in str(context.exception))
+                              'date': '2018-06-07T19:14:48Z',
+                              'store_number': '9',
+                              'item_number': '12',
+                              'value': '16'}
+        self.assertEqual(self.service._upsert_item(), self.service.REASON_STALE)
+        self.service.event['date'] = '2019-06-07T19:14:48Z'
+        self.service.event['value'] = '117'
+        self.assertEqual(self.service._upsert_item(), self.service.REASON_OUT_OF_STOCK)
+        # Applied events are written through
+        self.service.event['value'] = '16'
+        self.assertEqual(self.service._upsert_item(), self.service.REASON_OUT_OF_STOCK)
+        self.assertEqual(self.service.cache.get((12, 9)), (0, datetime.datetime(2018, 12, 3, 23, 57, 40)))
+        self.service.event['event_type'] = 'incoming'
+        self.assertEqual(self.service._upsert_item(), self.service.REASON_APPLIED)
+        self.assertEqual(self.service.cache.get((12, 9)), (16, datetime.datetime(2019, 6, 7, 19, 14, 48)))
 
-    def test_check_item_date(self):
-        self.service.event = {'store_number': 9,
-                              'item_number': 12,
-                              'date': '2018-12-03T23:57:40Z'}
-        self.service._get_item()
-        self.service.event = {'date': '2019-06-06T19:14:48Z'}
-        is_valid_date = self.service._check_item_date()
-        self.assertTrue(is_valid_date)
-        self.service.event = {'date': '2018-06-06T19:14:48Z'}
-        is_valid_date = self.service._check_item_date()
-        self.assertFalse(is_valid_date)
+    def test_process_batch_rollback(self):
+        events = ['{"transaction_id": "ceb2c843-3cbb-42c2-9140-697ffc278ef8", "event_type": "incoming", '
+                  '"date": "2019-09-22T06:23:02Z", "store_number": "9", "item_number": "12", "value": "10"}',
+                  '{"transaction_id": "not a uuid", "event_type": "incoming", '
+                  '"date": "2019-09-22T06:23:02Z", "store_number": "9", "item_number": "12", "value": "10"}']
+        self.service.offset_store = StockOffsetStore(self.test_service_db, b'stockservice', 'events')
+        # The bad event is skipped as malformed, the rest of the batch and the offsets are committed
+        self.service.process_batch(events, offsets={0: 41})
+        self.assertEqual(self.service.metrics.counters['events_malformed'].value, 1)
+        self.test_service_db.cursor.execute("SELECT current_value from stock WHERE item_number=12 AND store_number=9;")
+        self.assertEqual(self.test_service_db.cursor.fetchone()[0], 126)
+        self.assertEqual(self.service.offset_store.load(), {0: 41})
+
+    def test_process_batch_database_error(self):
+        events = ['{"transaction_id": "ceb2c843-3cbb-42c2-9140-697ffc278ef8", "event_type": "incoming", '
+                  '"date": "2019-09-22T06:23:02Z", "store_number": "9", "item_number": "12", "value": "10"}']
+        self.service.offset_store = StockOffsetStore(self.test_service_db, b'stockservice', 'events')
+        with mock.patch.object(self.service, 'STOCK_UPSERT_SQL', 'SELECT 1 / 0;'):
+            with self.assertRaises(psycopg2.DataError):
+                self.service.process_batch(events, offsets={0: 41})
+        self.assertNotIn((12, 9), self.service.cache)
+        self.assertIsNone(self.service.dedup.check('ceb2c843-3cbb-42c2-9140-697ffc278ef8'))
+        self.test_service_db.cursor.execute("SELECT count(*) from events;")
+        self.assertEqual(self.test_service_db.cursor.fetchone()[0], 1)
+        # Offsets are rolled back with the events
+        self.assertEqual(self.service.offset_store.load(), {})
+
+    def test_parse_event_values(self):
+        event = {"transaction_id": "ceb2c843-3cbb-42c2-9140-697ffc278ef8", "event_type": "incoming",
+                 "date": "2019-09-22T06:23:02Z", "store_number": "9", "item_number": "12", "value": "10"}
+        bad_values = [('transaction_id', 'not a uuid'),
+                      ('transaction_id', 42),
+                      ('event_type', None),
+                      ('date', '2019-13-22T06:23:02Z'),
+                      ('date', 1569133382),
+                      ('value', 'ten'),
+                      ('value', '1_000'),
+                      ('value', 10.5),
+                      ('value', True),
+                      ('store_number', str(2 ** 31)),
+                      ('item_number', -2 ** 31 - 1)]
+        for event_field, value in bad_values:
+            self.service.event = json.dumps(dict(event, **{event_field: value}))
+            self.assertFalse(self.service._parse_event(), (event_field, value))
+        for event_field, value in [('value', ' 10'), ('value', -5), ('date', '2019-09-22T06:23:02+02:00'),
+                                   ('store_number', str(2 ** 31 - 1))]:
+            self.service.event = json.dumps(dict(event, **{event_field: value}))
+            self.assertTrue(self.service._parse_event(), (event_field, value))
+        self.service.event = '[1, 2]'
+        self.assertFalse(self.service._parse_event())
+
+    def test_process_batch_offsets(self):
+        events = ['{"transaction_id": "ceb2c843-3cbb-42c2-9140-697ffc278ef8", "event_type": "incoming", '
+                  '"date": "2019-09-22T06:23:02Z", "store_number": "9", "item_number": "12", "value": "10"}']
+        self.service.offset_store = StockOffsetStore(self.test_service_db, b'stockservice', 'events')
+        self.service.process_batch(events, offsets={0: 41, 1: 7})
+        self.service.process_batch([], offsets={0: 42})
+        self.assertEqual(self.service.offset_store.load(), {0: 42, 1: 7})
+        self.test_service_db.cursor.execute("SELECT current_value from stock WHERE item_number=12 AND store_number=9;")
+        self.assertEqual(self.test_service_db.cursor.fetchone()[0], 126)
+
+    def test_process_batch_duplicates(self):
+        event = ('{"transaction_id": "ceb2c843-3cbb-42c2-9140-697ffc278ef8", "event_type": "incoming", '
+                 '"date": "2019-09-22T06:23:02Z", "store_number": "9", "item_number": "12", "value": "10"}')
+        stored_event = ('{"transaction_id": "7c71fb42-1f5e-45e1-be16-7d4d772d1aab", "event_type": "incoming", '
+                        '"date": "2019-09-22T06:23:02Z", "store_number": "9", "item_number": "12", "value": "10"}')
+        # The stored event of the fixture is dated 2018, it was stored within the seed window
+        self.service.warm_cache()
+        self.service.process_batch([event])
+        # Replays are rejected from memory, without an insert
+        with mock.patch.object(self.service, '_insert_transaction') as insert_transaction:
+            self.service.process_batch([event, stored_event])
+            insert_transaction.assert_not_called()
+        self.assertEqual(self.service.dedup.duplicates, 2)
+        # A probable hit of a new id is confirmed by the database
+        with mock.patch.object(self.service.dedup, 'check', return_value=self.service.dedup.PROBABLE_DUPLICATE):
+            self.service.process_batch([event.replace('ceb2c843', 'aaaaaaaa')])
+        self.assertEqual(self.service.dedup.false_positives, 1)
+        counters = self.service.metrics.get_summary()['counters']
+        self.assertEqual(counters, {'events': 4, 'events_applied': 2, 'events_duplicate': 2})
+        self.assertEqual(self.service.metrics.histogram('stock_upsert').count, 2)
+        self.assertEqual(self.service.metrics.histogram('event_decode').count, 4)
+        self.test_service_db.cursor.execute("SELECT current_value from stock WHERE item_number=12 AND store_number=9;")
+        self.assertEqual(self.test_service_db.cursor.fetchone()[0], 136)
+
+    def test_process_batch_same_id_other_date(self):
+        # The events are keyed by id and date, the ids table keeps an id unique across dates
+        event = {'transaction_id': 'ceb2c843-3cbb-42c2-9140-697ffc278ef8', 'event_type': 'incoming',
+                 'date': '2019-01-01T00:00:00Z', 'store_number': '9', 'item_number': '20', 'value': '5'}
+        for compaction in (False, True):
+            service = StockService(database=StockServiceDB(config=self.postgresql.dsn()))
+            service.compaction = compaction
+            service.process_batch([StockEventCodec.encode_json(event)])
+            event['date'] = '2019-01-02T00:00:00Z'
+            service.database.close()
+        self.assertEqual(service.metrics.counters['events_duplicate'].value, 1)
+        self.test_service_db.cursor.execute("SELECT current_value from stock WHERE item_number=20 AND store_number=9;")
+        self.assertEqual(self.test_service_db.cursor.fetchone()[0], 5)
+        self.test_service_db.cursor.execute("SELECT count(*) from events WHERE item_number=20;")
+        self.assertEqual(self.test_service_db.cursor.fetchone()[0], 1)
+
+    def test_process_batch_binary(self):
+        codec = StockEventCodec(StockEventCodec.BINARY_FORMAT)
+        event = {'transaction_id': 'ceb2c843-3cbb-42c2-9140-697ffc278ef8', 'event_type': 'incoming',
+                 'date': '2019-09-22T06:23:02Z', 'store_number': '9', 'item_number': '12', 'value': '10'}
+        stale_event = dict(event, transaction_id='407f9c78-13a1-4745-a491-84c4bb09468c', event_type='sale',
+                           date='2019-09-22T06:23:01Z')
+        # JSON and binary messages in the same batch
+        self.service.process_batch([codec.encode(event), StockEventCodec.encode_json(stale_event)])
+        self.assertEqual(self.service.cache.get((12, 9)), (126, datetime.datetime(2019, 9, 22, 6, 23, 2)))
+        self.assertEqual(self.service.metrics.counters['events_stale'].value, 1)
+        self.test_service_db.cursor.execute("SELECT current_value from stock WHERE item_number=12 AND store_number=9;")
+        self.assertEqual(self.test_service_db.cursor.fetchone()[0], 126)
+
+    def test_process_batch_snapshot(self):
+        event = ('{"transaction_id": "ceb2c843-3cbb-42c2-9140-697ffc278ef8", "event_type": "incoming", '
+                 '"date": "2019-09-22T06:23:02Z", "store_number": "9", "item_number": "12", "value": "10"}')
+        self.service.snapshot_port = 0
+        self.service.start_snapshot()
+        self.service.snapshot.stop()
+        self.assertEqual(self.service.snapshot.get_item(9, 12)['current_value'], 116)
+        self.service.process_batch([event])
+        self.assertEqual(self.service.snapshot.get_item(9, 12)['current_value'], 126)
+        # Rolled back states are not applied
+        get_upsert_values = self.service._get_upsert_values
+        upsert_values = [get_upsert_values, lambda: dict(get_upsert_values(), delta=2 ** 31)]
+        with mock.patch.object(self.service, '_get_upsert_values', side_effect=lambda: upsert_values.pop(0)()):
+            with self.assertRaises(psycopg2.DataError):
+                self.service.process_batch([event.replace('ceb2c843', 'aaaaaaaa'), event.replace('ceb2c843', 'bbbbbbbb')])
+        self.assertEqual(self.service.snapshot.get_item(9, 12)['current_value'], 126)
+        self.assertEqual(self.service.batch_states, {})
+
+    def test_process_reordered(self):
+        event = {'transaction_id': 'ceb2c843-3cbb-42c2-9140-697ffc278ef8', 'event_type': 'incoming',
+                 'date': '2019-09-22T06:23:02Z', 'store_number': '9', 'item_number': '12', 'value': '10'}
+        late_event = dict(event, transaction_id='407f9c78-13a1-4745-a491-84c4bb09468c', event_type='sale',
+                          date='2019-09-22T06:23:01Z')
+        self.service.offset_store = StockOffsetStore(self.test_service_db, b'stockservice', 'events')
+        self.service.reorder = StockReorderBuffer(window_s=60)
+        self.service.process_reordered([mock.Mock(value=StockEventCodec.encode_json(event), partition_id=0, offset=5),
+                                        mock.Mock(value=StockEventCodec.encode_json(late_event), partition_id=0,
+                                                  offset=6)])
+        # Both are held, the offsets stay before them
+        self.assertEqual(len(self.service.reorder), 2)
+        self.assertEqual(self.service.offset_store.load(), {0: 4})
+        self.service.process_reordered([mock.Mock(value=b'{}', partition_id=0, offset=7)])
+        self.assertEqual(self.service.offset_store.load(), {0: 4})
+        newer_event = dict(event, transaction_id='aaaaaaaa-3cbb-42c2-9140-697ffc278ef8', date='2019-09-22T07:30:00Z')
+        self.service.process_reordered([mock.Mock(value=StockEventCodec.encode_json(newer_event), partition_id=1,
+                                                  offset=0)])
+        # The late sale is applied before the incoming event, instead of being stale
+        self.assertEqual(self.service.metrics.counters['events_applied'].value, 2)
+        self.assertNotIn('events_stale', self.service.metrics.counters)
+        self.assertEqual(self.service.offset_store.load(), {0: 7})
+        self.test_service_db.cursor.execute("SELECT current_value from stock WHERE item_number=12 AND store_number=9;")
+        self.assertEqual(self.test_service_db.cursor.fetchone()[0], 116)
+
+    def test_process_batch_compacted(self):
+        event = {'transaction_id': 'ceb2c843-3cbb-42c2-9140-697ffc278ef8', 'event_type': 'incoming',
+                 'date': '2019-09-22T06:23:02Z', 'store_number': '9', 'item_number': '12', 'value': '10'}
+        events = [event,
+                  dict(event, transaction_id='407f9c78-13a1-4745-a491-84c4bb09468c', event_type='sale',
+                       date='2019-09-22T06:23:03Z', value='200'),
+                  dict(event, transaction_id='8947695b-7f19-44b6-96b6-7f8ed041fe57', event_type='sale',
+                       date='2019-09-22T06:23:04Z', value='26'),
+                  dict(event, transaction_id='aaaaaaaa-3cbb-42c2-9140-697ffc278ef8', date='2019-09-22T06:23:00Z',
+                       value='5'),
+                  dict(event, transaction_id='7c71fb42-1f5e-45e1-be16-7d4d772d1aab'),
+                  event,
+                  dict(event, transaction_id='bbbbbbbb-3cbb-42c2-9140-697ffc278ef8', event_type='sale',
+                       item_number='13'),
+                  dict(event, transaction_id='cccccccc-3cbb-42c2-9140-697ffc278ef8', item_number='14', value='5')]
+        self.service.compaction = True
+        self.service.process_batch([StockEventCodec.encode_json(event) for event in events])
+        counters = self.service.metrics.get_summary()['counters']
+        self.assertEqual(counters, {'events': 8,
+                                    'events_applied': 3,
+                                    'events_duplicate': 2,
+                                    'events_no_item': 1,
+                                    'events_out_of_stock': 1,
+                                    'events_stale': 1})
+        # One stock write for the batch
+        self.assertEqual(self.service.metrics.histogram('stock_upsert').count, 1)
+        self.assertEqual(self.service.cache.get((12, 9)), (100, datetime.datetime(2019, 9, 22, 6, 23, 4)))
+        self.test_service_db.cursor.execute("SELECT item_number, current_value FROM stock ORDER BY item_number;")
+        self.assertEqual(self.test_service_db.cursor.fetchall(), [(12, 100), (14, 5)])
+        self.test_service_db.cursor.execute("SELECT count(*) FROM events;")
+        self.assertEqual(self.test_service_db.cursor.fetchone()[0], 7)
+        # Committed ids are known to the dedup filter
+        self.service.process_batch([StockEventCodec.encode_json(event)])
+        self.assertEqual(self.service.metrics.counters['events_duplicate'].value, 3)
+        # Invalid values are skipped, not inserted with the batch
+        self.service.process_batch([StockEventCodec.encode_json(dict(event, transaction_id=transaction_id,
+                                                                     value=value))
+                                    for transaction_id, value in [('dddddddd-3cbb-42c2-9140-697ffc278ef8', '1'),
+                                                                  ('eeeeeeee-3cbb-42c2-9140-697ffc278ef8', 'x')]])
+        self.assertEqual(self.service.metrics.counters['events_malformed'].value, 1)
+        self.test_service_db.cursor.execute("SELECT count(*) FROM events;")
+        self.assertEqual(self.test_service_db.cursor.fetchone()[0], 8)
+
+    def test_process_batch_compacted_other_writer(self):
+        event = {'transaction_id': 'ceb2c843-3cbb-42c2-9140-697ffc278ef8', 'event_type': 'sale',
+                 'date': '2019-09-22T06:23:02Z', 'store_number': '9', 'item_number': '12', 'value': '26'}
+        self.service.compaction = True
+        self.service.warm_cache()
+        # Another writer moved the cached item: the fold starts from the locked row
+        self.test_service_db.cursor.execute("UPDATE stock SET current_value=10 WHERE item_number=12 AND store_number=9;")
+        self.test_service_db.commit()
+        self.service.process_batch([StockEventCodec.encode_json(event)])
+        self.assertEqual(self.service.metrics.counters['events_out_of_stock'].value, 1)
+        self.test_service_db.cursor.execute("SELECT current_value from stock WHERE item_number=12 AND store_number=9;")
+        self.assertEqual(self.test_service_db.cursor.fetchone()[0], 10)
+        # A new item created by another writer after the read is not overwritten
+        self.test_service_db.cursor.execute("INSERT INTO stock VALUES (30, 9, 7, '2019-09-22T06:00:00Z');")
+        self.test_service_db.commit()
+        get_item_states = self.service._get_item_states
+        with mock.patch.object(self.service, '_get_item_states',
+                               side_effect=lambda item_keys: {item_key: item_state for item_key, item_state
+                                                              in get_item_states(item_keys).items()
+                                                              if item_key != (30, 9)}):
+            self.service.process_batch([StockEventCodec.encode_json(
+                dict(event, transaction_id='407f9c78-13a1-4745-a491-84c4bb09468c', event_type='incoming',
+                     item_number='30', value='5'))])
+        self.assertEqual(self.service.metrics.counters['events_applied'].value, 1)
+        self.test_service_db.cursor.execute("SELECT current_value from stock WHERE item_number=30 AND store_number=9;")
+        self.assertEqual(self.test_service_db.cursor.fetchone()[0], 12)
+        self.assertEqual(self.service.cache.get((30, 9)), (12, datetime.datetime(2019, 9, 22, 6, 23, 2)))
+
+    def test_get_batch(self):
+        self.service.kafka_client = mock.Mock()
+        self.service.kafka_client.consumer.consume.side_effect = ['message1', 'message2', 'message3']
+        self.service.batch_size = 2
+        self.assertEqual(self.service._get_batch(), ['message1', 'message2'])
+        self.service.kafka_client.consumer.consume.side_effect = ['message3', None]
+        self.assertEqual(self.service._get_batch(), ['message3'])
 
     def tearDown(self):
         self.postgresql.stop()
@@ -0,0 +1,105 @@
+import datetime
+import json
+from unittest import TestCase
+import urllib.error
+import urllib.request
+import testing.postgresql
+import psycopg2
+
+from database.database import StockServiceDB
+from database.pool import StockServiceDBPool
+from service.snapshot import StockReader, StockSnapshot
+
+
+def init_test_db(postgresql):
+    conn = psycopg2.connect(**postgresql.dsn())
+    cursor = conn.cursor()
+    cursor.execute(
+        "CREATE TABLE stock (item_number INTEGER NOT NULL, store_number INTEGER NOT NULL, PRIMARY KEY (item_number, store_number), current_value INTEGER, last_update TIMESTAMP);")
+    cursor.execute(
+        "INSERT INTO stock values(12, 9, 116, '2018-12-03T23:57:40Z'), (13, 9, 5, '2018-12-04T10:00:00Z'), "
+        "(12, 2, 40, '2018-12-05T10:00:00Z')")
+    cursor.close()
+    conn.commit()
+    conn.close()
+
+
+Postgresql = testing.postgresql.PostgresqlFactory(cache_initialized_db=True,
+                                                  on_initialized=init_test_db)
+
+
+def tearDownModule():
+    Postgresql.clear_cache()
+
+
+class StockSnapshotTest(TestCase):
+
+    def setUp(self):
+        self.postgresql = Postgresql()
+        self.database = StockServiceDB(config=self.postgresql.dsn())
+        self.snapshot = StockSnapshot()
+        self.snapshot.load(self.database.stream(StockSnapshot.STOCK_SQL.format('stock')))
+
+    def test_get_item(self):
+        self.assertEqual(len(self.snapshot), 3)
+        self.assertEqual(self.snapshot.get_item(9, 12), {'store_number': 9,
+                                                         'item_number': 12,
+                                                         'current_value': 116,
+                                                         'last_update': datetime.datetime(2018, 12, 3, 23, 57, 40)})
+        self.assertIsNone(self.snapshot.get_item(9, 99))
+        self.assertEqual([row['item_number'] for row in self.snapshot.get_store(9)], [12, 13])
+        self.assertEqual([row['store_number'] for row in self.snapshot.get_item_stores(12)], [2, 9])
+        self.assertEqual(self.snapshot.get_store(99), [])
+
+    def test_apply(self):
+        self.snapshot.apply({(12, 9): (100, datetime.datetime(2019, 1, 1)),
+                             (14, 3): (7, datetime.datetime(2019, 1, 1))})
+        self.assertEqual(self.snapshot.get_item(9, 12)['current_value'], 100)
+        self.assertEqual([row['store_number'] for row in self.snapshot.get_item_stores(14)], [3])
+        self.assertEqual([(row['store_number'], row['item_number']) for row in self.snapshot.get_all()],
+                         [(2, 12), (3, 14), (9, 12), (9, 13)])
+
+    def test_get_rows(self):
+        self.assertEqual(len(list(self.snapshot.get_rows('/stock'))), 3)
+        self.assertEqual(len(self.snapshot.get_rows('/stock/9')), 2)
+        self.assertEqual(len(self.snapshot.get_rows('/stock/9/12')), 1)
+        self.assertEqual(self.snapshot.get_rows('/stock/9/99'), [])
+        self.assertEqual(len(self.snapshot.get_rows('/items/12/')), 2)
+        self.assertIsNone(self.snapshot.get_rows('/stock/nine'))
+        self.assertIsNone(self.snapshot.get_rows('/items'))
+        self.assertIsNone(self.snapshot.get_rows('/other/1'))
+
+    def test_start_server(self):
+        self.snapshot.start_server(0)
+        url = 'http://127.0.0.1:{}'.format(self.snapshot.server.server_address[1])
+        with urllib.request.urlopen(url + '/stock/9') as response:
+            rows = json.loads(response.read().decode('utf-8'))
+        self.assertEqual(rows[0], {'store_number': 9, 'item_number': 12, 'current_value': 116,
+                                   'last_update': '2018-12-03T23:57:40'})
+        self.assertEqual(len(rows), 2)
+        with urllib.request.urlopen(url + '/stock') as response:
+            rows = json.loads(response.read().decode('utf-8'))
+        self.assertEqual([(row['store_number'], row['item_number']) for row in rows], [(2, 12), (9, 12), (9, 13)])
+        with self.assertRaises(urllib.error.HTTPError):
+            urllib.request.urlopen(url + '/stock/nine')
+
+    def test_reader(self):
+        reader = StockReader(database=self.database)
+        self.assertEqual(sorted(row['item_number'] for row in reader.iter_store(9)), [12, 13])
+        self.assertEqual(sorted(row['store_number'] for row in reader.iter_item_stores(12)), [2, 9])
+        self.assertEqual(reader.get_item(2, 12)['current_value'], 40)
+        self.assertIsNone(reader.get_item(2, 13))
+
+    def test_reader_pool(self):
+        pool = StockServiceDBPool(config=self.postgresql.dsn(), min_size=1, max_size=1)
+        reader = StockReader(pool=pool)
+        # Every read gives its connection back, a pool of one is enough
+        self.assertEqual(sorted(row['item_number'] for row in reader.iter_store(9)), [12, 13])
+        self.assertEqual(reader.get_item(2, 12)['current_value'], 40)
+        self.assertEqual(sorted(row['store_number'] for row in reader.iter_item_stores(12)), [2, 9])
+        pool.close()
+
+    def tearDown(self):
+        self.snapshot.stop()
+        self.database.close()
+        self.postgresql.stop()
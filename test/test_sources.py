@@ -0,0 +1,44 @@
+import bz2
+import gzip
+import os
+import tempfile
+import zipfile
+from unittest import TestCase
+
+from importer.sources import StockImportSource
+
+
+class StockImportSourceTest(TestCase):
+
+    def setUp(self):
+        self.input_dir = tempfile.TemporaryDirectory()
+        with open('samples/csv_sample_1.csv', 'rb') as csv_file:
+            self.csv_content = csv_file.read()
+
+    def _get_members(self, filename):
+        source = StockImportSource(os.path.join(self.input_dir.name, filename), '.csv')
+        return [(member_name, csv_file.read()) for member_name, csv_file in source.iter_members()]
+
+    def test_is_supported(self):
+        self.assertTrue(StockImportSource.is_supported('csv_sample_1.csv', '.csv'))
+        self.assertTrue(StockImportSource.is_supported('csv_sample_1.csv.gz', '.csv'))
+        self.assertTrue(StockImportSource.is_supported('csv_all_incoming.zip', '.csv'))
+        self.assertFalse(StockImportSource.is_supported('README.md', '.csv'))
+
+    def test_iter_members(self):
+        with zipfile.ZipFile(os.path.join(self.input_dir.name, 'drop.zip'), 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr('first.csv', self.csv_content)
+            archive.writestr('notes.txt', b'Not a CSV file')
+            archive.writestr('daily/second.csv', self.csv_content)
+        with gzip.open(os.path.join(self.input_dir.name, 'drop.csv.gz'), 'wb') as gzip_file:
+            gzip_file.write(self.csv_content)
+        with bz2.open(os.path.join(self.input_dir.name, 'drop.csv.bz2'), 'wb') as bzip2_file:
+            bzip2_file.write(self.csv_content)
+        csv_text = self.csv_content.decode()
+        self.assertEqual(self._get_members('drop.zip'), [('drop.zip/first.csv', csv_text),
+                                                         ('drop.zip/daily/second.csv', csv_text)])
+        self.assertEqual(self._get_members('drop.csv.gz'), [('drop.csv.gz', csv_text)])
+        self.assertEqual(self._get_members('drop.csv.bz2'), [('drop.csv.bz2', csv_text)])
+
+    def tearDown(self):
+        self.input_dir.cleanup()
@@ -1,4 +1,6 @@
 from unittest import TestCase
+import datetime
+from uuid import UUID
 
 from importer.validator import StockRecordValidator, StockValidatorException
 
@@ -52,3 +54,49 @@ class StockImporterTest(TestCase):
         self.assertTrue(self.validator.validate(valid_list_value))
         invalid_list_value = {"event_type": "broken"}
         self.assertFalse(self.validator.validate(invalid_list_value))
+
+    def test_convert_datetime(self):
+        expected_datetime = datetime.datetime(2018, 12, 3, 23, 57, 40)
+        self.assertEqual(self.validator._convert_datetime('2018-12-03T23:57:40Z'), expected_datetime)
+        # Fallback parser, normalized to naive UTC
+        self.assertEqual(self.validator._convert_datetime('2018-12-04T00:57:40+01:00'), expected_datetime)
+        self.validator.datetime_fallback = False
+        with self.assertRaises(StockValidatorException) as context:
+            self.validator._convert_datetime('2018-12-04T00:57:40+01:00')
+        self.assertTrue('Not a valid datetime string' in str(context.exception))
+        with self.assertRaises(StockValidatorException) as context:
+            self.validator._convert_datetime('2018-13-03T23:57:40Z')
+        self.assertTrue('Not a valid datetime string' in str(context.exception))
+
+    def test_convert(self):
+        validator = StockRecordValidator(config={'transaction_id': '_check_uuid',
+                                                 'event_type': ['incoming', 'sale'],
+                                                 'date': '_check_datetime',
+                                                 'store_number': '_check_integer',
+                                                 'item_number': '_check_integer',
+                                                 'value': '_check_integer'})
+        record_line = {'transaction_id': '7c71fb42-1f5e-45e1-be16-7d4d772d1aab',
+                       'event_type': 'sale',
+                       'date': '2018-12-03T23:57:40Z',
+                       'store_number': '9',
+                       'item_number': '8',
+                       'value': '116'}
+        self.assertEqual(validator.convert(record_line),
+                         {'transaction_id': UUID('7c71fb42-1f5e-45e1-be16-7d4d772d1aab'),
+                          'event_type': 'sale',
+                          'date': datetime.datetime(2018, 12, 3, 23, 57, 40),
+                          'store_number': 9,
+                          'item_number': 8,
+                          'value': 116})
+        record_line['value'] = 'notanint'
+        self.assertIsNone(validator.convert(record_line))
+        record_line['value'] = ''
+        self.assertIsNone(validator.convert(record_line))
+
+    def test_compile(self):
+        validator = StockRecordValidator(config={'transaction_id': '_check_not_existing',
+                                                 'event_type': 42})
+        validator.line_length = 1
+        self.assertFalse(validator.validate({'transaction_id': '7a21e465-3ae3-4546-b2fa-e87812e4018c'}))
+        self.assertFalse(validator.validate({'event_type': 'incoming'}))
+        self.assertFalse(validator.validate({'not_in_config': 'incoming'}))
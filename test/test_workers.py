@@ -0,0 +1,113 @@
+import json
+from unittest import TestCase, mock
+import testing.postgresql
+import psycopg2
+
+from kafka_client.codec import StockEventCodec
+from service.workers import StockServiceWorkerPool
+
+
+def init_test_db(postgresql):
+    conn = psycopg2.connect(**postgresql.dsn())
+    cursor = conn.cursor()
+    cursor.execute(
+        "CREATE TABLE events (transaction_id uuid NOT NULL, event_type VARCHAR, date TIMESTAMP NOT NULL, PRIMARY KEY (transaction_id, date), store_number INTEGER, item_number INTEGER, value INTEGER, inserted_at TIMESTAMP NOT NULL DEFAULT now());")
+    cursor.execute(
+        "CREATE TABLE event_ids (transaction_id uuid PRIMARY KEY);")
+    cursor.execute(
+        "CREATE TABLE stock (item_number INTEGER NOT NULL, store_number INTEGER NOT NULL, PRIMARY KEY (item_number, store_number), current_value INTEGER, last_update TIMESTAMP);")
+    cursor.execute(
+        "INSERT INTO stock values(12, 9, 116, '2018-12-03T23:57:40Z')")
+    cursor.close()
+    conn.commit()
+    conn.close()
+
+
+Postgresql = testing.postgresql.PostgresqlFactory(cache_initialized_db=True,
+                                                  on_initialized=init_test_db)
+
+
+def tearDownModule():
+    Postgresql.clear_cache()
+
+
+class StockServiceWorkerPoolTest(TestCase):
+
+    def setUp(self):
+        self.postgresql = Postgresql()
+        self.worker_pool = StockServiceWorkerPool(worker_count=2,
+                                                  database_config=self.postgresql.dsn(),
+                                                  kafka_client=mock.Mock())
+
+    def test_get_worker_index(self):
+        event = '{"transaction_id": "d2a531fa-a417-4983-ab7d-4bb1411c6250", "event_type": "incoming", ' \
+                '"date": "2019-08-07T05:48:12Z", "store_number": "9", "item_number": "12", "value": "400"}'
+        same_key_event = '{"transaction_id": "407f9c78-13a1-4745-a491-84c4bb09468c", "event_type": "sale", ' \
+                         '"date": "2019-08-08T05:48:12Z", "store_number": 9, "item_number": 12, "value": "4"}'
+        self.assertEqual(self.worker_pool._get_worker_index(event),
+                         self.worker_pool._get_worker_index(same_key_event))
+        self.assertEqual(self.worker_pool._get_worker_index('<note>That is not a JSON</note>'), 0)
+        binary_event = StockEventCodec(StockEventCodec.BINARY_FORMAT).encode(json.loads(event))
+        self.assertEqual(self.worker_pool._get_worker_index(binary_event), self.worker_pool._get_worker_index(event))
+
+    def test_dispatch(self):
+        self.worker_pool._start_workers()
+        self.worker_pool.dispatch('{"transaction_id": "d2a531fa-a417-4983-ab7d-4bb1411c6250", '
+                                  '"event_type": "incoming", "date": "2019-08-07T05:48:12Z", '
+                                  '"store_number": "9", "item_number": "12", "value": "4"}')
+        self.worker_pool.dispatch('{"transaction_id": "407f9c78-13a1-4745-a491-84c4bb09468c", '
+                                  '"event_type": "incoming", "date": "2019-08-07T05:48:12Z", '
+                                  '"store_number": "2", "item_number": "10", "value": "400"}')
+        self.worker_pool._commit_offsets()
+        self.worker_pool.kafka_client.commit_offsets.assert_called_once()
+        # The outcomes of the workers are served with the metrics of the dispatcher
+        counters = self.worker_pool.metrics.get_summary()['counters']
+        self.assertEqual((counters['events_dispatched'], counters['events'], counters['events_applied']), (2, 2, 2))
+        self.assertEqual(self.worker_pool.pending_events, 0)
+        self.worker_pool._stop_workers()
+        conn = psycopg2.connect(**self.postgresql.dsn())
+        cursor = conn.cursor()
+        cursor.execute("SELECT item_number, store_number, current_value from stock ORDER BY item_number;")
+        self.assertEqual(cursor.fetchall(), [(10, 2, 400), (12, 9, 120)])
+        conn.close()
+
+    def test_rebalance(self):
+        self.worker_pool._start_workers()
+        self.worker_pool._rewarm_workers()
+        self.worker_pool._wait_for_workers('FLUSH')
+        # Another consumer wrote the item while its partition was assigned to it
+        conn = psycopg2.connect(**self.postgresql.dsn())
+        cursor = conn.cursor()
+        cursor.execute("UPDATE stock SET current_value=500 WHERE item_number=12 AND store_number=9;")
+        conn.commit()
+        self.worker_pool.offsets = {0: 41, 1: 7}
+        with mock.patch('service.workers.StockOffsetStore') as offset_store:
+            offset_store.return_value.load.return_value = {1: 9, 2: 3}
+            self.assertEqual(self.worker_pool._get_rebalance_offsets(None, {0: 41, 1: 7}, {1: 7, 2: -1}), {1: 9, 2: 3})
+        self.assertEqual(self.worker_pool.offsets, {1: 7})
+        # The next rebalance reads the offsets on the same pooled connection
+        connections = []
+
+        def get_offset_store(database, consumer_group, topic):
+            connections.append(database.connection)
+            return mock.Mock(**{'load.return_value': {}})
+
+        with mock.patch('service.workers.StockOffsetStore', side_effect=get_offset_store):
+            self.worker_pool._get_rebalance_offsets(None, {1: 7}, {1: 7})
+            self.worker_pool._get_rebalance_offsets(None, {1: 7}, {1: 7})
+        self.assertIs(connections[0], connections[1])
+        # The cache is warmed again: the sale is checked against the current value, not the cached one
+        self.worker_pool.dispatch('{"transaction_id": "d2a531fa-a417-4983-ab7d-4bb1411c6250", '
+                                  '"event_type": "sale", "date": "2019-08-07T05:48:12Z", '
+                                  '"store_number": "9", "item_number": "12", "value": "200"}')
+        self.worker_pool._stop_workers()
+        cursor.execute("SELECT current_value from stock WHERE item_number=12 AND store_number=9;")
+        self.assertEqual(cursor.fetchone()[0], 300)
+        conn.close()
+
+    def tearDown(self):
+        for worker in self.worker_pool.workers:
+            worker.terminate()
+        if self.worker_pool.database_pool:
+            self.worker_pool.database_pool.close()
+        self.postgresql.stop()
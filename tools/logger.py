@@ -1,15 +1,88 @@
+import atexit
 import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+DEFAULT_LEVEL = logging.INFO
+DEFAULT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+_queue_handler = None
+_setup_lock = threading.Lock()
+
+
+def _get_queue_handler():
+    # One queue per process: the calling thread only enqueues, a listener thread formats and writes the records
+    global _queue_handler
+    with _setup_lock:
+        if _queue_handler is None:
+            log_queue = queue.SimpleQueue()
+            stream_handler = logging.StreamHandler()
+            stream_handler.setLevel(DEFAULT_LEVEL)
+            stream_handler.setFormatter(logging.Formatter(DEFAULT_FORMAT))
+            queue_listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+            queue_listener.start()
+            # Stopping the listener writes out the records still queued
+            atexit.register(queue_listener.stop)
+            _queue_handler = logging.handlers.QueueHandler(log_queue)
+    return _queue_handler
 
 
 def get_logger(name):
+    # Safe to call repeatedly: the handler is added once per logger
     logger = logging.getLogger(name)
-    logger.setLevel(logging.INFO)
-    ch = logging.StreamHandler()
-    ch.setLevel(logging.INFO)
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    ch.setFormatter(formatter)
-    logger.addHandler(ch)
+    queue_handler = _get_queue_handler()
+    if queue_handler not in logger.handlers:
+        logger.setLevel(DEFAULT_LEVEL)
+        logger.addHandler(queue_handler)
     return logger
 
 
+class SampledLogger:
+    # For per-event lines: at most max_records records per interval_s are written (0: no limit), the others are
+    # only counted and reported with the next written record. Level checks come first, so filtered calls stay cheap.
+
+    DEFAULT_MAX_RECORDS = 10
+    DEFAULT_INTERVAL_S = 1
+
+    def __init__(self, logger, max_records=None, interval_s=None):
+        self.logger = logger
+        self.max_records = self.DEFAULT_MAX_RECORDS if max_records is None else max_records
+        self.interval_s = interval_s if interval_s else self.DEFAULT_INTERVAL_S
+        self.window_start = 0
+        self.window_count = 0
+        self.suppressed_count = 0
+
+    def log(self, level, msg, *args):
+        if not self.logger.isEnabledFor(level):
+            return
+        if self.max_records:
+            now = time.monotonic()
+            if now - self.window_start >= self.interval_s:
+                self.window_start = now
+                self.window_count = 0
+            self.window_count += 1
+            if self.window_count > self.max_records:
+                self.suppressed_count += 1
+                return
+            if self.suppressed_count:
+                self.logger.log(level, '%s similar records suppressed.', self.suppressed_count)
+                self.suppressed_count = 0
+        self.logger.log(level, msg, *args)
+
+    def debug(self, msg, *args):
+        self.log(logging.DEBUG, msg, *args)
+
+    def info(self, msg, *args):
+        self.log(logging.INFO, msg, *args)
+
+    def warning(self, msg, *args):
+        self.log(logging.WARNING, msg, *args)
+
+
+def get_sampled_logger(name, max_records=None, interval_s=None):
+    return SampledLogger(get_logger(name), max_records=max_records, interval_s=interval_s)
+
+
 logger = get_logger
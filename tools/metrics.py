@@ -0,0 +1,229 @@
+import bisect
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+
+from tools import logger
+logger = logger.get_logger(__name__)
+
+
+class MetricsCounter:
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class MetricsGauge:
+
+    def __init__(self):
+        self.value = None
+
+    def set(self, value):
+        self.value = value
+
+
+class MetricsHistogram:
+    # Fixed exponential buckets (seconds): observing a value is one bisect and a few additions
+
+    DEFAULT_BUCKETS = tuple(0.000001 * 2 ** exponent for exponent in range(25))
+
+    def __init__(self, buckets=None):
+        self.buckets = buckets if buckets else self.DEFAULT_BUCKETS
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def get_percentile(self, percentile):
+        # Upper bound of the bucket holding the percentile
+        if not self.count:
+            return None
+        rank = percentile / 100 * self.count
+        seen_count = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen_count += bucket_count
+            if seen_count >= rank:
+                return self.buckets[index] if index < len(self.buckets) else self.max
+        return self.max
+
+    def get_summary(self):
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else None,
+                'p50': self.get_percentile(50),
+                'p99': self.get_percentile(99),
+                'max': self.max}
+
+
+class MetricsTimer:
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class MetricsRegistry:
+    # Metrics of one process. Written by the processing thread only, read by the endpoint and summary threads.
+
+    DEFAULT_PREFIX = 'stockservice'
+    DEFAULT_HOST = '127.0.0.1'
+    DEFAULT_SUMMARY_INTERVAL_S = 60
+
+    def __init__(self, prefix=None):
+        self.prefix = prefix if prefix else self.DEFAULT_PREFIX
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.server = None
+        self.summary_stop = None
+        # {source: state} of the registries of other processes, e.g. workers, reported with their own values
+        self.source_states = {}
+
+    def counter(self, name):
+        counter = self.counters.get(name)
+        if counter is None:
+            counter = self.counters[name] = MetricsCounter()
+        return counter
+
+    def gauge(self, name):
+        gauge = self.gauges.get(name)
+        if gauge is None:
+            gauge = self.gauges[name] = MetricsGauge()
+        return gauge
+
+    def histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = MetricsHistogram()
+        return histogram
+
+    def timer(self, name):
+        return MetricsTimer(self.histogram(name))
+
+    def get_state(self):
+        # Picklable copy of the values, sent to the registry of another process
+        return {'counters': {name: counter.value for name, counter in list(self.counters.items())},
+                'gauges': {name: gauge.value for name, gauge in list(self.gauges.items())},
+                'histograms': {name: (list(histogram.counts), histogram.count, histogram.total, histogram.max)
+                               for name, histogram in list(self.histograms.items())}}
+
+    def set_source_state(self, source, state):
+        # States are cumulative: the latest one of a source replaces the one before
+        self.source_states[source] = state
+
+    def add_state(self, state):
+        # Counters, histograms and set gauges are added up; histograms are expected on the same buckets
+        for name, value in state['counters'].items():
+            self.counter(name).inc(value)
+        for name, value in state['gauges'].items():
+            if value is not None:
+                gauge = self.gauge(name)
+                gauge.set(value if gauge.value is None else gauge.value + value)
+        for name, (counts, count, total, max_value) in state['histograms'].items():
+            histogram = self.histogram(name)
+            histogram.counts = [own_count + bucket_count for own_count, bucket_count in zip(histogram.counts, counts)]
+            histogram.count += count
+            histogram.total += total
+            histogram.max = max(histogram.max, max_value)
+
+    def _get_merged(self):
+        if not self.source_states:
+            return self
+        merged = MetricsRegistry(prefix=self.prefix)
+        merged.add_state(self.get_state())
+        for state in list(self.source_states.values()):
+            merged.add_state(state)
+        return merged
+
+    def get_summary(self):
+        registry = self._get_merged()
+        return {'counters': {name: counter.value for name, counter in sorted(registry.counters.items())},
+                'gauges': {name: gauge.value for name, gauge in sorted(registry.gauges.items())},
+                'timings': {name: histogram.get_summary() for name, histogram in sorted(registry.histograms.items())}}
+
+    def render(self):
+        # Prometheus text format
+        registry = self._get_merged()
+        lines = []
+        for name, counter in sorted(list(registry.counters.items())):
+            lines.append('# TYPE {}_{}_total counter'.format(self.prefix, name))
+            lines.append('{}_{}_total {}'.format(self.prefix, name, counter.value))
+        for name, gauge in sorted(list(registry.gauges.items())):
+            if gauge.value is None:
+                continue
+            lines.append('# TYPE {}_{} gauge'.format(self.prefix, name))
+            lines.append('{}_{} {}'.format(self.prefix, name, gauge.value))
+        for name, histogram in sorted(list(registry.histograms.items())):
+            metric_name = '{}_{}_seconds'.format(self.prefix, name)
+            lines.append('# TYPE {} histogram'.format(metric_name))
+            cumulative_count = 0
+            for bucket, bucket_count in zip(histogram.buckets, histogram.counts):
+                cumulative_count += bucket_count
+                lines.append('{}_bucket{{le="{:g}"}} {}'.format(metric_name, bucket, cumulative_count))
+            lines.append('{}_bucket{{le="+Inf"}} {}'.format(metric_name, histogram.count))
+            lines.append('{}_sum {}'.format(metric_name, histogram.total))
+            lines.append('{}_count {}'.format(metric_name, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def log_summary(self):
+        logger.info('Metrics: {}'.format(json.dumps(self.get_summary())))
+
+    def start_server(self, port, host=None):
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host if host else self.DEFAULT_HOST, port), MetricsHandler)
+        threading.Thread(target=self.server.serve_forever, name='metrics-server', daemon=True).start()
+        logger.info('Metrics endpoint: http://{}:{}/metrics'.format(*self.server.server_address[:2]))
+
+    def start_summary_log(self, interval_s=None):
+        interval_s = interval_s if interval_s else self.DEFAULT_SUMMARY_INTERVAL_S
+        self.summary_stop = threading.Event()
+
+        def _log_summaries(summary_stop):
+            while not summary_stop.wait(interval_s):
+                self.log_summary()
+
+        threading.Thread(target=_log_summaries, args=(self.summary_stop,), name='metrics-summary',
+                         daemon=True).start()
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if self.summary_stop:
+            self.summary_stop.set()
+            self.summary_stop = None